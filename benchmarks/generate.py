@@ -0,0 +1,90 @@
+# ! python3
+
+""" Deterministic generators for synthetic ING exports and database.json rule sets
+
+        python benchmarks/generate.py <directory> [--rows N] [--categories N] [--payees N] [--memos N] [--seed N]
+
+The same arguments always give the same files, so benchmark runs can be compared.
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import random
+
+HEADER = ["Datum", "Naam / Omschrijving", "Rekening", "Tegenrekening", "Code", "Af Bij", "Bedrag (EUR)",
+          "MutatieSoort", "Mededelingen"]
+
+WORDS = ['ALBERT', 'HEIJN', 'JUMBO', 'LIDL', 'ALDI', 'SHELL', 'ESSO', 'KRUIDVAT', 'HEMA', 'ACTION', 'BOL', 'COM',
+         'NS', 'GVB', 'RET', 'ZIGGO', 'KPN', 'VODAFONE', 'ENECO', 'VATTENFALL', 'WATERNET', 'GEMEENTE', 'BELASTING',
+         'ZORG', 'VERZEKERING', 'BAKKER', 'SLAGER', 'APOTHEEK', 'TANDARTS', 'HUISARTS', 'SPORT', 'SCHOOL', 'BV', 'NV']
+CODES = [('BA', 'Betaalautomaat'), ('GT', 'Online bankieren'), ('IC', 'Incasso'), ('OV', 'Overschrijving')]
+
+
+def name(rng, index):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))) + ' ' + str(index)
+
+
+def generateDatabase(path, categories=100, payees=20, memos=5, seed=1):
+    """ database.json with plain payee and memo names, plus a few regex rules per category like real rule sets """
+    rng = random.Random(seed)
+    data = {'categories': []}
+
+    for i in range(categories):
+        x = {'Master Category': 'Master ' + str(i % 12), 'Category': 'Category ' + str(i),
+             'Payees': [name(rng, i * payees + j) for j in range(payees)],
+             'Memos': ['memo ' + name(rng, i * memos + j).lower() for j in range(memos)]}
+        if i % 10 == 0:
+            x['Payees'].append(rng.choice(WORDS) + '.*' + str(i))
+        data['categories'].append(x)
+
+    with open(path, 'w') as f:
+        json.dump(data, f, sort_keys=True, indent=4, separators=(',', ': '))
+    return data
+
+
+def generateExport(path, rows=10000, data=None, unknown=0.1, seed=1):
+    """ ING export where most payees come from the rule set and a fraction is unknown """
+    rng = random.Random(seed)
+    payees = [payee for x in (data or {'categories': []})['categories'] for payee in x['Payees'] if '*' not in payee]
+    unknowns = [name(rng, 100000 + i) for i in range(200)]
+    start = datetime.date(2015, 1, 1)
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(HEADER)
+
+        for i in range(rows):
+            date = start + datetime.timedelta(days=i * 3650 // max(rows, 1))
+            payee = rng.choice(unknowns) if not payees or rng.random() < unknown else rng.choice(payees)
+            code, kind = rng.choice(CODES)
+            memo = 'Pasvolgnr:%03d %s' % (rng.randrange(1000), date.strftime('%d-%m-%Y'))
+            if rng.random() < 0.02:
+                # Multi-line memo, quoted newline as in real exports
+                memo = memo + '\nIBAN: NL%02dINGB%010d' % (rng.randrange(100), rng.randrange(10 ** 10))
+            writer.writerow([date.strftime('%Y%m%d'), payee, 'NL01INGB%010d' % rng.randrange(3), '', code,
+                             'Bij' if rng.random() < 0.1 else 'Af', '%d,%02d' % (rng.randrange(500), rng.randrange(100)),
+                             kind, memo])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic ING export and rule database.')
+    parser.add_argument('directory')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--categories', type=int, default=100)
+    parser.add_argument('--payees', type=int, default=20, help='payees per category')
+    parser.add_argument('--memos', type=int, default=5, help='memos per category')
+    parser.add_argument('--unknown', type=float, default=0.1, help='fraction of rows with an unknown payee')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.directory, exist_ok=True)
+    data = generateDatabase(os.path.join(args.directory, 'database.json'), args.categories, args.payees, args.memos,
+                            args.seed)
+    generateExport(os.path.join(args.directory, 'export.csv'), args.rows, data, args.unknown, args.seed)
+
+
+if __name__ == '__main__':
+    main()
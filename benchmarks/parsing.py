@@ -0,0 +1,75 @@
+# ! python3
+
+""" Micro-benchmark of the date and amount parsing in Transaction
+
+Compares the previous path (regex + strptime/strftime per row, float amounts) with the cached,
+regex-free parseDate and the integer-cent parseAmount.
+
+        python benchmarks/parsing.py [rows]
+"""
+
+import datetime
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main'))
+
+from main import parseAmount, parseDate
+
+
+def previousDate(date):
+    regex = re.compile(r'\d\d\d\d\d\d\d\d')
+    date = regex.search(date)
+    date = datetime.datetime.strptime(date.group(0), '%Y%m%d').strftime('%d/%m/%y')
+    return date
+
+
+def previousAmount(amount):
+    return float(amount.replace(',', '.'))
+
+
+def sample(rows):
+    # A year of transactions: a few hundred distinct dates, amounts in the ING '1234,56' format
+    random.seed(1)
+    start = datetime.date(2020, 1, 1)
+    dates = [(start + datetime.timedelta(days=random.randrange(366))).strftime('%Y%m%d') for _ in range(rows)]
+    amounts = ['%d,%02d' % (random.randrange(2000), random.randrange(100)) for _ in range(rows)]
+    return dates, amounts
+
+
+def measure(function, values, repeat=5):
+    best = min(timeit.repeat(lambda: [function(value) for value in values], number=1, repeat=repeat))
+    return len(values) / best
+
+
+def main(rows=100000):
+    dates, amounts = sample(rows)
+
+    # Same results on the sample, apart from the float -> cents representation
+    assert [previousDate(date) for date in dates[:1000]] == [parseDate(date) for date in dates[:1000]]
+    assert [round(previousAmount(amount) * 100) for amount in amounts[:1000]] == [parseAmount(amount) for amount in amounts[:1000]]
+
+    rows = list(zip(dates, amounts))
+    results = [
+        ('date, previous', measure(previousDate, dates)),
+        ('date, parseDate', measure(parseDate, dates)),
+        ('amount, previous', measure(previousAmount, amounts)),
+        ('amount, parseAmount', measure(parseAmount, amounts)),
+        ('row, previous', measure(lambda row: (previousDate(row[0]), previousAmount(row[1])), rows)),
+        ('row, current', measure(lambda row: (parseDate(row[0]), parseAmount(row[1])), rows)),
+    ]
+
+    for name, rate in results:
+        print('%-22s %12.0f rows/s' % (name, rate))
+
+    # Exact cents cost a little against the C float parser, the date cache more than makes up for it
+    print('date speed-up:   %.1fx' % (results[1][1] / results[0][1]))
+    print('amount speed-up: %.1fx' % (results[3][1] / results[2][1]))
+    print('row speed-up:    %.1fx' % (results[5][1] / results[4][1]))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,207 @@
+# ! python3
+
+""" Benchmark suite for the per-row conversion path
+
+Generates a synthetic ING export and rule database (see generate.py) and measures rows/s and peak memory of
+parsing (into Transaction objects and into batches, see batch.py), classification and the full headless conversion.
+Runs offline and without a display.
+
+        python benchmarks/run.py [--rows N] [--categories N] [--payees N] [--files N] [--output results.json]
+                                 [--compare previous.json]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import closing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main'))
+
+from cache import ClassificationCache
+from cli import convertDirectory
+from convert import convertFile, parseBatches, parseTransactions, readRows
+from main import Database
+from generate import generateDatabase, generateExport
+
+
+def fresh(database):
+    # Cold start: nothing loaded, compiled or cached
+    Database.filename = database
+    Database.backend = None
+    Database.data = None
+    Database.matchers = {}
+    Database.cache = ClassificationCache()
+
+
+def parse(context):
+    with closing(readRows(context['export'])) as rows:
+        return sum(1 for _ in parseTransactions(rows))
+
+
+def parseBatched(context):
+    with closing(readRows(context['export'])) as rows:
+        return sum(len(batch) for batch in parseBatches(rows))
+
+
+def keepTransactions(context):
+    # Memory of a whole export in memory, as Transaction objects
+    with closing(readRows(context['export'])) as rows:
+        transactions = list(parseTransactions(rows))
+    return len(transactions)
+
+
+def keepBatches(context):
+    with closing(readRows(context['export'])) as rows:
+        batches = list(parseBatches(rows))
+    return sum(len(batch) for batch in batches)
+
+
+def classify(context):
+    for transaction in context['transactions']:
+        transaction.classify()
+    return len(context['transactions'])
+
+
+def classifyBatched(context):
+    for batch in context['batches']:
+        batch.classify()
+    return sum(len(batch) for batch in context['batches'])
+
+
+def convert(context):
+    written, unknown = convertFile(context['export'], os.path.join(context['directory'], 'output.csv'),
+                                   uncategorized=os.path.join(context['directory'], 'uncategorized.csv'))
+    return written + unknown
+
+
+def convertParallel(context):
+    output = os.path.join(context['directory'], 'output')
+    os.makedirs(output, exist_ok=True)
+    convertDirectory(context['input'], output, workers=context['workers'], database=context['database'])
+    return context['rows'] * context['files']
+
+
+def prepare(context, name):
+    fresh(context['database'])
+    if name == 'classify, warm cache':
+        classify(context)
+
+
+BENCHMARKS = [
+    ('parse', parse),
+    ('parse, batches', parseBatched),
+    ('keep all, transactions', keepTransactions),
+    ('keep all, batches', keepBatches),
+    ('classify, cold', classify),
+    ('classify, warm cache', classify),
+    ('classify, batches', classifyBatched),
+    ('convert', convert),
+    ('convert directory, parallel', convertParallel),
+]
+
+
+def measure(context, name, function, repeat):
+    best = None
+    rows = 0
+    for _ in range(repeat):
+        prepare(context, name)
+        started = time.perf_counter()
+        rows = function(context)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    # Separate run for the memory, tracemalloc slows everything down. Worker processes are not traced.
+    prepare(context, name)
+    tracemalloc.start()
+    function(context)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'rows': rows, 'seconds': best, 'rows_per_second': rows / best if best else 0.0,
+            'peak_memory_kb': peak // 1024}
+
+
+def compare(results, previous):
+    print()
+    print('%-30s %12s %12s %8s' % ('compared to previous', 'rows/s now', 'rows/s then', 'ratio'))
+    for name, result in results['results'].items():
+        old = previous['results'].get(name)
+        if old and old['rows_per_second']:
+            print('%-30s %12.0f %12.0f %7.2fx' % (name, result['rows_per_second'], old['rows_per_second'],
+                                                  result['rows_per_second'] / old['rows_per_second']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark parsing, classification and conversion.')
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--categories', type=int, default=100)
+    parser.add_argument('--payees', type=int, default=20, help='payees per category')
+    parser.add_argument('--memos', type=int, default=5, help='memos per category')
+    parser.add_argument('--files', type=int, default=4, help='files for the parallel directory conversion')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', action='append', help='only run benchmarks whose name starts with this')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='ingtoynab-bench-')
+    try:
+        database = os.path.join(directory, 'database.json')
+        data = generateDatabase(database, args.categories, args.payees, args.memos, args.seed)
+
+        export = os.path.join(directory, 'export.csv')
+        generateExport(export, args.rows, data, seed=args.seed)
+
+        input_path = os.path.join(directory, 'input')
+        os.makedirs(input_path)
+        for i in range(args.files):
+            shutil.copy(export, os.path.join(input_path, 'export%d.csv' % i))
+
+        context = {'directory': directory, 'database': database, 'export': export, 'input': input_path,
+                   'rows': args.rows, 'files': args.files, 'workers': args.workers}
+        fresh(database)
+        with closing(readRows(export)) as rows:
+            context['transactions'] = list(parseTransactions(rows))
+        with closing(readRows(export)) as rows:
+            context['batches'] = list(parseBatches(rows))
+
+        results = {
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': {'rows': args.rows, 'categories': args.categories, 'payees': args.payees,
+                           'memos': args.memos, 'files': args.files, 'workers': args.workers, 'seed': args.seed},
+            'results': {},
+        }
+
+        print('%-30s %12s %10s %14s' % ('benchmark', 'rows/s', 'seconds', 'peak memory'))
+        for name, function in BENCHMARKS:
+            if args.only and not any(name.startswith(prefix) for prefix in args.only):
+                continue
+            result = measure(context, name, function, args.repeat)
+            results['results'][name] = result
+            print('%-30s %12.0f %10.3f %11d kB' % (name, result['rows_per_second'], result['seconds'],
+                                                  result['peak_memory_kb']))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
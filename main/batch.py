@@ -0,0 +1,135 @@
+""" Transactions stored column by column, for converting large exports
+
+A Transaction object per row costs an instance dict and its own strings for every field. The conversion parses the
+rows into TransactionBatch objects instead: a few hundred transactions per batch, with the dates as day numbers and
+the amounts as cents in typed arrays, Af/Bij as one byte, and payees, memos and accounts in lists in which repeated
+payees and accounts share one string. A batch is classified and written as a whole.
+
+Where a single transaction is needed (asking the user, suggestions, the batch review) batch[i] returns a small view
+with the attributes and methods of a Transaction.
+"""
+
+from array import array
+
+from main import Database, Transaction, formatAmount, formatOrdinal, parseAmount, parseOrdinal
+
+# Transactions per batch, small enough that progress reporting and cancelling stay responsive
+BATCH_ROWS = 512
+
+# Distinct payees and accounts shared between batches of one file, forgotten when there are more
+SHARED_STRINGS = 10000
+
+
+class TransactionBatch:
+
+    __slots__ = ('dates', 'payees', 'memos', 'debits', 'amounts', 'accounts', 'numbers', 'shared')
+
+    def __init__(self, shared=None):
+        # Day numbers (date.toordinal) and cents
+        self.dates = array('l')
+        self.amounts = array('q')
+        # 1 for Af (outflow), 0 for Bij (inflow)
+        self.debits = bytearray()
+        self.payees = []
+        self.memos = []
+        self.accounts = []
+        # Row numbers in the export, for warnings and for leaving out rows that were converted before
+        self.numbers = array('l')
+        # Raw payee -> payee and account -> account, the strings stored in the batch
+        self.shared = ({}, {}) if shared is None else shared
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, index):
+        if not -len(self.dates) <= index < len(self.dates):
+            raise IndexError('transaction index out of range')
+        return BatchTransaction(self, index % len(self.dates))
+
+    def __iter__(self):
+        for index in range(len(self.dates)):
+            yield BatchTransaction(self, index)
+
+    def append(self, date, payee, memo, type, amount, account='', number=0):
+        # Same arguments as Transaction and the row number. Raises MalformedRow before anything is added
+        date = parseOrdinal(date)
+        amount = parseAmount(amount)
+
+        payees, accounts = self.shared
+        if len(payees) >= SHARED_STRINGS:
+            payees.clear()
+
+        name = payees.get(payee)
+        if name is None:
+            name = payees[payee] = payee.replace(',', ' &')
+        self.payees.append(name)
+        self.accounts.append(accounts.setdefault(account, account))
+
+        self.dates.append(date)
+        self.amounts.append(amount)
+        self.debits.append(type == 'Af')
+        self.memos.append(memo)
+        self.numbers.append(number)
+
+    def classify(self, count=True):
+        """ 'Master Category: Category' or '' for every transaction, payee rules first, then memo rules.
+        With count the hits of the rules are counted, see Database.lookupMany
+        """
+        database = Database()
+        categories = database.lookupMany('Payees', self.payees, count)
+
+        missing = [index for index, category in enumerate(categories) if not category]
+        if missing:
+            found = database.lookupMany('Memos', [self.memos[index] for index in missing], count)
+            for index, category in zip(missing, found):
+                categories[index] = category
+
+        return categories
+
+    def outputRow(self, index, category):
+        # Row of the YNAB file, see convert.outputRow
+        date = formatOrdinal(self.dates[index])
+        amount = formatAmount(self.amounts[index])
+        if self.debits[index]:
+            return [date, self.payees[index], category, self.memos[index], amount, '']
+        else:
+            return [date, self.payees[index], category, self.memos[index], '', amount]
+
+
+class BatchTransaction:
+    """ One transaction of a batch, it can be used wherever a Transaction is expected """
+
+    __slots__ = ('batch', 'index')
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    @property
+    def date(self):
+        return formatOrdinal(self.batch.dates[self.index])
+
+    @property
+    def payee(self):
+        return self.batch.payees[self.index]
+
+    @property
+    def memo(self):
+        return self.batch.memos[self.index]
+
+    @property
+    def type(self):
+        return 'Af' if self.batch.debits[self.index] else 'Bij'
+
+    @property
+    def amount(self):
+        return self.batch.amounts[self.index]
+
+    @property
+    def account(self):
+        return self.batch.accounts[self.index]
+
+    describe = Transaction.describe
+    classify = Transaction.classify
+    searchPayees = Transaction.searchPayees
+    searchMemos = Transaction.searchMemos
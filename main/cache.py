@@ -0,0 +1,146 @@
+""" Classification cache
+
+The same payees and memos come back in every export. The cache remembers the rule that matched a payee or memo (its
+number, see Matcher.match), in a bounded in-memory LRU and optionally in a SQLite file that survives between runs (and
+can be shared by the worker processes of cli.py). Entries are only valid for one version of the rule database: any
+added rule or external edit of the database changes its stamp, which empties the cache.
+
+Payees and memos are cached separately, because the memo of most transactions is unique (card number, date)
+while the payee repeats, and the memo rules are only needed when the payee rules find nothing.
+"""
+
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class ClassificationCache:
+
+    maxsize = 65536
+    flush_after = 500
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        DROP TABLE IF EXISTS entries;
+        CREATE TABLE IF NOT EXISTS results (
+            field TEXT NOT NULL,
+            text TEXT NOT NULL,
+            rule INTEGER NOT NULL,
+            PRIMARY KEY (field, text)
+        ) WITHOUT ROWID;
+    '''
+
+    def __init__(self):
+        self.memory = OrderedDict()
+        self.stamp = None
+        self.diskfile = None
+        self.connection = None
+        self.pending = []
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def openDisk(self, filename):
+        # Enable the on-disk tier, it is opened on the next lookup
+        self.close()
+        self.diskfile = filename
+        self.stamp = None
+
+    def validate(self, stamp):
+        # Drop everything when the rule database has changed since the entries were cached
+        if stamp == self.stamp:
+            return
+
+        # Results that were not written yet belong to the previous rules
+        self.pending = []
+        self.memory.clear()
+        self.stamp = stamp
+
+        if self.diskfile is None:
+            return
+
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.diskfile, timeout=30, check_same_thread=False)
+            self.connection.executescript(self.schema)
+
+        with self.connection:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'stamp'").fetchone()
+            if row is None or row[0] != stamp:
+                self.connection.execute('DELETE FROM results')
+                self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('stamp', ?)", (stamp,))
+
+    def get(self, stamp, field, text, search):
+        """ Result of search(text) for field ('Payees' or 'Memos'), search is only called on a miss.
+        The rules are matched case-insensitively, so the lowercase text is a safe key.
+        """
+        key = (field, text.lower())
+
+        with self.lock:
+            self.validate(stamp)
+
+            result = self.memory.get(key)
+            if result is not None:
+                self.memory.move_to_end(key)
+                self.hits = self.hits + 1
+                return result
+
+            if self.connection is not None:
+                row = self.connection.execute('SELECT rule FROM results WHERE field = ? AND text = ?', key).fetchone()
+                if row is not None:
+                    self.disk_hits = self.disk_hits + 1
+                    self.remember(key, row[0])
+                    return row[0]
+
+            result = search(text)
+            self.misses = self.misses + 1
+            self.remember(key, result)
+
+            if self.connection is not None:
+                self.pending.append(key + (result,))
+                if len(self.pending) >= self.flush_after:
+                    self.flush()
+
+            return result
+
+    def clear(self):
+        # Forget every result, for rules that were edited in memory and are not stored yet (same stamp)
+        with self.lock:
+            self.pending = []
+            self.memory.clear()
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.execute('DELETE FROM results')
+
+    def remember(self, key, result):
+        self.memory[key] = result
+        if len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def flush(self):
+        # Write the new entries to the on-disk tier in one transaction
+        if self.connection is None or not self.pending:
+            return
+
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO results (field, text, rule) VALUES (?, ?, ?)',
+                                        self.pending)
+        self.pending = []
+
+    def save(self):
+        with self.lock:
+            self.flush()
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.flush()
+                self.connection.close()
+                self.connection = None
+
+    def statistics(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        rate = 100.0 * (self.hits + self.disk_hits) / lookups if lookups else 0.0
+        return 'Classification cache: %.1f%% hits (%d memory, %d disk, %d misses).' % (
+            rate, self.hits, self.disk_hits, self.misses)
@@ -0,0 +1,79 @@
+""" Checkpoints of conversions that were stopped halfway
+
+Output is written to <file>.part and only renamed to <file> once the whole export is converted, so a YNAB file is
+never half-written. While converting, <output>.checkpoint records how many rows of the export are done and the size
+of every .part file at that moment. When a conversion is cancelled or fails, the next conversion of the same export
+into the same output cuts the .part files back to those sizes and continues after the last row that was done,
+without classifying the earlier rows or asking about them again.
+"""
+
+import json
+import os
+import time
+
+# Seconds between two checkpoints while converting, a cancelled conversion always saves one
+INTERVAL = 2.0
+
+
+def partName(filename):
+    return str(filename) + '.part'
+
+
+def finishParts(parts):
+    # Rename the .part files of a completed conversion to their final names
+    for part in parts:
+        os.replace(part, part[:-len('.part')])
+
+
+class Checkpoint:
+
+    def __init__(self, source, outputfile, accounts=False):
+        self.filename = str(outputfile) + '.checkpoint'
+        stat = os.stat(source)
+        # A checkpoint only applies to the same version of the export, converted the same way
+        self.source = [stat.st_size, stat.st_mtime_ns]
+        self.accounts = accounts
+        self.saved = time.monotonic()
+        self.state = self.load()
+
+    def load(self):
+        # The saved state, or None when there is nothing to continue
+        try:
+            with open(self.filename) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if state.get('source') != self.source or state.get('accounts') != self.accounts:
+            return None
+
+        # Every .part file must still be there, at least as long as it was
+        for part, size in state['files'].items():
+            if not os.path.exists(part) or os.path.getsize(part) < size:
+                return None
+
+        return state
+
+    def due(self):
+        return time.monotonic() - self.saved >= INTERVAL
+
+    def save(self, records, written, unknown, files, uncategorized=False, offset=None):
+        """ records: rows of the export that are done, files: size of every .part file, uncategorized: whether
+        the uncategorized file was created, offset: byte offset in the export of the next row (chunked only)
+        """
+        state = {'source': self.source, 'accounts': self.accounts, 'records': records, 'written': written,
+                 'unknown': unknown, 'files': files, 'uncategorized': uncategorized}
+        if offset is not None:
+            state['offset'] = offset
+
+        temporary = self.filename + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(state, f)
+        os.replace(temporary, self.filename)
+        self.saved = time.monotonic()
+
+    def remove(self):
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,214 @@
+""" Chunk-parallel conversion of very large ING exports
+
+One multi-gigabyte export keeps a single worker busy while the other cores are idle. convertChunked memory-maps
+the file and cuts it into chunks that end on a record boundary. The worker processes parse and classify the chunks,
+and the results are written here in the original order, so the output is the same as that of convertFile. The
+checkpoint (see checkpoint.py) also records the byte offset of the next chunk, so a stopped conversion continues there.
+
+Memos (Mededelingen) can contain quoted newlines, a newline only ends a record outside quotes. Escaped quotes inside
+a quoted field come in pairs, so a newline is outside quotes when the number of quotes between the start of the
+chunk and the newline is even. The quotes are counted with bytes.count, not character by character in Python.
+"""
+
+import csv
+import io
+import locale
+import logging
+import mmap
+import os
+from collections import deque
+from contextlib import ExitStack
+
+import instrument
+from checkpoint import Checkpoint, finishParts
+from convert import openOutput, parseBatches
+from main import Database
+
+logger = logging.getLogger(__name__)
+
+# Files larger than this are split, chunks are at most CHUNK_BYTES
+SPLIT_BYTES = 32 << 20
+CHUNK_BYTES = 16 << 20
+# Smaller chunks cost more in sending results back than they gain
+MINIMUM_CHUNK_BYTES = 1 << 20
+
+# Encoding open() uses for the export in readRows
+ENCODING = locale.getpreferredencoding(False)
+
+
+def recordEnd(mapped, start, position):
+    # Offset just after the first newline at or after position that ends a record, a record starts at start
+    quotes = mapped[start:position].count(b'"')
+    while True:
+        newline = mapped.find(b'\n', position)
+        if newline < 0:
+            return len(mapped)
+
+        quotes = quotes + mapped[position:newline].count(b'"')
+        if quotes % 2 == 0:
+            return newline + 1
+        # Inside a quoted field, look for the next newline
+        position = newline + 1
+
+
+def splitFile(filename, chunk_bytes=CHUNK_BYTES, start=None):
+    # (start, end) byte offsets of the chunks of an export from start, by default after the header row
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            size = len(mapped)
+            chunks = []
+            if start is None:
+                start = recordEnd(mapped, 0, 0)
+            while start < size:
+                end = recordEnd(mapped, start, min(start + chunk_bytes, size))
+                chunks.append((start, end))
+                start = end
+            return chunks
+
+
+def chunkSize(filename, workers):
+    # A few chunks per worker, so a slow chunk does not leave the others waiting at the end
+    size = os.path.getsize(filename) // (workers * 4)
+    return max(MINIMUM_CHUNK_BYTES, min(CHUNK_BYTES, size))
+
+
+def classifyChunk(filename, start, end, profile=None):
+    """ Parse and classify one chunk, in a worker process. Row numbers are counted from the start of the chunk.
+
+    Returns the number of csv records in the chunk, the warnings about rows as (row number, text), and the row
+    number, category flag (1 when found), YNAB row and account of every transaction, plus the stage timings and
+    the cProfile statistics file of the worker.
+    """
+    part = instrument.profilePart(profile)
+    with instrument.profile(part):
+        result = parseChunk(filename, start, end)
+
+    report = instrument.collect()
+    return result + (report, part)
+
+
+def parseChunk(filename, start, end):
+    # Records, row warnings and converted rows of one chunk, see classifyChunk
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        text = mapped[start:end].decode(ENCODING)
+
+    records = 0
+
+    def counted(rows):
+        nonlocal records
+        for records, row in enumerate(rows, 1):
+            yield row
+
+    warnings = []
+    numbers = []
+    found = bytearray()
+    rows = []
+    accounts = []
+    for batch in parseBatches(counted(csv.reader(io.StringIO(text, newline=''))), warnings=warnings):
+        for index, category in enumerate(batch.classify()):
+            numbers.append(batch.numbers[index])
+            found.append(bool(category))
+            rows.append(batch.outputRow(index, category))
+            accounts.append(batch.accounts[index])
+
+    Database().saveResults()
+    return records, warnings, numbers, found, rows, accounts
+
+
+def convertChunked(executor, filename, outputfile, uncategorized=None, skip=None, accounts=False,
+                   flush_thread=False, chunk_bytes=CHUNK_BYTES, window=8, profile=None):
+    """ Convert one large export with the worker processes of executor (see cli.initWorker), chunk by chunk.
+    At most window chunks are in flight, so the results waiting to be written stay bounded.
+
+    Same output as convertFile without resolve. Returns the number of categorized and uncategorized rows written,
+    the combined stage timings of the chunks (None while timing is disabled in the workers) and the cProfile
+    statistics files of the workers that converted chunks (with profile).
+    """
+    reports = []
+    parts = set()
+
+    # Only a checkpoint of a chunked conversion has the offset to continue at
+    checkpoint = Checkpoint(filename, outputfile, accounts)
+    state = checkpoint.state if checkpoint.state and 'offset' in checkpoint.state else None
+    if state is None:
+        state = {'records': 0, 'written': 0, 'unknown': 0, 'files': {}, 'uncategorized': False, 'offset': None}
+    else:
+        logger.info('Continuing ' + str(filename) + ' at row ' + str(state['records'] + 2)
+                    + ', where the last conversion stopped.')
+    written = state['written']
+    unknown = state['unknown']
+    # csv records in the chunks that are written, and where the next chunk starts
+    records = state['records']
+    offset = state['offset']
+
+    chunks = iter(splitFile(filename, chunk_bytes, offset))
+    pending = deque()
+
+    def submit():
+        for start, end in chunks:
+            pending.append((executor.submit(classifyChunk, filename, start, end, profile), end))
+            return
+
+    with ExitStack() as stack:
+        outputwriter = openOutput(stack, outputfile, accounts, flush_thread, state['files'])
+        uncategorizedwriter = None
+        if state['uncategorized'] and uncategorized is not None:
+            uncategorizedwriter = openOutput(stack, uncategorized, accounts, flush_thread, state['files'])
+
+        try:
+            for _ in range(window):
+                submit()
+
+            while pending:
+                future, end = pending.popleft()
+                count, warnings, numbers, found, rows, rowaccounts, report, part = future.result()
+                submit()
+
+                for number, text in warnings:
+                    if not (skip and records + number - 2 in skip):
+                        logger.warning('Row ' + str(records + number) + text)
+                if report is not None:
+                    reports.append(report)
+                if part is not None:
+                    parts.add(part)
+
+                # Rows of the chunk that were not converted before
+                indexes = range(len(rows))
+                if skip:
+                    indexes = [index for index in indexes if records + numbers[index] - 2 not in skip]
+                records = records + count
+
+                known = [index for index in indexes if found[index]]
+                outputwriter.writerows([rows[index] for index in known], [rowaccounts[index] for index in known])
+                written = written + len(known)
+
+                if uncategorized is not None and len(known) < len(indexes):
+                    if uncategorizedwriter is None:
+                        uncategorizedwriter = openOutput(stack, uncategorized, accounts, flush_thread)
+                    missing = [index for index in indexes if not found[index]]
+                    uncategorizedwriter.writerows([rows[index] for index in missing],
+                                                  [rowaccounts[index] for index in missing])
+                    unknown = unknown + len(missing)
+
+                offset = end
+                if checkpoint.due():
+                    files = outputwriter.sizes()
+                    if uncategorizedwriter is not None:
+                        files.update(uncategorizedwriter.sizes())
+                    checkpoint.save(records, written, unknown, files, uncategorizedwriter is not None, offset)
+        finally:
+            # After an error, do not leave the workers busy with chunks nobody is waiting for
+            for future, end in pending:
+                future.cancel()
+
+    files = outputwriter.parts()
+    if uncategorizedwriter is not None:
+        files = files + uncategorizedwriter.parts()
+    finishParts(files)
+    checkpoint.remove()
+
+    report = instrument.mergeReports(reports) if reports else None
+    return written, unknown, report, parts
@@ -0,0 +1,476 @@
+# ! python3
+
+""" Headless batch converter, converts all ING exports in a directory without a display.
+
+        python cli.py convert <input directory> <output directory> [--workers N] [--database database.json]
+                                                                       [--incremental] [--cache]
+                                                                       [--timings [report.json]] [--profile file]
+                                                                       [--accounts [--flush-thread]]
+                                                                       [--split-size MB] [--count-hits]
+        python cli.py merge <input directory> <output file> [--database database.json] [--uncategorized file]
+        python cli.py watch <input directory> <output directory> [--database database.json] [--settle seconds]
+        python cli.py migrate [database.json] [database.sqlite]
+        python cli.py import <file> [<file> ...] [--database database.json] [--dry-run] [--conflicts file]
+        python cli.py rules [--database database.json] [--top N] [--min-age days]
+        python cli.py prune [--database database.json] [--min-age days] [--dry-run] [--backup file]
+
+Files are converted in parallel in a pool of worker processes, very large files are split into chunks that the
+workers convert in parallel (see chunks.py). Transactions without a category are written to
+<output directory>/uncategorized/<file> instead of opening a dialog.
+"""
+
+import argparse
+import datetime
+import logging
+import os
+import signal
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import instrument
+from chunks import SPLIT_BYTES, chunkSize, convertChunked
+from convert import convertFile
+from merge import mergeFiles
+from main import Database
+from manifest import Manifest
+from rules import (FIELDS, ImportReport, countedEntries, coveredEntries, invalidEntries, label, pruneEntries,
+                   readRules, saveConflicts, saveRules)
+from storage import migrate
+
+logger = logging.getLogger(__name__)
+
+
+def scanFiles(input_path):
+    # All ING exports in the input directory, in a stable order
+    files = []
+    for file in sorted(os.scandir(input_path), key=lambda entry: entry.name):
+        filename = Path(file)
+        if filename.name.startswith('.') or not file.is_file():
+            continue
+        if not filename.name.endswith(".csv"):
+            logger.warning(str(filename) + ' is not a CSV file.. Skipped.')
+            continue
+        files.append(str(filename))
+    return files
+
+
+def initWorker(database, level, cache=False, timings=False, hits=False):
+    # Runs once per worker process, the Database index stays warm for every file the process converts
+    logging.basicConfig(level=level, format='%(processName)s %(levelname)s: %(message)s', force=True)
+    Database.filename = database
+    if cache:
+        # The on-disk cache is a SQLite file, so all workers can share it
+        Database().enableDiskCache()
+    if hits:
+        # SQLite too, every worker adds its counts
+        Database().enableHitCounts()
+    if timings:
+        instrument.enable()
+
+
+def convertOne(filename, output_path, skip=None, profile=None, name=None, accounts=False, flush_thread=False):
+    name = name or Path(filename).name
+    outputfile = os.path.join(output_path, name)
+    uncategorized = os.path.join(output_path, 'uncategorized', name)
+
+    part = instrument.profilePart(profile)
+    with instrument.profile(part):
+        written, unknown = convertFile(filename, outputfile, uncategorized=uncategorized, skip=skip,
+                                       accounts=accounts, flush_thread=flush_thread)
+
+    # Stage timings of this file, when enabled
+    report = instrument.collect()
+    return filename, written, unknown, Database.cache.statistics(), report, part
+
+
+def convertDirectory(input_path, output_path, workers=None, database='database.json', verbose=False,
+                     incremental=False, cache=False, timings=None, profile=None, accounts=False, flush_thread=False,
+                     split_size=SPLIT_BYTES, hits=False):
+    """ Convert every .csv file in input_path into output_path. Returns the number of files that failed.
+
+    In incremental mode files that were converted before are skipped, and only new transactions are written.
+    The overlap between files is worked out here, one file after the other, before the files are converted in parallel.
+
+    With timings (a report file name) the stages of every file are timed and summarized (see instrument.py),
+    with profile the workers run cProfile and their statistics are merged into that file.
+    With accounts every account in a file gets its own output file, see shards.py.
+    Files larger than split_size bytes are split into chunks that all workers convert (0 to never split).
+    With hits the workers add up how often every rule matched, see hits.py.
+    """
+    if timings is not None:
+        instrument.enable()
+    files = scanFiles(input_path)
+    logger.info('Found ' + str(len(files)) + ' files to process..')
+
+    manifest = None
+    plans = {}
+    if incremental:
+        manifest = Manifest(output_path)
+        for filename in list(files):
+            plan = manifest.prepare(filename)
+            if plan is None:
+                logger.info(filename + ' has been converted before.. Skipped.')
+                files.remove(filename)
+            else:
+                plans[filename] = plan
+
+    os.makedirs(os.path.join(output_path, 'uncategorized'), exist_ok=True)
+    database = os.path.abspath(database)
+    # Per-row messages from the workers are only shown in verbose mode
+    level = logging.DEBUG if verbose else logging.WARNING
+    failed = 0
+
+    if profile is not None:
+        profile = os.path.abspath(profile)
+    parts = set()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker,
+                             initargs=(database, level, cache, timings is not None, hits)) as executor:
+        futures = {}
+        large = []
+        for filename in files:
+            if split_size and os.path.getsize(filename) > split_size:
+                large.append(filename)
+                continue
+            skip = plans[filename].skip if filename in plans else None
+            futures[executor.submit(convertOne, filename, output_path, skip, profile, None, accounts,
+                                    flush_thread)] = filename
+
+        # The chunks of large files are queued behind the other files, their results are written here in order
+        count = workers or os.cpu_count() or 1
+        for filename in large:
+            name = Path(filename).name
+            skip = plans[filename].skip if filename in plans else None
+            try:
+                written, unknown, report, chunkparts = convertChunked(
+                    executor, filename, os.path.join(output_path, name),
+                    os.path.join(output_path, 'uncategorized', name), skip, accounts, flush_thread,
+                    chunkSize(filename, count), count * 2, profile)
+            except Exception:
+                failed = failed + 1
+                logger.exception('Failed to convert ' + filename)
+                continue
+
+            logger.info('Processed file completly. ' + filename + ': ' + str(written) + ' rows written, '
+                        + str(unknown) + ' uncategorized, in chunks.')
+            parts.update(chunkparts)
+            if report is not None:
+                logger.info(instrument.finishFile(filename, report))
+
+            if manifest is not None:
+                manifest.commit(filename, plans[filename], written + unknown)
+                manifest.save()
+
+        for future in as_completed(futures):
+            try:
+                filename, written, unknown, statistics, report, part = future.result()
+            except Exception:
+                failed = failed + 1
+                logger.exception('Failed to convert ' + futures[future])
+            else:
+                logger.info('Processed file completly. ' + filename + ': ' + str(written) + ' rows written, '
+                            + str(unknown) + ' uncategorized.')
+                logger.info(statistics)
+                if part is not None:
+                    parts.add(part)
+                if report is not None:
+                    logger.info(instrument.finishFile(filename, report))
+
+                if manifest is not None:
+                    manifest.commit(filename, plans[filename], written + unknown)
+                    manifest.save()
+
+    if timings is not None:
+        instrument.saveReport(timings)
+        logger.info('Timings saved to ' + timings)
+    if profile is not None:
+        instrument.mergeProfiles(profile, sorted(parts))
+        logger.info('Profile saved to ' + profile + ', view it with: python -m pstats ' + profile)
+
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert ING exports to YNAB without the GUI.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every processed transaction')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    convert = commands.add_parser('convert', help='convert all ING .csv files in a directory')
+    convert.add_argument('input', help='directory with ING .csv exports')
+    convert.add_argument('output', help='directory to write the YNAB files to')
+    convert.add_argument('-w', '--workers', type=int, default=None,
+                         help='number of worker processes (default: number of cores)')
+    convert.add_argument('-i', '--incremental', action='store_true',
+                         help='skip files and transactions that were converted before')
+    convert.add_argument('-c', '--cache', action='store_true',
+                         help='keep classification results in a cache file next to the database between runs')
+    convert.add_argument('-d', '--database', default='database.json',
+                         help='category database, database.json or a migrated .sqlite file')
+    convert.add_argument('-a', '--accounts', action='store_true',
+                         help='write a separate file per account (Rekening), <file>-<account>.csv')
+    convert.add_argument('--flush-thread', action='store_true',
+                         help='with --accounts, write the account files on a background thread')
+    convert.add_argument('-t', '--timings', nargs='?', const='conversion-timings.json', default=None,
+                         help='time every conversion stage and save a JSON report (default: conversion-timings.json)')
+    convert.add_argument('-p', '--profile', default=None, help='run cProfile and save the statistics to this file')
+    convert.add_argument('--split-size', type=float, default=SPLIT_BYTES / (1 << 20),
+                         help='split files larger than this many MB into chunks that all workers convert '
+                              '(default: %(default)g, 0 to never split)')
+    convert.add_argument('--count-hits', action='store_true',
+                         help='add up how often every rule matches in a file next to the database, see rules')
+
+    merging = commands.add_parser('merge', help='convert all exports in a directory into one date-sorted file '
+                                                'without duplicates')
+    merging.add_argument('input', help='directory with (overlapping) ING .csv exports')
+    merging.add_argument('output', help='YNAB file to write')
+    merging.add_argument('-d', '--database', default='database.json',
+                         help='category database, database.json or a migrated .sqlite file')
+    merging.add_argument('-c', '--cache', action='store_true',
+                         help='keep classification results in a cache file next to the database between runs')
+    merging.add_argument('-u', '--uncategorized', default=None,
+                         help='file for transactions without a category (default: <output>-uncategorized.csv)')
+    merging.add_argument('--run-rows', type=int, default=50000,
+                         help='transactions sorted in memory at a time, larger runs go to temporary files')
+    merging.add_argument('--temp', default=None, help='directory for the temporary files')
+    merging.add_argument('--count-hits', action='store_true',
+                         help='add up how often every rule matches in a file next to the database, see rules')
+
+    watching = commands.add_parser('watch', help='keep running and convert new or changed exports as they arrive')
+    watching.add_argument('input', help='directory to watch for ING .csv exports')
+    watching.add_argument('output', help='directory to write the YNAB files to')
+    watching.add_argument('-d', '--database', default='database.json',
+                          help='category database, database.json or a migrated .sqlite file')
+    watching.add_argument('-c', '--cache', action='store_true',
+                          help='keep classification results in a cache file next to the database between runs')
+    watching.add_argument('-s', '--settle', type=float, default=2.0,
+                          help='seconds a file must stay unchanged before it is converted (default: 2)')
+    watching.add_argument('--interval', type=float, default=1.0, help='seconds between checks (default: 1)')
+    watching.add_argument('-a', '--accounts', action='store_true',
+                          help='write a separate file per account (Rekening), <file>-<account>.csv')
+    watching.add_argument('--polling', action='store_true', help='poll the directory instead of using inotify')
+    watching.add_argument('-t', '--timings', nargs='?', const='conversion-timings.json', default=None,
+                          help='time every conversion stage and save a JSON report when the watcher stops')
+    watching.add_argument('--count-hits', action='store_true',
+                          help='add up how often every rule matches in a file next to the database, see rules')
+
+    migration = commands.add_parser('migrate', help='copy database.json (and its journal) into a SQLite database')
+    migration.add_argument('source', nargs='?', default='database.json')
+    migration.add_argument('target', nargs='?', default='database.sqlite')
+
+    importing = commands.add_parser('import', help='add the rules of CSV files, YNAB register exports or other '
+                                                   'databases to the category database')
+    importing.add_argument('files', nargs='+', help='rule CSVs, YNAB register exports or database files')
+    importing.add_argument('-d', '--database', default='database.json',
+                           help='category database, database.json or a migrated .sqlite file')
+    importing.add_argument('-n', '--dry-run', action='store_true',
+                           help='only report what would be added, leave the database as it is')
+    importing.add_argument('--conflicts', default=None,
+                           help='write the entries that are already in another category to this CSV')
+
+    report = commands.add_parser('rules', help='report the most used rules, rules that never match and rules that '
+                                               'can never decide the category')
+    report.add_argument('-d', '--database', default='database.json',
+                        help='category database, database.json or a migrated .sqlite file')
+    report.add_argument('--top', type=int, default=20, help='number of most used rules to list (default: 20)')
+    report.add_argument('--min-age', type=int, default=365,
+                        help='days a rule must have been counted without a hit to be dead (default: 365)')
+
+    pruning = commands.add_parser('prune', help='remove dead rules and rules that can never decide the category')
+    pruning.add_argument('-d', '--database', default='database.json',
+                         help='category database, database.json or a migrated .sqlite file')
+    pruning.add_argument('--min-age', type=int, default=365,
+                         help='days a rule must have been counted without a hit to be dead (default: 365)')
+    pruning.add_argument('-n', '--dry-run', action='store_true',
+                         help='only report what would be removed, leave the database as it is')
+    pruning.add_argument('--backup', default=None,
+                         help='rule CSV to append the removed rules to, for cli.py import '
+                              '(default: <database>-pruned.csv)')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    if args.command == 'convert':
+        if not os.path.exists(args.database):
+            parser.error('category database ' + args.database + ' not found')
+        failed = convertDirectory(args.input, args.output, workers=args.workers, database=args.database,
+                                  verbose=args.verbose, incremental=args.incremental, cache=args.cache,
+                                  timings=args.timings, profile=args.profile, accounts=args.accounts,
+                                  flush_thread=args.flush_thread, split_size=int(args.split_size * (1 << 20)),
+                                  hits=args.count_hits)
+        return 1 if failed else 0
+
+    if args.command == 'merge':
+        if not os.path.exists(args.database):
+            parser.error('category database ' + args.database + ' not found')
+        return merge(args)
+
+    if args.command == 'watch':
+        if not os.path.exists(args.database):
+            parser.error('category database ' + args.database + ' not found')
+        return watch(args)
+
+    if args.command == 'migrate':
+        categories = migrate(args.source, args.target)
+        logger.info('Migrated ' + str(categories) + ' categories from ' + args.source + ' to ' + args.target + '.')
+        return 0
+
+    if args.command == 'import':
+        if not os.path.exists(args.database):
+            parser.error('category database ' + args.database + ' not found')
+        return importRules(args)
+
+    if args.command in ('rules', 'prune'):
+        if not os.path.exists(args.database):
+            parser.error('category database ' + args.database + ' not found')
+        return reportRules(args) if args.command == 'rules' else pruneRules(args)
+
+
+def merge(args):
+    Database.filename = args.database
+    if args.cache:
+        Database().enableDiskCache()
+    if args.count_hits:
+        Database().enableHitCounts()
+    if not args.verbose:
+        logging.getLogger('convert').setLevel(logging.WARNING)
+
+    files = scanFiles(args.input)
+    logger.info('Found ' + str(len(files)) + ' files to merge..')
+    uncategorized = args.uncategorized or os.path.splitext(args.output)[0] + '-uncategorized.csv'
+
+    written, unknown, duplicates = mergeFiles(files, args.output, uncategorized=uncategorized,
+                                              run_rows=args.run_rows, directory=args.temp)
+    logger.info('Merged into ' + args.output + ': ' + str(written) + ' rows written, ' + str(unknown)
+                + ' uncategorized, ' + str(duplicates) + ' duplicates left out.')
+    logger.info(Database.cache.statistics())
+    Database.cache.close()
+    return 0
+
+
+def importRules(args):
+    Database.filename = args.database
+
+    # Conflicts within the imported files (a payee with several categories in a register) come first
+    found = ImportReport()
+    rules = []
+    for filename in args.files:
+        rules.extend(readRules(filename, found))
+    logger.info('Read ' + str(len(rules)) + ' rules from ' + str(len(args.files)) + ' file(s).')
+
+    report = Database().addRules(rules, dry_run=args.dry_run)
+    report.conflicts = found.conflicts + report.conflicts
+
+    logger.info(('Dry run: ' if args.dry_run else 'Imported into ' + args.database + ': ') + report.summary())
+    for field, entry, kept, imported in report.conflicts[:10]:
+        logger.warning(field + ' ' + entry + ' stays in ' + kept + ', not added to ' + imported + '.')
+    for rule, reason in report.invalid[:10]:
+        logger.warning('Left out ' + str(rule) + ': ' + reason)
+    if args.conflicts and report.conflicts:
+        saveConflicts(args.conflicts, report)
+        logger.info(str(len(report.conflicts)) + ' conflicts saved to ' + args.conflicts)
+    return 0
+
+
+def minimumAge(args):
+    # Rules counted since this date (ISO) without a hit are dead
+    return (datetime.date.today() - datetime.timedelta(days=args.min_age)).isoformat()
+
+
+def reportRules(args):
+    Database.filename = args.database
+    Database().enableHitCounts()
+    data = Database().openDatabase()
+    counts = Database.hits.load()
+    before = minimumAge(args)
+
+    counted = countedEntries(data, counts)
+    if not counted:
+        logger.info('No hits counted yet, convert with --count-hits first.')
+
+    hot = sorted((item for item in counted if item[0]), key=lambda item: -item[0])
+    for hits, since, last, position, field, entry in hot[:args.top]:
+        x = data['categories'][position]
+        logger.info(str(hits) + ' hits: ' + field[:-1] + ' ' + repr(entry) + ' of '
+                    + label(x['Master Category'], x['Category']) + ', counted since ' + since + '.')
+
+    dead = [item for item in counted if not item[0]]
+    old = [item for item in dead if item[1] <= before]
+    logger.info(str(len(old)) + ' rules never matched since ' + before + ', ' + str(len(dead) - len(old))
+                + ' more were counted for less than ' + str(args.min_age) + ' days.')
+    for hits, since, last, position, field, entry in old:
+        x = data['categories'][position]
+        logger.info('Never matched: ' + field[:-1] + ' ' + repr(entry) + ' of '
+                    + label(x['Master Category'], x['Category']) + ', counted since ' + since + '.')
+
+    for field, key in FIELDS:
+        for position, entry, other, covering in coveredEntries(data, field):
+            x = data['categories'][position]
+            y = data['categories'][other]
+            logger.info('Never decides: ' + key + ' ' + repr(entry) + ' of ' + label(x['Master Category'], x['Category'])
+                        + ', ' + repr(covering) + ' of ' + label(y['Master Category'], y['Category'])
+                        + ' matches first.')
+
+    for position, field, entry, reason in invalidEntries(data):
+        x = data['categories'][position]
+        logger.info('Not used: ' + field[:-1] + ' ' + repr(entry) + ' of ' + label(x['Master Category'], x['Category'])
+                    + ', ' + reason + '.')
+    return 0
+
+
+def pruneRules(args):
+    Database.filename = args.database
+    Database().enableHitCounts()
+    data = Database().openDatabase()
+
+    prune = pruneEntries(data, Database.hits.load(), minimumAge(args))
+    for position, field, entry, reason in prune:
+        x = data['categories'][position]
+        logger.info(('Would remove ' if args.dry_run else 'Removing ') + field[:-1] + ' ' + repr(entry) + ' of '
+                    + label(x['Master Category'], x['Category']) + ': ' + reason + '.')
+    if args.dry_run or not prune:
+        logger.info(('Dry run: ' if args.dry_run else '') + str(len(prune)) + ' rules to remove.')
+        return 0
+
+    # The removed rules can be imported again
+    backup = args.backup or os.path.splitext(args.database)[0] + '-pruned.csv'
+    saveRules(backup, data, prune)
+    Database().removeEntries([item[:3] for item in prune])
+    Database().saveDatabase()
+    Database.hits.forget([(field, label(data['categories'][position]['Master Category'],
+                                        data['categories'][position]['Category']), entry)
+                          for position, field, entry, reason in prune])
+    logger.info('Removed ' + str(len(prune)) + ' rules from ' + args.database + ', saved to ' + backup + '.')
+    return 0
+
+
+def watch(args):
+    # Imported here, watch.py imports convertOne from this module
+    from watch import watchDirectory
+
+    # Per-row messages are only shown in verbose mode, like the workers of convert
+    if not args.verbose:
+        logging.getLogger('convert').setLevel(logging.WARNING)
+    if args.timings is not None:
+        instrument.enable()
+
+    # Stop between two files on Ctrl+C or kill
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    try:
+        watchDirectory(args.input, args.output, database=args.database, cache=args.cache, settle=args.settle,
+                       interval=args.interval, polling=args.polling, stop=stop, accounts=args.accounts,
+                       hits=args.count_hits)
+    except KeyboardInterrupt:
+        pass
+
+    if args.timings is not None:
+        instrument.saveReport(args.timings)
+        logger.info('Timings saved to ' + args.timings)
+    logger.info('Stopped watching.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,363 @@
+""" Streaming conversion of ING exports into YNAB import files
+
+Rows flow through a chain of generators (reader -> transactions -> classify -> writer) in small batches
+(see batch.py), so memory use stays flat no matter how large the export is.
+"""
+
+import csv
+import itertools
+import logging
+import os
+from contextlib import ExitStack, closing
+
+import instrument
+from batch import BATCH_ROWS, TransactionBatch
+from checkpoint import Checkpoint, finishParts, partName
+from main import Database, MalformedRow, Transaction, formatAmount
+from shards import ShardedWriter
+
+logger = logging.getLogger(__name__)
+
+# Date,Payee,Category,Memo,Outflow,Inflow
+HEADER = ["Date", "Payee", "Category", "Memo", "Outflow", "Inflow"]
+
+
+class ConversionCancelled(Exception):
+    """ Raised when the user stops processing in the middle of a file """
+
+
+def countRows(filename):
+    # Cheap pre-scan, counts line endings in binary blocks instead of parsing the csv.
+    # Newlines inside quoted memos are counted too, so the result is an estimate for progress reporting.
+    lines = 0
+    last = b'\n'
+    with open(filename, 'rb') as inputfile:
+        for block in iter(lambda: inputfile.read(1 << 20), b''):
+            lines = lines + block.count(b'\n')
+            last = block[-1:]
+
+    if last != b'\n':
+        lines = lines + 1
+
+    # Header row
+    return max(lines - 1, 0)
+
+
+def readRows(filename):
+    # Yield the rows of an ING export one by one, skipping the header
+    with open(filename, newline='') as inputfile:
+        csvreader = csv.reader(inputfile)
+        next(csvreader, None)
+        for row in csvreader:
+            yield row
+
+
+def reportProgress(rows, progress, start=0):
+    # Pass rows through unchanged, reporting how many rows are done once the next one is requested.
+    # start rows were done before, by a conversion that is continued
+    for count, row in enumerate(rows, start + 1):
+        yield row
+        progress(count)
+
+
+def checkCancel(rows, cancel):
+    # Stop cleanly between two rows once the cancel event is set
+    for row in rows:
+        if cancel.is_set():
+            raise ConversionCancelled()
+        yield row
+
+
+def warnRow(number, text, warnings=None):
+    # Warning about a row. Chunk workers collect them in warnings, their row numbers are only known later
+    if warnings is None:
+        logger.warning('Row ' + str(number) + text)
+    else:
+        warnings.append((number, text))
+
+
+def numberedRows(rows, skip=None, warnings=None, first=0):
+    # Datum,Naam / Omschrijving,Rekening,Tegenrekening,Code,Af Bij,Bedrag (EUR),MutatieSoort,Mededelingen
+    # (row number, row) of the rows to convert, rows that are too short are skipped with a warning.
+    # skip holds the indexes of data rows that were converted before (see manifest.py),
+    # first is the number of data rows before rows (see checkpoint.py)
+    for number, row in enumerate(rows, 2 + first):
+        if skip and number - 2 in skip:
+            continue
+
+        if len(row) < 9:
+            warnRow(number, ' has ' + str(len(row)) + ' columns instead of 9.. Skipped.', warnings)
+            continue
+
+        yield number, row
+
+
+def parseTransactions(rows, skip=None):
+    # One Transaction per row, rows with an invalid date or amount are skipped with a warning
+    for number, row in numberedRows(rows, skip):
+        try:
+            # date, payee, memo, type, amount, account
+            transaction = Transaction(row[0], row[1], str(row[8]), str(row[5]), str(row[6]), row[2])
+        except MalformedRow as error:
+            warnRow(number, ': ' + str(error) + '.. Skipped.')
+            continue
+
+        yield transaction
+
+
+def parseBatches(rows, skip=None, size=BATCH_ROWS, warnings=None, first=0):
+    # The same transactions as parseTransactions, in TransactionBatches of at most size transactions
+    shared = None
+    batch = TransactionBatch()
+    for number, row in numberedRows(rows, skip, warnings, first):
+        try:
+            batch.append(row[0], row[1], row[8], row[5], row[6], row[2], number)
+        except MalformedRow as error:
+            warnRow(number, ': ' + str(error) + '.. Skipped.', warnings)
+            continue
+
+        if len(batch) >= size:
+            yield batch
+            # Payees and accounts that repeat in the next batches share their strings
+            shared = batch.shared
+            batch = TransactionBatch(shared)
+
+    if len(batch):
+        yield batch
+
+
+def resolveCategory(transaction, category, resolve):
+    # Final category of a transaction that was classified together with its batch. Unknown transactions are passed
+    # to resolve, which returns a category, 'Skipped' or 'Cancelled' (see AddCategoryDialog). None when skipped.
+    if not category:
+        # A rule added for an earlier transaction may match this one by now. The row was counted by classifyBatches
+        category = transaction.classify(count=False)
+
+    if not category:
+        result = resolve(transaction)
+
+        if result == 'Cancelled':
+            raise ConversionCancelled()
+        elif result == 'Skipped':
+            logger.info('Transaction skipped.')
+            return None
+        else:
+            logger.info('Category or payee added.')
+            category = result
+
+    # Categorized transactions improve the suggestions for the next unknown ones
+    Database().learn(transaction, category)
+    return category
+
+
+def classifyBatches(batches, resolve=None):
+    # Use payee or memo to search for the category, yields (batch, categories). Without resolve, the category of
+    # unknown transactions is '', a transaction the user skipped has category None
+    for batch in batches:
+        categories = batch.classify()
+
+        for index, category in enumerate(categories):
+            if resolve is not None:
+                try:
+                    category = categories[index] = resolveCategory(batch[index], category, resolve)
+                except ConversionCancelled:
+                    # The transactions before this one are done, they are written before processing stops
+                    yield batch, categories[:index]
+                    raise
+
+            if category:
+                logger.info('Category found.' + 'Payee: ' + batch.payees[index] + ' Category: ' + category,
+                            extra={'summary': 'Category found.'})
+
+        yield batch, categories
+
+
+class UnknownPayee:
+    """ The unknown transactions of one payee, they all need just one decision """
+
+    def __init__(self, transaction):
+        self.payee = transaction.payee
+        # First transaction of this payee, shown during the review
+        self.transaction = transaction
+        self.count = 0
+
+
+def resumedRows(filename, outputfile, accounts=False):
+    # Rows of the export that an earlier, stopped conversion into outputfile already did
+    state = Checkpoint(filename, outputfile, accounts).state
+    return state['records'] if state is not None else 0
+
+
+def collectUnknowns(filenames, skips=None, cancel=None, outputs=None, accounts=False):
+    # First pass of a two-pass conversion: classify every row without asking anything and group
+    # the transactions without a category by payee, in the order they were found. outputs maps an export to its
+    # output file, the rows before its checkpoint are converted already and left out like in convertFile
+    unknowns = {}
+    for filename in filenames:
+        skip = skips.get(filename) if skips else None
+        done = resumedRows(filename, outputs[filename], accounts) if outputs else 0
+        with closing(readRows(filename)) as rows:
+            pipeline = itertools.islice(rows, done, None)
+            if cancel is not None:
+                pipeline = checkCancel(pipeline, cancel)
+            for batch in parseBatches(pipeline, skip, first=done):
+                # The rule hits are counted when the rows are converted
+                for index, category in enumerate(batch.classify(count=False)):
+                    transaction = batch[index]
+                    if category:
+                        Database().learn(transaction, category)
+                    else:
+                        group = unknowns.get(transaction.payee)
+                        if group is None:
+                            group = unknowns[transaction.payee] = UnknownPayee(transaction)
+                        group.count = group.count + 1
+
+    return unknowns
+
+
+def outputRow(transaction, category):
+    # 07/25/10,Sample Payee,,Sample Memo for an outflow,100.00,
+    # 07/26/10,Sample Payee 2,,Sample memo for an inflow,,500.00
+    amount = formatAmount(transaction.amount)
+    if transaction.type == 'Af':
+        return [transaction.date, transaction.payee, category, transaction.memo, amount, '']
+    else:
+        return [transaction.date, transaction.payee, category, transaction.memo, '', amount]
+
+
+def openWriter(file):
+    # csv writer for an open output file
+    return csv.writer(file)
+
+
+class SingleFile:
+    """ Same interface as ShardedWriter, for output that is not split per account """
+
+    def __init__(self, file, writer):
+        self.file = file
+        self.writer = writer
+
+    def writerow(self, row, account):
+        self.writer.writerow(row)
+
+    def writerows(self, rows, accounts):
+        self.writer.writerows(rows)
+
+    def sizes(self):
+        self.file.flush()
+        return {self.file.name: os.fstat(self.file.fileno()).st_size}
+
+    def parts(self):
+        return [self.file.name]
+
+
+def openOutput(stack, filename, accounts=False, flush_thread=False, sizes=None):
+    # Writer for one output file, or one file per account, as .part files that are closed together with the stack.
+    # sizes has the .part files of a stopped conversion that is continued (see checkpoint.py)
+    if accounts:
+        return stack.enter_context(ShardedWriter(filename, HEADER, background=flush_thread, sizes=sizes))
+
+    part = partName(filename)
+    if sizes and part in sizes:
+        os.truncate(part, sizes[part])
+        file = stack.enter_context(open(part, 'a', newline=''))
+        return SingleFile(file, openWriter(file))
+
+    file = stack.enter_context(open(part, 'w', newline=''))
+    writer = openWriter(file)
+    writer.writerow(HEADER)
+    return SingleFile(file, writer)
+
+
+def convertFile(filename, outputfile, resolve=None, progress=None, uncategorized=None, cancel=None, skip=None,
+                accounts=False, flush_thread=False):
+    """ Convert one ING export into a YNAB file, batch by batch. Both files are closed when this returns,
+    also when the conversion is cancelled, either by resolve or by setting the cancel event (checked between rows).
+
+    Without resolve, transactions that have no category are written to the uncategorized file (if given)
+    with an empty category, instead of asking the user. Rows whose index is in skip are left out.
+    With accounts, every account gets its own output file, named after outputfile (see shards.py),
+    flush_thread writes those files on a background thread.
+
+    The files get their final names once the whole export is converted. A cancelled or failed conversion leaves
+    a checkpoint, the next conversion of the export into outputfile continues from there (see checkpoint.py).
+    Returns the number of categorized and uncategorized rows written.
+    """
+    checkpoint = Checkpoint(filename, outputfile, accounts)
+    state = checkpoint.state or {'records': 0, 'written': 0, 'unknown': 0, 'files': {}, 'uncategorized': False}
+    # Rows of the export that are done
+    done = state['records']
+    written = state['written']
+    unknown = state['unknown']
+    if checkpoint.state is not None:
+        logger.info('Continuing ' + str(filename) + ' at row ' + str(done + 2) + ', where the last conversion stopped.')
+
+    with ExitStack() as stack:
+        rows = stack.enter_context(closing(readRows(filename)))
+        outputwriter = openOutput(stack, outputfile, accounts, flush_thread, state['files'])
+        uncategorizedwriter = None
+        if state['uncategorized'] and uncategorized is not None:
+            uncategorizedwriter = openOutput(stack, uncategorized, accounts, flush_thread, state['files'])
+
+        def save():
+            files = outputwriter.sizes()
+            if uncategorizedwriter is not None:
+                files.update(uncategorizedwriter.sizes())
+            checkpoint.save(done, written, unknown, files, uncategorizedwriter is not None)
+
+        pipeline = itertools.islice(rows, done, None)
+        if progress is not None:
+            pipeline = reportProgress(pipeline, progress, done)
+
+        if cancel is not None:
+            pipeline = checkCancel(pipeline, cancel)
+
+        batches = classifyBatches(parseBatches(pipeline, skip, first=done), resolve)
+        if instrument.enabled():
+            batches = instrument.timedBatches(batches)
+
+        try:
+            for batch, categories in batches:
+                known = []
+                unknowns = []
+                for index, category in enumerate(categories):
+                    if category:
+                        known.append(index)
+                        logger.info('Transaction processed.' + 'Payee: ' + batch.payees[index] + ' Category: '
+                                    + category, extra={'summary': 'Transaction processed.'})
+                    elif category is not None and uncategorized is not None:
+                        unknowns.append(index)
+                        logger.info('Category not found.' + 'Payee: ' + batch.payees[index],
+                                    extra={'summary': 'Category not found.'})
+
+                outputwriter.writerows([batch.outputRow(index, categories[index]) for index in known],
+                                       [batch.accounts[index] for index in known])
+                written = written + len(known)
+
+                if unknowns:
+                    # Only created once the first unknown transaction shows up
+                    if uncategorizedwriter is None:
+                        uncategorizedwriter = openOutput(stack, uncategorized, accounts, flush_thread)
+
+                    uncategorizedwriter.writerows([batch.outputRow(index, '') for index in unknowns],
+                                                  [batch.accounts[index] for index in unknowns])
+                    unknown = unknown + len(unknowns)
+
+                if categories:
+                    done = batch.numbers[len(categories) - 1] - 1
+                if checkpoint.due():
+                    save()
+        except ConversionCancelled:
+            save()
+            raise
+
+    parts = outputwriter.parts()
+    if uncategorizedwriter is not None:
+        parts = parts + uncategorizedwriter.parts()
+    finishParts(parts)
+    checkpoint.remove()
+
+    # New classification results and rule hits go to their files once per file
+    Database().saveResults()
+
+    return written, unknown
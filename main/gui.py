@@ -1,8 +1,10 @@
+import collections
 import logging
-import csv
 import os
 import queue
 import signal
+import threading
+import time
 from pathlib import Path
 
 from tkinter import *
@@ -13,6 +15,12 @@ from tkinter.scrolledtext import ScrolledText
 import tkinter as tk
 
 from main import *
+import instrument
+from convert import ConversionCancelled, collectUnknowns, convertFile, countRows
+from merge import mergeFiles
+from manifest import Manifest
+from matcher import checkEntry, escape
+from prefix import PrefixIndex
 
 logger = logging.getLogger(__name__)
 
@@ -61,6 +69,11 @@ class Application:
         second_tab = ttk.PanedWindow(self.root, orient=VERTICAL)
         second_tab.grid(row=0, column=0, sticky="nsew")
 
+        manage_frame = ttk.Labelframe(second_tab, text="Payees and Memos")
+        manage_frame.columnconfigure(4, weight=1)
+        manage_frame.rowconfigure(1, weight=1)
+        second_tab.add(manage_frame)
+
         notebook.add(first_tab, text='Convert Transactions', underline=0, padding=2)
         notebook.add(second_tab, text='Manage Payees/Categories', underline=0, padding=2)
 
@@ -68,11 +81,38 @@ class Application:
         self.main = MainUi(main_frame)
         self.settings = SettingsUi(settings_frame, self, self.root)
         self.console = ConsoleUi(console_frame)
+        self.manage = ManageUi(manage_frame)
+
+        # The database is only loaded into the manage tab when it is shown
+        self.notebook = notebook
+        self.second_tab = second_tab
+        notebook.bind('<<NotebookTabChanged>>', self.tab_changed)
 
         signal.signal(signal.SIGINT, self.quit)
 
+    def tab_changed(self, event=None):
+        if self.notebook.select() == str(self.second_tab):
+            self.manage.refresh()
+
     def quit(self, *args):
-        self.root.destroy()
+        if self.settings.closing:
+            return
+        # Let a running conversion stop between rows, the window is closed once it has saved its checkpoint
+        self.settings.closing = True
+        self.settings.cancel_event.set()
+        try:
+            self.manage.flush()
+        except Exception:
+            logger.exception('Could not save the category database.')
+        self.close_when_stopped()
+
+    def close_when_stopped(self):
+        # The worker may be waiting for an answer, poll_worker keeps answering until the worker has stopped
+        worker = self.settings.worker
+        if worker is not None and worker.is_alive():
+            self.root.after(100, self.close_when_stopped)
+        else:
+            self.root.destroy()
 
 class MainUi:
 
@@ -124,10 +164,33 @@ class SettingsUi:
         # Input/Output paths to search for
         self.input_path = StringVar()
         self.output_path = StringVar()
+        self.batch_review = BooleanVar()
+        self.incremental = BooleanVar()
+        self.timings = BooleanVar()
+        self.accounts = BooleanVar()
+        self.merge = BooleanVar()
+        self.count_hits = BooleanVar()
+        # Progress of the conversion running on the worker thread
+        self.status = StringVar()
+        self.worker = None
+        self.cancel_event = threading.Event()
+        # Set when the window is closed, the worker is not asked anything anymore
+        self.closing = False
+        self.progress_queue = queue.Queue()
+        self.requests = queue.Queue()
+        self.rows_done = 0
+        # Rows done before this run by a conversion that is continued, not counted in rows/s
+        self.rows_resumed = None
+        self.rows_total = 0
+        self.file_started = 0
+        self.file_name = ''
         # Initialize UI
         self.initUI()
         self.add_padding()
 
+        # Start polling the worker for progress and questions for the user
+        self.frame.after(100, self.poll_worker)
+
     def initUI(self):
         # Labels
         ttk.Label(self.frame, text="Input Directory").grid(column=0, row=3, sticky=E)
@@ -144,8 +207,23 @@ class SettingsUi:
         ttk.Button(self.frame, text="Browse..", command=self.inputdirectory).grid(column=2, row=3, sticky=W)
         ttk.Button(self.frame, text="Browse..", command=self.outputdirectory).grid(column=2, row=4, sticky=W)
 
-        ttk.Button(self.frame, text="Run", command=lambda: self.scanAndConvert(self.input_path.get(), self.output_path.get())).grid(column=0, row=5, sticky=W)
+        self.run_button = ttk.Button(self.frame, text="Run", command=self.run)
+        self.run_button.grid(column=0, row=5, sticky=W)
         ttk.Button(self.frame, text="Close", command=lambda: self.parent.quit()).grid(column=1, row=5, sticky=W)
+        self.cancel_button = ttk.Button(self.frame, text="Cancel", command=self.cancel, state='disabled')
+        self.cancel_button.grid(column=2, row=5, sticky=W)
+
+        ttk.Checkbutton(self.frame, text="Review unknown transactions in one batch", variable=self.batch_review).grid(column=1, row=6, sticky=W)
+        ttk.Checkbutton(self.frame, text="Skip files and transactions that were converted before", variable=self.incremental).grid(column=1, row=7, sticky=W)
+        ttk.Checkbutton(self.frame, text="Measure the time of every conversion stage", variable=self.timings).grid(column=1, row=8, sticky=W)
+        ttk.Checkbutton(self.frame, text="Write a separate file per account", variable=self.accounts).grid(column=1, row=9, sticky=W)
+        ttk.Checkbutton(self.frame, text="Merge all files into one date-sorted file without duplicates", variable=self.merge).grid(column=1, row=10, sticky=W)
+        ttk.Checkbutton(self.frame, text="Count how often every payee and memo rule matches", variable=self.count_hits).grid(column=1, row=11, sticky=W)
+
+        # Progress
+        self.progressbar = ttk.Progressbar(self.frame, orient=HORIZONTAL, mode='determinate')
+        self.progressbar.grid(column=0, columnspan=3, row=12, sticky=(W, E))
+        ttk.Label(self.frame, textvariable=self.status).grid(column=0, columnspan=3, row=13, sticky=W)
 
     def add_padding(self):
         for child in self.frame.winfo_children():
@@ -161,12 +239,120 @@ class SettingsUi:
         if dirname:
             self.input_path.set(dirname)
 
-    # Main method to search for files and process transactions
-    def scanAndConvert(self, input_path, output_path):
+    def run(self):
+        # Convert on a worker thread, so the window and the console stay responsive
+        if self.worker is not None and self.worker.is_alive():
+            return
+
+        self.cancel_event.clear()
+        self.worker = threading.Thread(target=self.convertInBackground, daemon=True,
+                                       args=(self.input_path.get(), self.output_path.get(), self.batch_review.get(),
+                                             self.incremental.get(), self.timings.get(), self.accounts.get(),
+                                             self.merge.get(), self.count_hits.get()))
+        self.run_button.state(['disabled'])
+        self.cancel_button.state(['!disabled'])
+        self.worker.start()
+
+    def cancel(self):
+        # The worker stops cleanly before the next row
+        self.cancel_event.set()
+        self.status.set('Cancelling..')
+
+    def convertInBackground(self, input_path, output_path, batch_review, incremental, timings, accounts, merge,
+                            count_hits):
+        if timings:
+            instrument.enable()
+        if count_hits:
+            # Saved after every file, see Database.saveResults
+            Database().enableHitCounts()
+        try:
+            self.scanAndConvert(input_path, output_path, batch_review, incremental, accounts, merge)
+        except Exception:
+            logger.exception('Processing failed.')
+        finally:
+            if timings:
+                self.saveTimings(output_path)
+                instrument.disable()
+            if count_hits:
+                Database().disableHitCounts()
+            self.progress_queue.put(('done',))
+
+    def saveTimings(self, output_path):
+        # Report of all converted files, next to the output
+        filename = os.path.join(output_path, 'conversion-timings.json')
+        try:
+            instrument.saveReport(filename)
+        except OSError:
+            logger.exception('Could not save the timings.')
+        else:
+            LogWindow.submit_message('INFO', 'Timings saved to ' + filename)
+
+    def callInMainThread(self, function, *args, cancelled='Cancelled'):
+        # Tk may only be used from the main thread. The worker waits here until poll_worker has run the function,
+        # or answered cancelled because the window is closed
+        reply = queue.Queue(maxsize=1)
+        self.requests.put((function, args, reply, cancelled))
+        return reply.get()
+
+    def poll_worker(self):
+        # Check every 100ms for questions from the worker and update the progress
+        while True:
+            try:
+                function, args, reply, cancelled = self.requests.get(block=False)
+            except queue.Empty:
+                break
+            else:
+                if self.closing:
+                    reply.put(cancelled)
+                    continue
+                try:
+                    result = function(*args)
+                except Exception:
+                    logger.exception('Could not ask for input.')
+                    result = cancelled
+                reply.put(result)
+
+        while True:
+            try:
+                event = self.progress_queue.get(block=False)
+            except queue.Empty:
+                break
+            else:
+                if event[0] == 'file':
+                    index, total, self.rows_total, name = event[1:]
+                    self.file_name = 'File ' + str(index) + ' of ' + str(total) + ': ' + name
+                    self.progressbar.configure(maximum=max(self.rows_total, 1), value=0)
+                elif event[0] == 'done':
+                    self.run_button.state(['!disabled'])
+                    self.cancel_button.state(['disabled'])
+                    self.status.set('Done.' if not self.cancel_event.is_set() else 'Cancelled.')
+
+        if self.worker is not None and self.worker.is_alive() and self.rows_total:
+            # rows_done is written by the worker, reading a single attribute is safe
+            rows = self.rows_done
+            resumed = self.rows_resumed or 0
+            elapsed = time.monotonic() - self.file_started
+            rate = int((rows - resumed) / elapsed) if elapsed > 0 else 0
+            self.progressbar.configure(value=min(rows, self.rows_total))
+            self.status.set(self.file_name + ' - row ' + str(rows) + ' of ' + str(self.rows_total)
+                            + ' - ' + str(rate) + ' rows/s')
+
+        self.frame.after(100, self.poll_worker)
+
+    def rowProgress(self, count):
+        if self.rows_resumed is None:
+            # The first row of this run
+            self.rows_resumed = count - 1
+        self.rows_done = count
+
+    # Main method to search for files and process transactions, runs on the worker thread
+    def scanAndConvert(self, input_path, output_path, batch_review=False, incremental=False, accounts=False,
+                       merge=False):
 
         logtext = 'Found ' + str(len(list(os.scandir(input_path)))) + ' files to process..'
         LogWindow.submit_message('INFO', logtext)
 
+        files = []
         for file in os.scandir(input_path):
             filename = Path(file)
             if not filename.name.startswith('.'):
@@ -174,82 +360,173 @@ class SettingsUi:
                     logtext = str(filename) + ' is not a CSV file.. Skipped.'
                     LogWindow.submit_message('WARNING', logtext)
                 else:
-                    logtext = 'Started processing file ' + str(filename)
+                    files.append(filename)
+
+        # Leave out what was converted before, whole files by content hash and single transactions by fingerprint
+        manifest = None
+        plans = {}
+        if incremental:
+            manifest = Manifest(output_path)
+            for filename in list(files):
+                with instrument.measure('manifest'):
+                    plan = manifest.prepare(filename)
+                if plan is None:
+                    logtext = str(filename) + ' has been converted before.. Skipped.'
+                    LogWindow.submit_message('INFO', logtext)
+                    files.remove(filename)
+                else:
+                    plans[filename] = plan
+                    logtext = str(filename) + ': ' + str(len(plan.skip)) + ' transactions have been converted before.'
                     LogWindow.submit_message('INFO', logtext)
 
-                    # Define output CSV filename
-                    outputfile = output_path + '/' + filename.name
-                    outputfile = open(outputfile, 'w', newline='')
-                    outputwriter = csv.writer(outputfile)
-                    outputwriter.writerow(["Date", "Payee", "Category", "Memo", "Outflow", "Inflow"])
+        skips = {filename: plan.skip for filename, plan in plans.items()}
+
+        # Either ask for every unknown transaction while converting, or review them all up front
+        resolve = self.resolveCategory
+        if batch_review:
+            with instrument.measure('review'):
+                # Merged output has no checkpoints, a separate conversion continues where it stopped
+                outputs = None if merge else {filename: output_path + '/' + filename.name for filename in files}
+                resolve = self.reviewUnknowns(files, skips, outputs, accounts)
+            if resolve is None:
+                logtext = 'Processing has been stopped.'
+                LogWindow.submit_message('INFO', logtext)
+                return
+
+        if instrument.enabled() and (incremental or batch_review):
+            # Time spent before the first file is converted
+            LogWindow.submit_message('INFO', instrument.finishFile('preparation'))
+
+        if merge:
+            self.mergeAll(files, output_path, resolve, skips, manifest, plans)
+            return
+
+        for index, filename in enumerate(files, 1):
+            if self.cancel_event.is_set():
+                logtext = 'Processing has been stopped.'
+                LogWindow.submit_message('INFO', logtext)
+                return
+
+            logtext = 'Started processing file ' + str(filename)
+            LogWindow.submit_message('INFO', logtext)
+
+            with instrument.measure('count rows'):
+                rows = countRows(filename)
+            logtext = 'Found ' + str(rows) + ' rows to process.'
+            LogWindow.submit_message('INFO', logtext)
+
+            self.rows_done = 0
+            self.rows_resumed = None
+            self.file_started = time.monotonic()
+            self.progress_queue.put(('file', index, len(files), rows, filename.name))
+
+            # Stream the rows from the input file through the category lookup into the output file
+            outputfile = output_path + '/' + filename.name
+            try:
+                with instrument.measure('convert file'):
+                    written, unknown = convertFile(filename, outputfile, resolve=resolve, progress=self.rowProgress,
+                                                   cancel=self.cancel_event, skip=skips.get(filename),
+                                                   accounts=accounts)
+            except ConversionCancelled:
+                logtext = 'Processing has been stopped. Converting ' + filename.name + ' again continues where it ' \
+                          + 'stopped.'
+                LogWindow.submit_message('INFO', logtext)
+                return
+
+            if manifest is not None:
+                with instrument.measure('manifest'):
+                    manifest.commit(filename, plans[filename], written)
+                    manifest.save()
+
+            logtext = 'Processed file completly. Saved output to disk. ' + str(filename)
+            LogWindow.submit_message('INFO', logtext)
+
+            LogWindow.submit_message('INFO', Database().statistics())
+            LogWindow.submit_message('INFO', Database.cache.statistics())
+            if instrument.enabled():
+                LogWindow.submit_message('INFO', instrument.finishFile(filename))
+
+    def mergeAll(self, files, output_path, resolve, skips, manifest, plans):
+        # All files into one date-sorted merged.csv, transactions that are in more than one file are written once.
+        # An earlier merged.csv may not be imported yet, the next merge goes to merged-2.csv and so on
+        name = 'merged.csv'
+        number = 1
+        while os.path.exists(os.path.join(output_path, name)):
+            number = number + 1
+            name = 'merged-' + str(number) + '.csv'
+
+        rows = sum(countRows(filename) for filename in files)
+        self.rows_done = 0
+        self.rows_resumed = None
+        self.file_started = time.monotonic()
+        self.progress_queue.put(('file', 1, 1, rows, name))
+
+        outputfile = os.path.join(output_path, name)
+        try:
+            with instrument.measure('merge files'):
+                written, unknown, duplicates = mergeFiles(files, outputfile, resolve=resolve, skips=skips,
+                                                          cancel=self.cancel_event, progress=self.rowProgress)
+        except ConversionCancelled:
+            logtext = 'Processing has been stopped.'
+            LogWindow.submit_message('INFO', logtext)
+            return
+
+        if manifest is not None:
+            for filename in files:
+                plan = plans[filename]
+                manifest.commit(filename, plan, len(plan.fingerprints) - len(plan.skip))
+            manifest.save()
+
+        logtext = 'Merged ' + str(len(files)) + ' files into ' + outputfile + ': ' + str(written) + ' rows written, ' \
+                  + str(duplicates) + ' duplicates left out.'
+        LogWindow.submit_message('INFO', logtext)
+        LogWindow.submit_message('INFO', Database().statistics())
+        LogWindow.submit_message('INFO', Database.cache.statistics())
+        if instrument.enabled():
+            LogWindow.submit_message('INFO', instrument.finishFile(outputfile))
+
+    def reviewUnknowns(self, files, skips=None, outputs=None, accounts=False):
+        # First pass over all files, the unknown transactions are then reviewed in one batch grouped by payee.
+        # Returns the resolve function for the second pass, or None when the review was cancelled.
+        try:
+            unknowns = collectUnknowns(files, skips, cancel=self.cancel_event, outputs=outputs, accounts=accounts)
+        except ConversionCancelled:
+            return None
+
+        logtext = 'Found ' + str(sum(group.count for group in unknowns.values())) + ' unknown transactions from ' \
+                  + str(len(unknowns)) + ' payees.'
+        LogWindow.submit_message('INFO', logtext)
 
-                    # Load input CSV file
-                    inputfile = open(filename)
-                    csvreader = csv.reader(inputfile)
-                    inputdata = list(csvreader)
+        decisions = {}
+        if unknowns:
+            # Build the suggestion index here, not in the dialog
+            Database().getSuggester()
+            decisions = self.callInMainThread(self.askReview, unknowns, cancelled=None)
+            if decisions is None:
+                return None
+
+        # Rules added during the review are picked up by the category lookup itself,
+        # the decisions only cover the payees that were categorized without adding a rule
+        return lambda transaction: decisions.get(transaction.payee, 'Skipped')
+
+    def resolveCategory(self, transaction):
+        # Ask the user for the category of an unknown transaction
+        logtext = 'Category not found for payee. Please add category to continue.'
+        LogWindow.submit_message('INFO', logtext)
 
-                    logtext = 'Found ' + str(len(inputdata)) + ' rows to process.'
-                    LogWindow.submit_message('INFO', logtext)
+        # Ranked on the worker thread, the first time the index is built
+        suggestions = Database().suggest(transaction)
+        return self.callInMainThread(self.askCategory, transaction, suggestions)
 
-                    # Create transaction instance and convert
-                    for row in inputdata[1:]:
-                        print(row)
-
-                        # date, payee, category, memo, type, amount
-
-                        row = Transaction(row[0], row[1], str(row[8]), str(row[5]), str(row[6]))
-
-                        # Use payee or memo to search for the category, if not retunn empty
-                        category = row.searchPayees()
-                        if not category:
-                            category = row.searchMemos()
-                            if not category:
-                                logtext = 'Category not found for payee. Please add category to continue.'
-                                LogWindow.submit_message('INFO', logtext)
-
-                                dialog = AddCategoryDialog(self.root, prompt="Add category")
-                                dialog.populate_transaction(row.__dict__.values())
-                                result = dialog.show()
-
-                                if result == 'Cancelled':
-                                    logtext = 'Processing has been stopped.'
-                                    LogWindow.submit_message('INFO', logtext)
-                                    return
-                                else:
-                                    if result == 'Skipped':
-                                        logtext = 'Transaction skipped.'
-                                        LogWindow.submit_message('INFO', logtext)
-                                        continue
-
-                                    else:
-                                        logtext = 'Category or payee added.'
-                                        LogWindow.submit_message('INFO', logtext)
-                                        category = result
-                        if category:
-                            logtext = 'Category found.' + 'Payee: ' + row.payee + ' Category: ' + category
-                            LogWindow.submit_message('INFO', logtext)
-
-                            if row.type == 'Af':
-                                type = ','
-                            else:
-                                type = ',,'
-
-                            # Date,Payee,Category,Memo,Outflow,Inflow
-                            # 07/25/10,Sample Payee,,Sample Memo for an outflow,100.00,
-                            # 07/26/10,Sample Payee 2,,Sample memo for an inflow,,500.003')
-
-                            output = row.date + ',' + str(row.payee) + ',' + category
-                            output = output + ',' + row.memo + type + str(row.amount)
-                            print(output)
-
-                            outputwriter.writerow(output.split(','))
-                            logtext = 'Transaction processed.' + 'Payee: ' + row.payee + ' Category: ' + category
-                            LogWindow.submit_message('INFO', logtext)
-
-                    # Close the file
-                    logtext = 'Processed file completly. Saving output to disk. ' + str(filename)
-                    LogWindow.submit_message('INFO', logtext)
-                    outputfile.close()
+    def askCategory(self, transaction, suggestions=()):
+        dialog = AddCategoryDialog(self.root, prompt="Add category")
+        dialog.populate_transaction(transaction.describe())
+        dialog.category.preselect(suggestions)
+        return dialog.show()
+
+    def askReview(self, unknowns):
+        dialog = ReviewDialog(self.root, unknowns)
+        return dialog.show()
 
 
 class QueueHandler(logging.Handler):
@@ -291,7 +568,16 @@ class LogWindow:
 
 class ConsoleUi:
 
-    """Poll messages from a logging queue and display them in a scrolled text widget"""
+    """Poll messages from a logging queue and display them in a scrolled text widget.
+    The queue is drained in batches with a single insert per poll, and only the last max_lines lines are kept.
+    """
+
+    max_lines = 2000
+    # Records drained per poll, and the number above which per-row messages are collapsed into counters
+    max_batch = 5000
+    busy = 200
+
+    levels = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
 
     def __init__(self, frame):
         self.frame = frame
@@ -304,36 +590,506 @@ class ConsoleUi:
         self.scrolled_text.tag_config('WARNING', foreground='orange')
         self.scrolled_text.tag_config('ERROR', foreground='red')
         self.scrolled_text.tag_config('CRITICAL', foreground='red', underline=1)
+
+        # Level filter, the history is kept so changing the filter shows older lines again
+        self.history = collections.deque(maxlen=self.max_lines)
+        self.level = tk.StringVar(value='DEBUG')
+        filter_frame = ttk.Frame(frame)
+        filter_frame.grid(row=1, column=0, sticky=W)
+        ttk.Label(filter_frame, text="Show").grid(row=0, column=0)
+        level = ttk.Combobox(filter_frame, textvariable=self.level, values=self.levels, state='readonly', width=10)
+        level.grid(row=0, column=1)
+        level.bind('<<ComboboxSelected>>', self.refilter)
+
         # Create a logging handler using a queue
         self.log_queue = queue.Queue()
         self.queue_handler = QueueHandler(self.log_queue)
         formatter = logging.Formatter('%(asctime)s: %(message)s')
         self.queue_handler.setFormatter(formatter)
-        logger.addHandler(self.queue_handler)
+        # Attached to the root logger, so messages from the conversion pipeline show up as well
+        logging.getLogger().addHandler(self.queue_handler)
 
         # Start polling messages from the queue
         self.frame.after(100, self.poll_log_queue)
 
-    def display(self, record):
-        msg = self.queue_handler.format(record)
+    def display(self, lines):
+        # lines are (levelno, levelname, message) tuples, inserted with one call
+        minimum = logging.getLevelName(self.level.get())
+        chunks = []
+        for levelno, levelname, msg in lines:
+            if levelno >= minimum:
+                chunks.append(msg + '\n')
+                chunks.append(levelname)
+
+        if not chunks:
+            return
+
         self.scrolled_text.configure(state='normal')
-        self.scrolled_text.insert(tk.END, msg + '\n', record.levelname)
+        self.scrolled_text.insert(tk.END, *chunks)
+
+        # Trim the oldest lines
+        count = int(self.scrolled_text.index('end-1c').split('.')[0])
+        if count > self.max_lines:
+            self.scrolled_text.delete('1.0', str(count - self.max_lines + 1) + '.0')
+
         self.scrolled_text.configure(state='disabled')
         # Autoscroll to the bottom
         self.scrolled_text.yview(tk.END)
 
+    def refilter(self, event=None):
+        self.scrolled_text.configure(state='normal')
+        self.scrolled_text.delete('1.0', tk.END)
+        self.scrolled_text.configure(state='disabled')
+        self.display(self.history)
+
+    def collapse(self, records):
+        # Under load, per-row messages (logged with a 'summary' extra) are counted instead of shown one by one
+        busy = len(records) > self.busy
+        lines = []
+        # (levelno, levelname, summary) -> [line number, count, first record], the counted line is shown where its
+        # first record was
+        counters = {}
+
+        for record in records:
+            summary = getattr(record, 'summary', None)
+            if busy and summary:
+                key = (record.levelno, record.levelname, summary)
+                counter = counters.get(key)
+                if counter is None:
+                    counters[key] = [len(lines), 1, record]
+                    lines.append(None)
+                else:
+                    counter[1] = counter[1] + 1
+            else:
+                lines.append((record.levelno, record.levelname, self.queue_handler.format(record)))
+
+        for (levelno, levelname, summary), (number, count, record) in counters.items():
+            msg = self.queue_handler.formatter.formatTime(record) + ': ' + summary + ' (' + str(count) + 'x)'
+            lines[number] = (levelno, levelname, msg)
+
+        return lines
+
     def poll_log_queue(self):
-        # Check every 100ms if there is a new message in the queue to display
-        while True:
+        # Check every 100ms if there are new messages in the queue and display them at once
+        records = []
+        while len(records) < self.max_batch:
             try:
-                record = self.log_queue.get(block=False)
+                records.append(self.log_queue.get(block=False))
             except queue.Empty:
                 break
-            else:
-                self.display(record)
+
+        if records:
+            lines = self.collapse(records)
+            self.history.extend(lines)
+            self.display(lines)
+
         self.frame.after(100, self.poll_log_queue)
 
 
+class ManageUi:
+    """ Payees and memos of every category, grouped by master category.
+
+    Categories and entries are only inserted into the tree when their parent is opened, entries in pages of
+    page_size, and they are removed again when it is closed, so the tree holds what is on screen instead of the whole
+    database. Typing in the search box filters through a prefix index (see prefix.py). Edits change the in-memory
+    database at once and are saved on a background thread save_delay ms after the last edit.
+    """
+
+    page_size = 200
+    max_results = 200
+    # Milliseconds after the last key press and after the last edit
+    search_delay = 150
+    save_delay = 2000
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.search = StringVar()
+        self.field = StringVar(value='Payees')
+        self.entry = StringVar()
+        self.status = StringVar()
+        # Tree item -> ('master', name), ('category', position), ('entry', position, field, entry),
+        # ('more', position, start) or ('placeholder',) for a parent that is not opened yet
+        self.items = {}
+        # Master category -> positions of its categories, and the prefix index, built on a background thread
+        self.masters = {}
+        self.index = None
+        self.indexer = None
+        self.built = None
+        # Database.version the tab shows
+        self.version = None
+        self.search_job = None
+        self.save_job = None
+        self.saver = None
+        self.unsaved = False
+        self.initUI()
+        self.add_padding()
+
+    def initUI(self):
+        ttk.Label(self.frame, text="Search").grid(column=0, row=0, sticky=E)
+        ttk.Entry(self.frame, textvariable=self.search).grid(column=1, row=0, columnspan=4, sticky=(W, E))
+        self.search.trace_add('write', self.schedule_search)
+
+        self.tree = ttk.Treeview(self.frame, columns=('details',), height=20, selectmode='browse')
+        self.tree.heading('#0', text='Category / Payee or Memo')
+        self.tree.heading('details', text='Details')
+        self.tree.column('details', width=160, stretch=False)
+        self.tree.grid(column=0, row=1, columnspan=5, sticky="nsew")
+
+        scrollbar = ttk.Scrollbar(self.frame, orient=VERTICAL, command=self.tree.yview)
+        scrollbar.grid(column=5, row=1, sticky=(N, S))
+        self.tree.configure(yscrollcommand=scrollbar.set)
+
+        self.tree.bind('<<TreeviewOpen>>', self.open_item)
+        self.tree.bind('<<TreeviewClose>>', self.close_item)
+        self.tree.bind('<<TreeviewSelect>>', self.select_item)
+
+        # Edit the selected entry or add a new one
+        ttk.Radiobutton(self.frame, text="Payee", variable=self.field, value='Payees').grid(column=0, row=2, sticky=E)
+        ttk.Radiobutton(self.frame, text="Memo", variable=self.field, value='Memos').grid(column=0, row=3, sticky=E)
+        ttk.Entry(self.frame, textvariable=self.entry).grid(column=1, row=2, rowspan=2, columnspan=4, sticky=(W, E))
+
+        ttk.Label(self.frame, text="Master Category").grid(column=0, row=4, sticky=E)
+        self.mastercat = ttk.Combobox(self.frame)
+        self.mastercat.grid(column=1, row=4, columnspan=4, sticky=(W, E))
+
+        ttk.Label(self.frame, text="Category").grid(column=0, row=5, sticky=E)
+        self.category = ttk.Combobox(self.frame)
+        self.category.grid(column=1, row=5, columnspan=4, sticky=(W, E))
+
+        ttk.Button(self.frame, text="Add", command=self.add_entry).grid(column=1, row=6, sticky=W)
+        ttk.Button(self.frame, text="Save changes", command=self.change_entry).grid(column=2, row=6, sticky=W)
+        ttk.Button(self.frame, text="Delete", command=self.delete_entry).grid(column=3, row=6, sticky=W)
+        ttk.Label(self.frame, textvariable=self.status).grid(column=4, row=6, sticky=E)
+
+    def add_padding(self):
+        for child in self.frame.winfo_children():
+            child.grid_configure(padx=5, pady=5)
+
+    def refresh(self, event=None):
+        # Loaded when the tab is shown, and again when rules were added elsewhere (a conversion, an import)
+        if self.version == Database.version:
+            return
+
+        data = Database().openDatabase()
+        self.version = Database.version
+        self.index = None
+        self.build_index()
+        self.masters = {}
+        for position, x in enumerate(data['categories']):
+            self.masters.setdefault(x['Master Category'], []).append(position)
+
+        self.mastercat['values'] = sorted(self.masters, key=str.lower)
+        self.category['values'] = sorted({x['Category'] for x in data['categories']}, key=str.lower)
+        self.show()
+
+    def build_index(self):
+        # Building the index of a large database takes a moment, the tab can be used in the meantime
+        version = Database.version
+        data = Database().openDatabase()
+
+        def build():
+            self.built = (version, PrefixIndex(data))
+
+        self.indexer = threading.Thread(target=build, daemon=True)
+        self.indexer.start()
+
+    def schedule_search(self, *args):
+        # Searched once typing pauses, not on every key press
+        if self.search_job is not None:
+            self.frame.after_cancel(self.search_job)
+        self.search_job = self.frame.after(self.search_delay, self.show)
+
+    def show(self):
+        self.search_job = None
+        self.tree.delete(*self.tree.get_children())
+        self.items = {}
+
+        query = self.search.get().strip()
+        if query:
+            self.show_results(query)
+            return
+
+        for master in sorted(self.masters, key=str.lower):
+            item = self.tree.insert('', 'end', text=master, values=(str(len(self.masters[master])) + ' categories',))
+            self.items[item] = ('master', master)
+            self.add_placeholder(item)
+
+    def show_results(self, query):
+        # Matching categories and entries, grouped by master category and category
+        if self.index is None:
+            if self.indexer.is_alive():
+                self.tree.insert('', 'end', text='Searching..')
+                self.search_job = self.frame.after(self.search_delay, self.show)
+                return
+
+            version, index = self.built
+            if version != Database.version:
+                # Edited while the index was built
+                self.build_index()
+                self.search_job = self.frame.after(self.search_delay, self.show)
+                return
+            self.index = index
+
+        results, more = self.index.search(query, self.max_results)
+
+        categories = Database().openDatabase()['categories']
+
+        def order(result):
+            x = categories[result[0]]
+            return x['Master Category'].lower(), x['Category'].lower(), result[0], result[1], result[2].lower()
+
+        masters = {}
+        parents = {}
+        for position, field, entry in sorted(results, key=order):
+            x = categories[position]
+            master = masters.get(x['Master Category'])
+            if master is None:
+                master = masters[x['Master Category']] = self.tree.insert('', 'end', text=x['Master Category'],
+                                                                          open=True)
+                self.items[master] = ('master', x['Master Category'])
+
+            parent = parents.get(position)
+            if parent is None:
+                parent = parents[position] = self.insert_category(master, position, open=bool(field))
+            if field:
+                self.insert_entry(parent, position, field, entry)
+
+        if more:
+            self.tree.insert('', 'end', text='More than ' + str(self.max_results) + ' matches, type more letters')
+        elif not results:
+            self.tree.insert('', 'end', text='Nothing found')
+
+    def add_placeholder(self, parent):
+        # Makes the parent openable, its children are inserted when it is opened
+        self.items[self.tree.insert(parent, 'end', text='..')] = ('placeholder',)
+
+    def insert_category(self, parent, position, open=False):
+        x = Database().openDatabase()['categories'][position]
+        details = str(len(x['Payees'])) + ' payees, ' + str(len(x['Memos'])) + ' memos'
+        item = self.tree.insert(parent, 'end', text=x['Category'], values=(details,), open=open)
+        self.items[item] = ('category', position)
+        if not open:
+            self.add_placeholder(item)
+        return item
+
+    def insert_entry(self, parent, position, field, entry):
+        item = self.tree.insert(parent, 'end', text=entry, values=(field[:-1],))
+        self.items[item] = ('entry', position, field, entry)
+        return item
+
+    def insert_page(self, parent, position, start):
+        # The next page_size entries of a category, and an item that loads the page after it
+        x = Database().openDatabase()['categories'][position]
+        entries = [('Payees', entry) for entry in x['Payees']] + [('Memos', entry) for entry in x['Memos']]
+        for field, entry in entries[start:start + self.page_size]:
+            self.insert_entry(parent, position, field, entry)
+
+        rest = len(entries) - start - self.page_size
+        if rest > 0:
+            item = self.tree.insert(parent, 'end', text=str(rest) + ' more, select to show')
+            self.items[item] = ('more', position, start + self.page_size)
+
+    def forget_children(self, parent):
+        for item in self.tree.get_children(parent):
+            self.forget_children(item)
+            self.items.pop(item, None)
+        self.tree.delete(*self.tree.get_children(parent))
+
+    def open_item(self, event=None):
+        item = self.tree.focus()
+        children = self.tree.get_children(item)
+        if not children or self.items.get(children[0]) != ('placeholder',):
+            return
+
+        self.forget_children(item)
+        kind = self.items.get(item)
+        if kind[0] == 'master':
+            categories = Database().openDatabase()['categories']
+            positions = self.masters.get(kind[1], [])
+            for position in sorted(positions, key=lambda position: categories[position]['Category'].lower()):
+                self.insert_category(item, position)
+        elif kind[0] == 'category':
+            self.insert_page(item, kind[1], 0)
+
+    def close_item(self, event=None):
+        # Closed branches give their items back, the tree only holds what was opened
+        item = self.tree.focus()
+        if self.items.get(item, ('',))[0] in ('master', 'category'):
+            self.forget_children(item)
+            self.add_placeholder(item)
+
+    def select_item(self, event=None):
+        selection = self.tree.selection()
+        if not selection:
+            return
+
+        item = selection[0]
+        kind = self.items.get(item)
+        if kind is None:
+            return
+
+        categories = Database().openDatabase()['categories']
+        if kind[0] == 'more':
+            parent = self.tree.parent(item)
+            self.items.pop(item)
+            self.tree.delete(item)
+            self.insert_page(parent, kind[1], kind[2])
+        elif kind[0] == 'master':
+            self.mastercat.set(kind[1])
+        elif kind[0] in ('category', 'entry'):
+            x = categories[kind[1]]
+            self.mastercat.set(x['Master Category'])
+            self.category.set(x['Category'])
+            if kind[0] == 'entry':
+                self.field.set(kind[2])
+                self.entry.set(kind[3])
+
+    def selected_entry(self):
+        selection = self.tree.selection()
+        kind = self.items.get(selection[0]) if selection else None
+        if kind is None or kind[0] != 'entry':
+            messagebox.showerror(message='No payee or memo selected.')
+            return None, None
+        return selection[0], kind
+
+    def check_input(self):
+        # The entry and category that are filled in, or None when they can not be saved
+        master, category, entry = self.mastercat.get().strip(), self.category.get().strip(), self.entry.get()
+        if master == '' or category == '':
+            messagebox.showerror(message='Master category or category not filled in.')
+        elif checkEntry(entry) is not None:
+            messagebox.showerror(message=self.field.get()[:-1] + ' ' + entry + ' can not be used: '
+                                 + checkEntry(entry) + '.')
+        else:
+            return master, category, entry
+        return None
+
+    def add(self, master, category, field, entry):
+        database = Database()
+        data = database.openDatabase()
+        count = len(data['categories'])
+        pos = database.findCategory(data, master, category)
+        if pos != '' and entry in data['categories'][pos][field]:
+            return
+
+        position = database.addEntry(master, category, field, entry)
+        x = data['categories'][position]
+        if self.index is not None:
+            if position >= count:
+                self.index.addCategory(position, x['Master Category'], x['Category'])
+            self.index.add(position, field, entry)
+
+        if position >= count:
+            # A new category, the browse view gets it from the masters
+            self.masters.setdefault(x['Master Category'], []).append(position)
+            self.mastercat['values'] = sorted(self.masters, key=str.lower)
+            self.category['values'] = sorted(set(self.category['values'] or ()) | {x['Category']}, key=str.lower)
+
+    def remove(self, position, field, entry):
+        Database().removeEntry(position, field, entry)
+        if self.index is not None:
+            self.index.remove(position, field, entry)
+
+    def add_entry(self):
+        checked = self.check_input()
+        if checked is None:
+            return
+        master, category, entry = checked
+        self.add(master, category, self.field.get(), entry)
+        self.edited()
+
+    def change_entry(self):
+        item, kind = self.selected_entry()
+        if item is None:
+            return
+        checked = self.check_input()
+        if checked is None:
+            return
+        master, category, entry = checked
+
+        self.remove(kind[1], kind[2], kind[3])
+        self.add(master, category, self.field.get(), entry)
+        self.edited()
+
+    def delete_entry(self):
+        item, kind = self.selected_entry()
+        if item is None:
+            return
+        self.remove(kind[1], kind[2], kind[3])
+        self.items.pop(item)
+        self.tree.delete(item)
+        self.edited()
+
+    def edited(self):
+        # Shown again with the edit, and saved once the edits pause
+        self.version = Database.version
+        self.unsaved = True
+        self.status.set('Unsaved changes')
+        self.reload()
+
+        if self.save_job is not None:
+            self.frame.after_cancel(self.save_job)
+        self.save_job = self.frame.after(self.save_delay, self.save)
+
+    def reload(self):
+        # Show the search results again, or the opened categories with their first page of entries
+        if self.search.get().strip():
+            self.show()
+            return
+
+        for master in self.tree.get_children():
+            for item in self.tree.get_children(master):
+                kind = self.items.get(item)
+                if kind is not None and kind[0] == 'category' and self.tree.item(item, 'open'):
+                    self.forget_children(item)
+                    self.insert_page(item, kind[1], 0)
+
+        shown = {self.items[item][1] for item in self.tree.get_children() if item in self.items}
+        if set(self.masters) != shown:
+            self.show()
+
+    def save(self):
+        self.save_job = None
+        if self.saver is not None and self.saver.is_alive():
+            self.save_job = self.frame.after(self.save_delay, self.save)
+            return
+
+        self.unsaved = False
+        self.status.set('Saving..')
+        self.saver = threading.Thread(target=self.saveInBackground, daemon=True)
+        self.saver.start()
+        self.frame.after(100, self.poll_save)
+
+    def saveInBackground(self):
+        try:
+            Database().saveDatabase()
+        except Exception:
+            logger.exception('Could not save the category database.')
+            self.unsaved = True
+
+    def poll_save(self):
+        if self.saver.is_alive():
+            self.frame.after(100, self.poll_save)
+            return
+
+        if not self.unsaved:
+            self.version = Database.version
+            self.status.set('Saved.')
+        elif self.save_job is None:
+            self.status.set('Not saved, see the console.')
+
+    def flush(self):
+        # Save what is still unsaved before the application closes
+        if self.save_job is not None:
+            self.frame.after_cancel(self.save_job)
+            self.save_job = None
+        if self.saver is not None:
+            self.saver.join()
+        if self.unsaved:
+            self.unsaved = False
+            Database().saveDatabase()
+
+
 class CategoryUi:
 
     def __init__(self, parent, frame, root):
@@ -397,13 +1153,34 @@ class CategoryUi:
             else:
                 if self.category.get() == '':
                     messagebox.showerror(message='Category not filled in.')
-                else:
+                elif self.checkEntries():
                     self.parent.var.set(self.mastercat.get() + ': ' + self.category.get())
                     # If a payee or memo is filled in, add category, otherwise just leave as is
                     if self.entry1.get() or self.entry2.get():
                         Category(self.category.get(), self.entry1.get(), self.entry2.get(), self.mastercat.get()).addCategory()
                     self.root.destroy()
 
+    def preselect(self, suggestions):
+        # Best suggestion selected, the suggested categories at the top of the list
+        if not suggestions:
+            return
+        master, category, score = suggestions[0]
+        self.mastercat.set(master)
+        self.category.set(category)
+
+        suggested = [name for master, name, score in suggestions]
+        others = sorted(name for name in self.category['values'] if name not in suggested)
+        self.category['values'] = list(dict.fromkeys(suggested)) + others
+
+    def checkEntries(self):
+        # Entries that would be rejected when the rules are compiled are not saved
+        for name, entry in (('Payee', self.entry1.get()), ('Memo', self.entry2.get())):
+            reason = checkEntry(entry) if entry else None
+            if reason is not None:
+                messagebox.showerror(message=name + ' ' + entry + ' can not be used: ' + reason + '.')
+                return False
+        return True
+
     def skip_category(self):
         self.parent.var.set('Skipped')
         self.root.destroy()
@@ -473,8 +1250,154 @@ class AddCategoryDialog:
             ttk.Label(self.transaction_frame, text=u"%s" % item, wraplength=600).grid(in_=self.transaction_frame, column=1, row=i, sticky='w')
 
 
-#Todo: add tab to see payees/memos and categories
-# Todo: Change categories
+class ReviewDialog:
+    """ Batch review of all unknown transactions, grouped by payee so every payee needs only one decision.
+    """
+
+    def __init__(self, parent, unknowns):
+        self.popup = tk.Toplevel(parent)
+        self.popup.title("Review unknown transactions")
+        self.popup.transient(parent)
+        self.parent = parent
+        self.popup.columnconfigure(0, weight=1)
+        self.popup.rowconfigure(0, weight=1)
+
+        self.payees = list(unknowns)
+        self.unknowns = unknowns
+        # payee -> 'Master Category: Category' and payee -> (rule, master, category)
+        self.decisions = {}
+        self.rules = {}
+        self.cancelled = True
+
+        self.add_rule = BooleanVar(value=True)
+        self.rule = StringVar()
+
+        self.initUI()
+
+    def initUI(self):
+
+        # List of unknown payees
+        transaction_frame = ttk.Labelframe(self.popup, text="Unknown Transactions")
+        transaction_frame.grid(row=0, column=0, sticky="nsew")
+        transaction_frame.columnconfigure(0, weight=1)
+        transaction_frame.rowconfigure(0, weight=1)
+
+        self.tree = ttk.Treeview(transaction_frame, columns=('rows', 'memo', 'category'), height=15)
+        self.tree.heading('#0', text='Payee')
+        self.tree.heading('rows', text='Rows')
+        self.tree.heading('memo', text='Memo')
+        self.tree.heading('category', text='Category')
+        self.tree.column('rows', width=50, stretch=False, anchor=E)
+        self.tree.grid(row=0, column=0, sticky="nsew")
+
+        scrollbar = ttk.Scrollbar(transaction_frame, orient=VERTICAL, command=self.tree.yview)
+        scrollbar.grid(row=0, column=1, sticky=(N, S))
+        self.tree.configure(yscrollcommand=scrollbar.set)
+
+        for i, payee in enumerate(self.payees):
+            group = self.unknowns[payee]
+            self.tree.insert('', 'end', iid=str(i), text=payee, values=(group.count, group.transaction.memo, ''))
+
+        self.tree.bind('<<TreeviewSelect>>', self.select_payee)
+
+        # Category for the selected payees
+        category_frame = ttk.Labelframe(self.popup, text="Category")
+        category_frame.grid(row=1, column=0, sticky="nsew")
+        category_frame.columnconfigure(1, weight=1)
+
+        ttk.Label(category_frame, text="Master Category").grid(column=0, row=0, sticky=E)
+        self.mastercat = ttk.Combobox(category_frame, values=Category('','','','').getMasterCategories())
+        self.mastercat.grid(column=1, row=0, columnspan=3, sticky=(W, E))
+
+        ttk.Label(category_frame, text="Category").grid(column=0, row=1, sticky=E)
+        self.category = ttk.Combobox(category_frame, values=Category('','','','').getCategories())
+        self.category.grid(column=1, row=1, columnspan=3, sticky=(W, E))
+
+        ttk.Label(category_frame, text="Payee rule").grid(column=0, row=2, sticky=E)
+        ttk.Entry(category_frame, textvariable=self.rule).grid(column=1, row=2, columnspan=2, sticky=(W, E))
+        ttk.Checkbutton(category_frame, text="Add rule", variable=self.add_rule).grid(column=3, row=2, sticky=W)
+
+        ttk.Button(category_frame, text="Apply to selected", command=self.apply_category).grid(column=1, row=3, sticky=W)
+        ttk.Button(category_frame, text="Skip selected", command=self.skip_category).grid(column=2, row=3, sticky=W)
+
+        ## buttons
+        buttons = ttk.Frame(self.popup)
+        buttons.grid(row=2, column=0, sticky=E)
+        ttk.Button(buttons, text="Convert", command=self.convert).grid(column=0, row=0)
+        ttk.Button(buttons, text="Cancel Processing", command=self.cancel_process).grid(column=1, row=0)
+
+        for frame in (transaction_frame, category_frame, buttons):
+            for child in frame.winfo_children():
+                child.grid_configure(padx=5, pady=5)
+
+    def select_payee(self, event=None):
+        # A rule can be edited when a single payee is selected, otherwise every payee becomes its own rule
+        selection = self.tree.selection()
+        if len(selection) == 1:
+            payee = self.payees[int(selection[0])]
+            self.rule.set(escape(payee))
+
+            # Best matching category, unless one was chosen for this payee already
+            suggestions = Database().suggest(self.unknowns[payee].transaction, 1)
+            if suggestions and payee not in self.decisions:
+                self.mastercat.set(suggestions[0][0])
+                self.category.set(suggestions[0][1])
+        else:
+            self.rule.set('')
+
+    def apply_category(self):
+        selection = self.tree.selection()
+        if not selection:
+            messagebox.showerror(message='No payee selected.', parent=self.popup)
+        elif self.mastercat.get() == '' or self.category.get() == '':
+            messagebox.showerror(message='Master category or category not filled in.', parent=self.popup)
+        elif self.add_rule.get() and len(selection) == 1 and self.rule.get() and checkEntry(self.rule.get()):
+            messagebox.showerror(message='Rule ' + self.rule.get() + ' can not be used: '
+                                 + checkEntry(self.rule.get()) + '.', parent=self.popup)
+        else:
+            category = self.mastercat.get() + ': ' + self.category.get()
+            for iid in selection:
+                payee = self.payees[int(iid)]
+                self.decisions[payee] = category
+
+                # Payee names are matched literally, BOL.COM must not match BOLXCOM
+                rule = self.rule.get() if len(selection) == 1 else escape(payee)
+                if self.add_rule.get() and rule:
+                    self.rules[payee] = (rule, self.mastercat.get(), self.category.get())
+                else:
+                    self.rules.pop(payee, None)
+
+                self.tree.set(iid, 'category', category)
+
+    def skip_category(self):
+        for iid in self.tree.selection():
+            payee = self.payees[int(iid)]
+            self.decisions.pop(payee, None)
+            self.rules.pop(payee, None)
+            self.tree.set(iid, 'category', 'Skipped')
+
+    def convert(self):
+        # Add all rules to the database, each one is a cheap journal append
+        if self.rules:
+            for rule, master, category in self.rules.values():
+                Category(category, rule, '', master).addCategory()
+
+            logtext = str(len(self.rules)) + ' payee rule(s) added.'
+            LogWindow.submit_message('INFO', logtext)
+
+        self.cancelled = False
+        self.popup.destroy()
+
+    def cancel_process(self):
+        self.popup.destroy()
+
+    def show(self):
+        # Returns the decisions per payee, or None when processing was cancelled
+        self.parent.wait_window(self.popup)
+        if self.cancelled:
+            return None
+        return self.decisions
+
 
 #Todo: add explanation
 # Todo; check output
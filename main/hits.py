@@ -0,0 +1,110 @@
+""" How often every payee and memo rule matches, kept between runs
+
+The matcher counts the hits of every rule in memory (see Matcher.found). With counting enabled the counts are added
+to a SQLite file next to the database (database.hits) after every file, so the worker processes of cli.py can all
+add theirs. Every rule is stored with the date it was first counted, a rule that has not matched anything since a
+long time ago is dead (see cli.py rules and prune).
+
+Rules are stored by field, 'Master Category: Category' and entry, so the counts survive edits of the database.
+"""
+
+import datetime
+import sqlite3
+import threading
+from collections import Counter
+from contextlib import closing
+
+
+class HitCounts:
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS hits (
+            field TEXT NOT NULL,
+            category TEXT NOT NULL,
+            entry TEXT NOT NULL,
+            hits INTEGER NOT NULL,
+            since TEXT NOT NULL,
+            last TEXT,
+            PRIMARY KEY (field, category, entry)
+        ) WITHOUT ROWID;
+    '''
+
+    def __init__(self):
+        self.filename = None
+        # (field, category, entry) -> hits not written yet, of matchers that were replaced
+        self.pending = Counter()
+        self.lock = threading.Lock()
+
+    def open(self, filename):
+        self.filename = filename
+
+    def close(self):
+        # Stop counting, hits that are not saved yet are dropped
+        with self.lock:
+            self.filename = None
+            self.pending = Counter()
+
+    def enabled(self):
+        return self.filename is not None
+
+    def connect(self):
+        connection = sqlite3.connect(self.filename, timeout=30)
+        connection.executescript(self.schema)
+        return connection
+
+    def collect(self, matcher):
+        # Move the hits counted by a matcher to pending, its counters start again at 0
+        if self.filename is None:
+            return
+
+        hits = matcher.hits
+        matcher.hits = [0] * len(hits)
+        with self.lock:
+            for rule, count in enumerate(hits[:-1]):
+                if count:
+                    index, entry = matcher.rules[rule]
+                    self.pending[(matcher.field, matcher.labels[index], entry)] += count
+
+    def save(self, matchers):
+        """ Add the hits of the matchers and the pending hits to the file. Rules that were never counted before are
+        stored with 0 hits, from today on.
+        """
+        if self.filename is None:
+            return
+
+        for matcher in matchers:
+            self.collect(matcher)
+
+        today = datetime.date.today().isoformat()
+        with self.lock:
+            pending = self.pending
+            self.pending = Counter()
+
+        with closing(self.connect()) as connection, connection:
+            for matcher in matchers:
+                if not getattr(matcher, 'counted', False):
+                    connection.executemany('INSERT OR IGNORE INTO hits (field, category, entry, hits, since) '
+                                           'VALUES (?, ?, ?, 0, ?)',
+                                           [(matcher.field, matcher.labels[index], entry, today)
+                                            for index, entry in matcher.rules])
+                    matcher.counted = True
+
+            connection.executemany('INSERT INTO hits (field, category, entry, hits, since, last) '
+                                   'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (field, category, entry) '
+                                   'DO UPDATE SET hits = hits + excluded.hits, last = excluded.last',
+                                   [key + (count, today, today) for key, count in pending.items()])
+
+    def forget(self, keys):
+        # Drop the counts of removed (field, category, entry) rules, added again they are counted from that day on
+        if self.filename is None:
+            return
+        with closing(self.connect()) as connection, connection:
+            connection.executemany('DELETE FROM hits WHERE field = ? AND category = ? AND entry = ?', keys)
+
+    def load(self):
+        # (field, category, entry) -> (hits, first counted, last hit) of every counted rule
+        if self.filename is None:
+            return {}
+        with closing(self.connect()) as connection:
+            return {row[:3]: row[3:] for row in connection.execute('SELECT field, category, entry, hits, since, last '
+                                                                   'FROM hits')}
@@ -0,0 +1,398 @@
+""" Timing of the conversion stages
+
+When a conversion is slow, this shows where the time goes: loading the database, compiling the rules, matching,
+parsing dates and amounts, reading and writing the csv files, logging. Disabled it costs nothing, the methods and
+functions of the converter are only wrapped with timers while instrumentation is enabled somewhere.
+
+Timing is enabled for the current thread (a context variable), not for the whole process: in the GUI the
+conversion on the worker thread is timed, the Tk thread that calls the same methods is not.
+
+Every stage counts its calls, the cumulative time (including the stages it calls, like cProfile's cumtime) and its
+slowest calls. The stages of a file are summarized when the file is done and collected in a JSON report.
+An optional cProfile run can be written next to it for the details.
+"""
+
+import contextvars
+import cProfile
+import functools
+import heapq
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import nullcontext
+
+import batch
+import convert
+import main
+import matcher
+import storage
+
+# Timings of the current thread, None while it is not timed
+timings = contextvars.ContextVar('timings', default=None)
+profiler = None
+# The wrappers are installed while at least one thread is timed
+patched = []
+users = 0
+lock = threading.Lock()
+
+
+class Stage:
+    """ Call count, cumulative time and the slowest calls of one stage """
+
+    keep = 5
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        # Min-heap of (seconds, label), so the fastest of the slowest calls is dropped first
+        self.slowest = []
+
+    def add(self, seconds, label=None):
+        self.calls = self.calls + 1
+        self.seconds = self.seconds + seconds
+        if label is not None:
+            self.keepSlowest(seconds, label)
+
+    def keepSlowest(self, seconds, label):
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, (seconds, label))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, label))
+
+    def merge(self, report):
+        # Add the report of another file or worker process
+        self.calls = self.calls + report['calls']
+        self.seconds = self.seconds + report['seconds']
+        for seconds, label in report['slowest']:
+            self.keepSlowest(seconds, label)
+
+    def report(self):
+        return {'calls': self.calls, 'seconds': self.seconds, 'slowest': sorted(self.slowest, reverse=True)}
+
+
+class Timings:
+    """ The stages of the current file, and the reports of the files that are done """
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.files = []
+        self.totals = {}
+
+    def add(self, name, seconds, label=None):
+        # Output can be written on a background thread (see shards.py), a time is added to the current file or the
+        # next, never lost
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = Stage()
+            stage.add(seconds, label)
+
+    def collect(self):
+        # Report of the current file, the next file starts from zero
+        with self.lock:
+            stages = self.stages
+            self.stages = {}
+        return {name: stage.report() for name, stage in stages.items()}
+
+    def addFile(self, filename, report):
+        self.files.append({'file': str(filename), 'stages': report})
+        for name, stage in report.items():
+            self.totals.setdefault(name, Stage()).merge(stage)
+
+    def save(self, filename):
+        report = {'files': self.files, 'totals': {name: stage.report() for name, stage in self.totals.items()}}
+        temporary = str(filename) + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(report, f, indent=4)
+        os.replace(temporary, filename)
+
+
+def timed(name, function, label=None):
+    # Wrap a function or method, label(*args) names a call in the list of slowest calls
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        current = timings.get()
+        if current is None:
+            # Called from a thread that is not timed
+            return function(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            current.add(name, time.perf_counter() - started, label(*args) if label else None)
+    return wrapper
+
+
+def timedIterator(name, iterator):
+    # Time every next() of a generator separately, its consumer is not counted
+    current = timings.get()
+    if current is None:
+        yield from iterator
+        return
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            current.add(name, time.perf_counter() - started)
+            yield item
+    finally:
+        iterator.close()
+
+
+def timedGenerator(name, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return timedIterator(name, function(*args, **kwargs))
+    return wrapper
+
+
+class TimedWriter:
+    """ csv writer that times writerow and writerows """
+
+    def __init__(self, writer, timings):
+        self.writer = writer
+        self.timings = timings
+
+    def writerow(self, row):
+        started = time.perf_counter()
+        try:
+            return self.writer.writerow(row)
+        finally:
+            self.timings.add('write csv', time.perf_counter() - started)
+
+    def writerows(self, rows):
+        started = time.perf_counter()
+        try:
+            return self.writer.writerows(rows)
+        finally:
+            self.timings.add('write csv', time.perf_counter() - started)
+
+
+def timedBatches(batches):
+    """ Time of every batch from reading until it is written, used by convertFile while enabled.
+    The time between two batches covers reading, parsing and classifying the rows and writing them (and asking
+    the user). Labelled with the first transaction of the batch.
+    """
+    current = timings.get()
+    started = time.perf_counter()
+    for transactions, categories in batches:
+        yield transactions, categories
+        now = time.perf_counter()
+        first = transactions[0]
+        current.add('batch', now - started, first.date + ' ' + first.payee + ' (' + str(len(transactions)) + ' rows)')
+        started = now
+
+
+def payee(transaction, *args):
+    return transaction.payee
+
+
+def text(instance, value, *args):
+    return value
+
+
+def transaction(instance, date, payee, *args):
+    return date + ' ' + payee
+
+
+def row(instance, date, payee, memo, type, amount, account='', number=0):
+    return 'row ' + str(number) + ': ' + date + ' ' + payee
+
+
+def lookups(instance, field, texts, *args):
+    return field + ' (' + str(len(texts)) + ' texts)'
+
+
+# Stage name, owner, attribute, label
+TARGETS = [
+    ('load database', storage.JsonStorage, 'load', None),
+    ('load database', storage.SqliteStorage, 'load', None),
+    ('add rule', main.Database, 'addRule', None),
+    ('compile rules', matcher.Matcher, '__init__', None),
+    ('match rules', matcher.Matcher, 'match', text),
+    ('parse transaction', main.Transaction, '__init__', transaction),
+    ('parse date', main.Transaction, 'convertDate', None),
+    ('parse amount', main, 'parseAmount', None),
+    ('parse transaction', batch.TransactionBatch, 'append', row),
+    ('parse date', batch, 'parseOrdinal', None),
+    ('parse amount', batch, 'parseAmount', None),
+    ('classify', batch.TransactionBatch, 'classify', None),
+    ('classify', main.Transaction, 'classify', payee),
+    ('look up categories', main.Database, 'lookupMany', lookups),
+    ('search category', main.Category, 'searchCategory', None),
+    ('add category', main.Category, 'addCategory', None),
+    ('get categories', main.Category, 'getCategories', None),
+    ('get categories', main.Category, 'getMasterCategories', None),
+    ('logging', logging.Logger, 'handle', None),
+]
+
+
+def enabled():
+    return timings.get() is not None
+
+
+def timedWriter(original):
+    def wrapper(*args):
+        current = timings.get()
+        writer = original(*args)
+        return writer if current is None else TimedWriter(writer, current)
+    return wrapper
+
+
+def enable():
+    """ Start timing the current thread. The functions in TARGETS are replaced by timed wrappers until the last
+    thread that enabled timing calls disable(), the wrappers only time the threads that enabled it
+    """
+    global users
+    if timings.get() is not None:
+        return
+
+    timings.set(Timings())
+    with lock:
+        users = users + 1
+        if users > 1:
+            return
+
+        for name, owner, attribute, label in TARGETS:
+            original = getattr(owner, attribute)
+            patched.append((owner, attribute, original))
+            setattr(owner, attribute, timed(name, original, label))
+
+        patched.append((convert, 'readRows', convert.readRows))
+        convert.readRows = timedGenerator('read csv', convert.readRows)
+        patched.append((convert, 'openWriter', convert.openWriter))
+        convert.openWriter = timedWriter(convert.openWriter)
+
+
+def disable():
+    global users
+    if timings.get() is None:
+        return
+
+    timings.set(None)
+    with lock:
+        users = users - 1
+        if users > 0:
+            return
+
+        while patched:
+            owner, attribute, original = patched.pop()
+            setattr(owner, attribute, original)
+
+
+def collect():
+    """ Report of the stages timed in the current thread since the last collect(), None while it is not timed """
+    current = timings.get()
+    return None if current is None else current.collect()
+
+
+def measure(name):
+    """ Context manager that times a stage of scanAndConvert, does nothing while disabled """
+    if timings.get() is None:
+        return nullcontext()
+    return Measurement(name)
+
+
+class Measurement:
+
+    def __init__(self, name):
+        self.name = name
+        self.timings = timings.get()
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings.add(self.name, time.perf_counter() - self.started)
+        return False
+
+
+def finishFile(filename, report=None):
+    """ Add the report of a converted file (by default the stages timed in this process) and return its summary """
+    if report is None:
+        report = collect()
+    timings.get().addFile(filename, report)
+    return summary(filename, report)
+
+
+def mergeReports(reports):
+    # One report from the reports of the parts of a file, e.g. the chunks of a large export (see chunks.py)
+    stages = {}
+    for report in reports:
+        for name, stage in report.items():
+            stages.setdefault(name, Stage()).merge(stage)
+    return {name: stage.report() for name, stage in stages.items()}
+
+
+def summary(filename, report):
+    lines = ['Timings of ' + str(filename) + ':']
+    for name, stage in sorted(report.items(), key=lambda item: item[1]['seconds'], reverse=True):
+        average = stage['seconds'] / stage['calls'] * 1e6 if stage['calls'] else 0.0
+        lines.append('  %-18s %8d calls %10.3f s %10.1f us/call' % (name, stage['calls'], stage['seconds'], average))
+
+    batches = report.get('batch')
+    if batches and batches['slowest']:
+        lines.append('  slowest batches: ' + ', '.join('%s (%.1f ms)' % (label, seconds * 1000)
+                                                       for seconds, label in batches['slowest'][:3]))
+    rows = report.get('parse transaction')
+    if rows and rows['slowest']:
+        lines.append('  slowest rows: ' + ', '.join('%s (%.1f us)' % (label, seconds * 1e6)
+                                                    for seconds, label in rows['slowest'][:3]))
+    return '\n'.join(lines)
+
+
+def saveReport(filename):
+    timings.get().save(filename)
+
+
+def profile(filename):
+    """ Context manager that runs cProfile and writes the statistics to filename, does nothing when filename is None.
+    Statistics of earlier profiled runs in this process are included, so the file always covers the whole process.
+    """
+    if filename is None:
+        return nullcontext()
+    return Profile(filename)
+
+
+class Profile:
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __enter__(self):
+        global profiler
+        if profiler is None:
+            profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def __exit__(self, *exc):
+        profiler.disable()
+        profiler.dump_stats(self.filename)
+        return False
+
+
+def profilePart(profile):
+    # Every worker process writes its own cProfile statistics, they are merged when all files are done
+    return None if profile is None else profile + '.' + str(os.getpid())
+
+
+def mergeProfiles(filename, parts):
+    # Combine the cProfile statistics of the worker processes into one file
+    parts = [part for part in parts if os.path.exists(part)]
+    if not parts:
+        return
+    stats = pstats.Stats(parts[0])
+    for part in parts[1:]:
+        stats.add(part)
+    stats.dump_stats(filename)
+    for part in parts:
+        os.remove(part)
@@ -1,21 +1,286 @@
 # ! python3
 
+import copy
 import datetime
-import json
+import functools
+import logging
+import os
+import threading
 
+from cache import ClassificationCache
+from hits import HitCounts
+from matcher import Matcher
+from rules import mergeRules
+from storage import applyRule, categoryNames, findCategory, masterCategoryNames, openStorage
+from suggest import Suggester
 
-""" Tkinter methods """
 
-from tkinter import *
-from gui import *
+class Database:
+    """ Shared in-memory index of the category database. The database is loaded once and kept for the whole run,
+    it is only loaded again when the stored database changes (e.g. the modification time or size of database.json).
 
+    Reading and writing is done by a storage backend (see storage.py), picked from the file extension of filename.
 
-class Database:
+    Edits of the manage tab only change the in-memory index until saveDatabase stores them. Until then they are kept
+    in pending as well, so a reload (another process added a rule) applies them again instead of dropping them.
+    """
+
+    filename = 'database.json'
+
+    # Shared between all instances, so Database().openDatabase() is cheap after the first call
+    data = None
+    stamp = None
+    version = 0
+    backend = None
+
+    # ('add' or 'remove', rule) of the edits that are not stored yet, in order
+    pending = []
+
+    # Compiled payee and memo matchers, rebuilt once per database version
+    matchers = {}
+
+    # Payee/memo -> rule number results, only valid for the current stamp of the database
+    cache = ClassificationCache()
+
+    # How often every rule matched, kept in a file when enabled
+    hits = HitCounts()
+
+    # Category suggestions for unknown transactions, and the payees categorized in this run (payee -> category)
+    suggester = None
+    learned = {}
+
+    # Counters to see how often the database was actually loaded
+    parses = 0
+    parses_avoided = 0
+
+    # Held while the database is loaded or stored, the manage tab saves on a background thread
+    lock = threading.RLock()
+
+    def storage(self):
+        if Database.backend is None or Database.backend.filename != self.filename:
+            Database.backend = openStorage(self.filename)
+            Database.data = None
+            Database.pending = []
+        return Database.backend
+
+    def fileStamp(self):
+        return self.storage().stamp()
 
     def openDatabase(self):
-        with open("database.json", "r") as read_file:
-            data = json.load(read_file)
-            return data
+        with Database.lock:
+            storage = self.storage()
+            stamp = storage.stamp()
+
+            if Database.data is not None and stamp == Database.stamp:
+                Database.parses_avoided = Database.parses_avoided + 1
+                return Database.data
+
+            Database.data = storage.load()
+            for action, rule in Database.pending:
+                self.applyEdit(Database.data, action, rule)
+            Database.stamp = stamp
+            Database.version = Database.version + 1
+            Database.parses = Database.parses + 1
+            self.compileRules()
+            return Database.data
+
+    def findCategory(self, data, master, category):
+        return findCategory(data, master, category)
+
+    def addRule(self, rule):
+        # Update the in-memory index and store only this rule, instead of rewriting the database
+        data = self.openDatabase()
+
+        # Rules for an existing category are stored under its exact names
+        pos = findCategory(data, rule['Master Category'], rule['Category'])
+        if pos != '':
+            x = data['categories'][pos]
+            rule = dict(rule, **{'Master Category': x['Master Category'], 'Category': x['Category']})
+
+        with Database.lock:
+            applyRule(data, rule)
+            storage = self.storage()
+            storage.addRule(data, rule)
+
+            if Database.suggester is not None and Database.suggester.data is data:
+                Database.suggester.addRule(rule)
+
+            Database.stamp = storage.stamp()
+            Database.version = Database.version + 1
+
+    def addRules(self, rules, dry_run=False):
+        """ Merge many rules at once (see rules.py) and write the database once. Returns an ImportReport.
+        With dry_run the database is left as it is, the report says what the import would do.
+        """
+        data = self.openDatabase()
+        if dry_run:
+            return mergeRules(copy.deepcopy(data), rules)
+
+        report = mergeRules(data, rules)
+        if report.added:
+            self.saveDatabase()
+            # Rebuilt with the new rules on the next suggestion
+            Database.suggester = None
+        return report
+
+    def addEntry(self, master, category, field, entry):
+        """ Add a payee or memo entry ('Payees' or 'Memos') to the in-memory index only, saveDatabase stores it.
+        Returns the position of the category.
+        """
+        with Database.lock:
+            data = self.openDatabase()
+            rule = {'Master Category': master, 'Category': category, 'Payee': '', 'Memo': ''}
+            rule[field[:-1]] = entry
+            self.applyEdit(data, 'add', rule)
+            Database.pending.append(('add', rule))
+            self.edited()
+            return findCategory(data, master, category)
+
+    def removeEntry(self, position, field, entry):
+        # Remove an entry of the category at position from the in-memory index only, saveDatabase stores it
+        self.removeEntries([(position, field, entry)])
+
+    def removeEntries(self, entries):
+        # Remove (position, field, entry) entries from the in-memory index only, saveDatabase stores them
+        with Database.lock:
+            data = self.openDatabase()
+            for position, field, entry in entries:
+                x = data['categories'][position]
+                rule = {'Master Category': x['Master Category'], 'Category': x['Category'], 'Payee': '', 'Memo': ''}
+                rule[field[:-1]] = entry
+                self.applyEdit(data, 'remove', rule)
+                Database.pending.append(('remove', rule))
+            self.edited()
+
+    def applyEdit(self, data, action, rule):
+        # Add or remove the payee or memo of rule, the category is found by its names
+        if action == 'add':
+            applyRule(data, rule)
+            return
+
+        pos = findCategory(data, rule['Master Category'], rule['Category'])
+        if pos == '':
+            return
+        for field, key in (('Payees', 'Payee'), ('Memos', 'Memo')):
+            if rule[key] and rule[key] in data['categories'][pos][field]:
+                data['categories'][pos][field].remove(rule[key])
+
+    def edited(self):
+        # The in-memory rules differ from the stored ones until they are saved, results of the old rules are dropped
+        Database.version = Database.version + 1
+        Database.suggester = None
+        Database.cache.clear()
+
+    def compileRules(self):
+        # Sort the payee and memo entries into plain names and regexes and check them, see matcher.py
+        for field in ('Payees', 'Memos'):
+            # Hits of the rules that are replaced are kept
+            if field in Database.matchers:
+                Database.hits.collect(Database.matchers[field])
+            matcher = Matcher(Database.data['categories'], field)
+            matcher.version = Database.version
+            Database.matchers[field] = matcher
+
+    def getMatcher(self, field):
+        self.openDatabase()
+
+        # After an added rule the rules are compiled again on the next lookup
+        matcher = Database.matchers.get(field)
+        if matcher is None or matcher.version != Database.version:
+            self.compileRules()
+            matcher = Database.matchers[field]
+
+        return matcher
+
+    def cacheStamp(self):
+        # The cache holds rule numbers (see Matcher.match), they only mean something for this version of the rules
+        return self.filename + ' ' + repr(Database.stamp) + ' rules'
+
+    def lookup(self, field, text, count=True):
+        # Category for a payee or memo, from the classification cache when it was looked up before
+        return self.lookupMany(field, [text], count)[0]
+
+    def lookupMany(self, field, texts, count=True):
+        """ Categories for many payees or memos, the database is checked once instead of once per text.
+        With count the rules that decided get a hit (see Matcher.found), a row that is classified again does not count.
+        """
+        matcher = self.getMatcher(field)
+        stamp = self.cacheStamp()
+        get = Database.cache.get
+        rules = [get(stamp, field, text, matcher.match) for text in texts]
+        if count:
+            return matcher.found(rules)
+        labels = matcher.ruleLabels
+        return [labels[rule] for rule in rules]
+
+    def getSuggester(self):
+        # Built on first use for the loaded database, added rules are passed on by addRule
+        data = self.openDatabase()
+        if Database.suggester is None or Database.suggester.data is not data:
+            suggester = Suggester(data['categories'])
+            suggester.data = data
+            for payee, category in Database.learned.items():
+                suggester.learn(payee, *category.split(': ', 1))
+            Database.suggester = suggester
+        return Database.suggester
+
+    def suggest(self, transaction, count=5):
+        # Ranked (master, category, score) suggestions for a transaction without a category
+        return self.getSuggester().suggest(transaction.payee, transaction.memo, count)
+
+    def learn(self, transaction, category):
+        # Remember the category ('Master Category: Category') of a transaction for the suggestions
+        if ': ' not in category or transaction.payee in Database.learned:
+            return
+        Database.learned[transaction.payee] = category
+        if Database.suggester is not None and Database.suggester.data is Database.data:
+            Database.suggester.learn(transaction.payee, *category.split(': ', 1))
+
+    def enableDiskCache(self):
+        # Keep the classification cache in a file next to the database, so it survives between runs
+        Database.cache.openDisk(os.path.splitext(self.filename)[0] + '.cache')
+
+    def enableHitCounts(self):
+        # Add up how often every rule matches in a file next to the database, see hits.py. Hits counted before are
+        # left out
+        for matcher in Database.matchers.values():
+            matcher.hits = [0] * len(matcher.hits)
+        Database.hits.open(os.path.splitext(self.filename)[0] + '.hits')
+
+    def disableHitCounts(self):
+        Database.hits.close()
+
+    def saveResults(self):
+        # New classification results and rule hits go to their files, once per converted file
+        Database.cache.save()
+        Database.hits.save(list(Database.matchers.values()))
+
+    def getCategories(self):
+        # The stored database does not have the pending edits yet, then the names come from the in-memory index
+        with Database.lock:
+            if Database.pending:
+                return categoryNames(self.openDatabase())
+            return self.storage().categories(self.openDatabase)
+
+    def getMasterCategories(self):
+        with Database.lock:
+            if Database.pending:
+                return masterCategoryNames(self.openDatabase())
+            return self.storage().masterCategories(self.openDatabase)
+
+    def saveDatabase(self):
+        # Write the whole in-memory index, for JSON this compacts the journal into database.json
+        with Database.lock:
+            data = self.openDatabase()
+            storage = self.storage()
+            storage.save(data)
+            Database.pending = []
+
+            Database.stamp = storage.stamp()
+            Database.version = Database.version + 1
+
+    def statistics(self):
+        return 'Database parsed ' + str(Database.parses) + ' time(s), ' + str(Database.parses_avoided) + ' parse(s) avoided.'
 
 
 class Category:
@@ -26,129 +291,137 @@ class Category:
         self.master = master
 
     def getCategories(self):
+        return Database().getCategories()
 
-        data = Database().openDatabase()
-        result = []
+    def getMasterCategories(self):
+        return Database().getMasterCategories()
 
-        for x in data['categories']:
-            result.append(x['Category'])
+    def searchCategory(self):
 
-        return result
+        # Search the in-memory database for this master and category
+        database = Database()
+        return database.findCategory(database.openDatabase(), self.master, self.category)
 
-    def getMasterCategories(self):
+    def addCategory(self):
+
+        # Todo logging
+        # Added to an existing category or a new one, only this rule is written to the database
+        rule = {'Category': self.category, 'Master Category': self.master, 'Payee': self.payee, 'Memo': self.memo}
+        Database().addRule(rule)
 
-        data = Database().openDatabase()
-        result = []
+class MalformedRow(ValueError):
+    """ Raised for an ING row with a date or amount that cannot be parsed """
 
-        for x in data['categories']:
-            result.append(x['Master Category'])
 
-        return list(set(result))
+@functools.lru_cache(maxsize=4096)
+def parseDate(date):
+    # '20200131' -> '31/01/20'. An export only has a few hundred distinct dates, so each one is converted once
+    text = date.strip()
+    if len(text) != 8 or not text.isdecimal():
+        raise MalformedRow('Invalid date: ' + repr(date))
 
-    def searchCategory(self):
+    year, month, day = int(text[:4]), int(text[4:6]), int(text[6:])
+    try:
+        datetime.date(year, month, day)
+    except ValueError:
+        raise MalformedRow('Invalid date: ' + repr(date)) from None
 
-        # Open json database and search of any memo's can be found within the nested JSON structure
-        data = Database().openDatabase()
-        count = -1
-        #Todo logging
-
-        for x in data['categories']:
-            count = count + 1
-
-            searchterm = x['Master Category']
-            regex = re.compile(searchterm, re.IGNORECASE)
-            result = regex.search(self.master)
-            if result:
-                searchterm = x['Category']
-                regex = re.compile(searchterm, re.IGNORECASE)
-                result = regex.search(self.category)
-                if result:
-                    return count
-        else:
-            return ''
+    return '%02d/%02d/%02d' % (day, month, year % 100)
 
-    def addCategory(self):
 
-        # Todo logging
-        # First, check if already exists, if not create new other wise add
-        pos = self.searchCategory()
-        print(pos)
+@functools.lru_cache(maxsize=4096)
+def parseOrdinal(date):
+    # '20200131' -> 737455, the day number of the date, as stored in a TransactionBatch (see batch.py)
+    text = date.strip()
+    if len(text) != 8 or not text.isdecimal():
+        raise MalformedRow('Invalid date: ' + repr(date))
 
-        data = Database().openDatabase()
+    try:
+        return datetime.date(int(text[:4]), int(text[4:6]), int(text[6:])).toordinal()
+    except ValueError:
+        raise MalformedRow('Invalid date: ' + repr(date)) from None
 
-        if pos == '':
-            # Open JSON file and add new master and category, save file again
-            add = {'Category': self.category, 'Master Category': self.master, 'Memos': [self.memo], 'Payees': [self.payee]}
 
-            data['categories'].append(add)
+@functools.lru_cache(maxsize=4096)
+def formatOrdinal(ordinal):
+    # 737455 -> '31/01/20', the date format of the YNAB file
+    date = datetime.date.fromordinal(ordinal)
+    return '%02d/%02d/%02d' % (date.day, date.month, date.year % 100)
 
-            # Open JSON and save dict as obj
-            js = json.dumps(data, sort_keys=True, indent=4, separators=(',', ': '))
-            with open('database.json', 'w+') as f:
-                f.write(js)
-        else:
 
-            # Open JSON file and add to existing category, save file again
-            if self.payee != '':
-                data['categories'][pos]['Payees'].append(self.payee)
+def parseAmount(amount):
+    # '1234,56' -> 123456, exact integer cents instead of a float
+    if amount[-3:-2] == ',':
+        # Fast path for the ING format
+        digits = amount[:-3] + amount[-2:]
+        if digits.isdecimal():
+            return int(digits)
 
-            if self.memo != '':
-                data['categories'][pos]['Memos'].append(self.memo)
+    text = amount.strip()
+    sign = 1
+    if text[:1] == '-':
+        sign = -1
+        text = text[1:]
+
+    whole, separator, fraction = text.replace('.', ',').partition(',')
+    if (whole and not whole.isdecimal()) or (fraction and not fraction.isdecimal()) or len(fraction) > 2 \
+            or not (whole or fraction):
+        raise MalformedRow('Invalid amount: ' + repr(amount))
+
+    return sign * (int(whole or '0') * 100 + int(fraction.ljust(2, '0')))
+
+
+def formatAmount(cents):
+    # 123456 -> '1234.56'
+    sign = '-' if cents < 0 else ''
+    return sign + '%d.%02d' % divmod(abs(cents), 100)
 
-            # Open JSON and save dict as obj
-            js = json.dumps(data, sort_keys=True, indent=4, separators=(',', ': '))
-            with open('database.json', 'w+') as f:
-                f.write(js)
 
 class Transaction:
 
-    def __init__(self, date, payee, memo, type, amount):
+    def __init__(self, date, payee, memo, type, amount, account=''):
         self.date = self.convertDate(date)
         self.payee = str(payee.replace(',', ' &'))
         self.memo = memo
         self.type = type
-        self.amount = float(amount.replace(',', '.'))
-
-    def searchPayees(self):
-        # Open json database and search of any payee's can be found within the nested JSON structure
-        data = Database().openDatabase()
-
-        # Access data, search for payee regex in all payee elements
-        for x in data['categories']:
-            searchterm = "|".join(x['Payees'])
-            if searchterm:
-                regex = re.compile(searchterm, re.IGNORECASE)
-                result = regex.search(self.payee)
-                if result:
-                    category = x['Master Category'] + ': ' + x['Category']
-                    return category
-        else:
-            return ''
-
-    def searchMemos(self):
-        # Open json database and search of any memo's can be found within the nested JSON structure
-        data = Database().openDatabase()
-        for x in data['categories']:
-
-            searchterm = "|".join(x['Memos'])
-            if searchterm:
-                regex = re.compile(searchterm, re.IGNORECASE)
-                result = regex.search(self.memo)
-                if result:
-                    category = x['Master Category'] + ': ' + x['Category']
-                    return category
-        else:
-            return ''
+        # Amount in cents
+        self.amount = parseAmount(amount)
+        # Rekening, the ING account of the transaction
+        self.account = account
+
+    def describe(self):
+        # Date, payee, memo, type and amount as shown in the TransactionUI
+        return self.date, self.payee, self.memo, self.type, formatAmount(self.amount)
+
+    def classify(self, count=True):
+        # Payee rules first, then memo rules. Returns 'Master Category: Category' or ''
+        return self.searchPayees(count) or self.searchMemos(count)
+
+    def searchPayees(self, count=True):
+        # Search the payee against the payee rules of all categories at once, first category wins
+        return Database().lookup('Payees', self.payee, count)
+
+    def searchMemos(self, count=True):
+        # Search the memo against the memo rules of all categories at once, first category wins
+        return Database().lookup('Memos', self.memo, count)
 
     def convertDate(self, date):
-        regex = re.compile('\d\d\d\d\d\d\d\d')
-        date = regex.search(date)
-        date = datetime.datetime.strptime(date.group(0), '%Y%m%d').strftime('%d/%m/%y')
-        return date
+        return parseDate(date)
 
 
 def main():
 
+    # Tkinter methods, only imported when the GUI starts so the converter itself also runs headless (see cli.py)
+    import tkinter as tk
+    from gui import Application
+    # gui.py and convert.py import this file as the module 'main', not '__main__', so configure their Database
+    from main import Database
+
+    # A migrated SQLite database is used instead of database.json when it exists (see cli.py migrate)
+    if os.path.exists('database.sqlite'):
+        Database.filename = 'database.sqlite'
+    Database().enableDiskCache()
+
     logging.basicConfig(level=logging.DEBUG)
     root = tk.Tk()
     app = Application(root)
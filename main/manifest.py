@@ -0,0 +1,95 @@
+""" Manifest of converted files and transactions, for incremental conversion
+
+ING exports overlap, this month's download contains most of last month's rows. The manifest is stored in the output
+directory and remembers every converted file by the hash of its content, and every converted transaction by a
+fingerprint of its row. Unchanged files are skipped entirely and from changed files only the new rows are converted,
+so YNAB never gets the same transaction twice.
+"""
+
+import csv
+import hashlib
+import json
+import os
+
+
+class FilePlan:
+    """ What is left to convert of one input file """
+
+    def __init__(self, digest, fingerprints, skip):
+        self.digest = digest
+        self.fingerprints = fingerprints
+        # Indexes of the data rows (header not counted) that were converted before
+        self.skip = skip
+
+
+class Manifest:
+
+    filename = '.ingtoynab-manifest.json'
+
+    def __init__(self, output_path):
+        self.path = os.path.join(output_path, self.filename)
+        self.files = {}
+        self.rows = set()
+        # Fingerprints of files prepared in this run, so overlapping files in one run are deduplicated as well
+        self.pending = set()
+
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+
+        self.files = data['files']
+        self.rows = set(data['rows'])
+
+    @staticmethod
+    def fileHash(filename):
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as inputfile:
+            for block in iter(lambda: inputfile.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def fingerprints(filename):
+        # One fingerprint per data row. Identical rows (two coffees on one day) are numbered, so they stay distinct
+        result = []
+        counts = {}
+        with open(filename, newline='') as inputfile:
+            csvreader = csv.reader(inputfile)
+            next(csvreader, None)
+            for row in csvreader:
+                base = hashlib.blake2b('\x1f'.join(row).encode('utf-8'), digest_size=8).hexdigest()
+                count = counts.get(base, 0)
+                counts[base] = count + 1
+                result.append(base if count == 0 else base + ':' + str(count))
+        return result
+
+    def prepare(self, filename):
+        """ Returns the FilePlan of a file, or None when exactly this file was converted before """
+        digest = self.fileHash(filename)
+        if digest in self.files:
+            return None
+
+        fingerprints = self.fingerprints(filename)
+        skip = set()
+        for index, fingerprint in enumerate(fingerprints):
+            if fingerprint in self.rows or fingerprint in self.pending:
+                skip.add(index)
+            else:
+                self.pending.add(fingerprint)
+
+        return FilePlan(digest, fingerprints, skip)
+
+    def commit(self, filename, plan, written):
+        # Called once a file has been converted completely
+        self.files[plan.digest] = {'name': os.path.basename(str(filename)), 'rows': len(plan.fingerprints),
+                                   'written': written}
+        self.rows.update(plan.fingerprints)
+
+    def save(self):
+        # Temporary file plus atomic rename, an interrupted save keeps the previous manifest
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'files': self.files, 'rows': sorted(self.rows)}, f)
+        os.replace(temporary, self.path)
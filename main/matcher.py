@@ -0,0 +1,337 @@
+""" Matching of payees and memos against the rules of all categories
+
+The rules are compiled once per version of the database. Most entries are plain names, they are matched as
+case-insensitive substrings by one Aho-Corasick automaton, in a single pass over the text. Only entries that really
+are regular expressions go through the regex engine.
+
+Entries that are not valid regular expressions, or that can backtrack catastrophically, are rejected with a warning
+when the rules are compiled, instead of failing in the middle of a run. Catastrophic backtracking needs a repeated
+group that can match the same text in more than one way, so every group that is repeated (+, *, {2,}, {20}) and
+contains a quantifier of variable length or an alternation is rejected: (a+)+, ((a+))+, (a|aa)+, (a+){20}. The
+parsed pattern is checked, not the text of the entry. A regex that still takes longer than the time budget on some
+text is disabled for the rest of the run.
+
+Every entry is a rule with a number, in database order, so the lowest matching rule number is also in the first
+matching category. match returns that number, which says which entry decided the category, and the hits of every
+rule are counted (see hits.py).
+"""
+
+import logging
+import re
+import sys
+import time
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    # Before Python 3.11
+    import sre_parse
+
+logger = logging.getLogger(__name__)
+
+METACHARACTERS = frozenset('.^$*+?{}[]|()\\')
+
+REPEATS = ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+
+NOTHING = sys.maxsize
+
+# Rejected entries are reported once per run, not every time the rules are compiled again
+reported = set()
+
+
+def literalText(entry):
+    """ The text a plain entry matches, or None when the entry is a regular expression.
+    Escaped punctuation (BOL\\.COM) is still plain text.
+    """
+    chars = []
+    escaped = False
+    for char in entry:
+        if escaped:
+            if char.isalnum() or char == '_':
+                # \d, \w, \b, \1 ..
+                return None
+            chars.append(char)
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char in METACHARACTERS:
+            return None
+        else:
+            chars.append(char)
+
+    if escaped:
+        return None
+    return ''.join(chars)
+
+
+def escape(text):
+    # Entry that matches text literally, only regex characters are escaped so the entry stays readable
+    return ''.join('\\' + char if char in METACHARACTERS else char for char in text)
+
+
+def checkEntry(entry):
+    """ Reason why a payee or memo entry cannot be used, or None when it is fine """
+    if not entry:
+        return 'the entry is empty and would match everything'
+
+    if literalText(entry) is not None:
+        return None
+
+    try:
+        re.compile(entry, re.IGNORECASE)
+    except re.error as error:
+        return 'invalid regular expression (' + str(error) + ')'
+
+    if nestedQuantifier(sre_parse.parse(entry, re.IGNORECASE)):
+        return 'nested quantifiers can make matching take forever'
+
+    return None
+
+
+def parts(value):
+    # The parsed subpatterns in the argument of a node of a parsed pattern
+    if isinstance(value, sre_parse.SubPattern):
+        yield value
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            yield from parts(item)
+
+
+def ambiguous(pattern):
+    # Whether a parsed pattern has a quantifier of variable length or an alternation
+    for op, value in pattern:
+        if str(op) in REPEATS and value[0] != value[1] or str(op) == 'BRANCH':
+            return True
+        if any(ambiguous(part) for part in parts(value)):
+            return True
+    return False
+
+
+def nestedQuantifier(pattern):
+    # Whether a parsed pattern repeats a group that can match the same text in more than one way
+    for op, value in pattern:
+        if str(op) in REPEATS and value[1] > 1 and ambiguous(value[2]):
+            return True
+        if any(nestedQuantifier(part) for part in parts(value)):
+            return True
+    return False
+
+
+class Automaton:
+    """ Aho-Corasick automaton over the plain entries, finds the lowest rule number of the entries in a text """
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [NOTHING]
+
+    def add(self, literal, rule):
+        state = 0
+        for char in literal:
+            following = self.goto[state].get(char)
+            if following is None:
+                following = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(NOTHING)
+                self.goto[state][char] = following
+            state = following
+        self.output[state] = min(self.output[state], rule)
+
+    def build(self):
+        # Breadth first, the fail state of a state is always closer to the root. Every state also reports the
+        # entries that end in its fail states, so search only has to look at the current state.
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, following in self.goto[state].items():
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[following] = self.goto[fail].get(char, 0)
+                self.output[following] = min(self.output[following], self.output[self.fail[following]])
+                queue.append(following)
+
+    def search(self, text):
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+
+        best = NOTHING
+        state = 0
+        for char in text:
+            while True:
+                following = goto[state].get(char)
+                if following is not None:
+                    state = following
+                    break
+                if state == 0:
+                    break
+                state = fail[state]
+
+            if output[state] < best:
+                best = output[state]
+        return best
+
+
+class Matcher:
+    """ Checks a payee or memo against the rules of all categories in one pass, the first matching category wins.
+
+    Plain entries are found by the automaton. The regular expressions of each category become a lookahead in a
+    single alternation, in database order, anchored at the start of the text so the first category that matches
+    anywhere wins. The entry that matched is then looked for in that category only, a named group per entry would
+    make every step of the search save all the groups. The result is the lower of the two rule numbers.
+    """
+
+    # Seconds a single regex match may take before the slow entries are disabled
+    budget = 0.05
+
+    def __init__(self, categories, field):
+        self.field = field
+        self.labels = []
+        # (category index, entry) of every rule, numbered in database order
+        self.rules = []
+        # (label, entry, reason) of the entries that are not used
+        self.rejected = []
+        self.automaton = Automaton()
+        # (category index, [(rule, entry)]) of the categories that have regular expressions
+        self.patterns = []
+        self.regex = None
+        self.fallback = []
+
+        for x in categories:
+            index = len(self.labels)
+            self.labels.append(x['Master Category'] + ': ' + x['Category'])
+
+            entries = []
+            for entry in x[field]:
+                if not entry:
+                    # Left out, it would match everything
+                    continue
+
+                rule = len(self.rules)
+                self.rules.append((index, entry))
+                literal = literalText(entry)
+                if literal is not None:
+                    self.automaton.add(literal.lower(), rule)
+                    continue
+
+                reason = checkEntry(entry)
+                if reason is not None:
+                    self.reject(index, entry, reason)
+                else:
+                    entries.append((rule, entry))
+
+            if entries:
+                self.patterns.append((index, entries))
+
+        # The number match returns when no rule matches, it has the label ''
+        self.nothing = len(self.rules)
+        self.ruleLabels = [self.labels[index] for index, entry in self.rules] + ['']
+        # Hits per rule, and of nothing
+        self.hits = [0] * (len(self.rules) + 1)
+
+        self.automaton.build()
+        self.compile()
+
+    def reject(self, index, entry, reason):
+        self.rejected.append((self.labels[index], entry, reason))
+        if (self.field, self.labels[index], entry) not in reported:
+            reported.add((self.field, self.labels[index], entry))
+            logger.warning(self.field[:-1] + ' rule ' + repr(entry) + ' of ' + self.labels[index] + ' is not used: '
+                           + reason + '.')
+
+    def compile(self):
+        self.regex = None
+        self.fallback = []
+        # Rules before this one can only be found by the automaton
+        self.first = self.patterns[0][1][0][0] if self.patterns else NOTHING
+        # (rule, compiled entry) per category in self.patterns, to find the entry that matched
+        self.compiled = [[(rule, re.compile(entry, re.IGNORECASE)) for rule, entry in entries]
+                         for index, entries in self.patterns]
+
+        parts = []
+        for position, (index, entries) in enumerate(self.patterns):
+            parts.append('(?=(?s:.*?)(?P<_c' + str(position) + '>' + '|'.join(entry for rule, entry in entries) + '))')
+
+        # Numbered backreferences would point to the wrong group once everything is combined
+        if parts and not any(re.search(r'\\[1-9]', entry) for index, entries in self.patterns
+                             for rule, entry in entries):
+            try:
+                self.regex = re.compile('|'.join(parts), re.IGNORECASE)
+            except re.error:
+                self.regex = None
+
+        if self.regex is None:
+            # Compile every category on its own, still only once per database version
+            self.fallback = [(re.compile('|'.join(entry for rule, entry in entries), re.IGNORECASE), position)
+                             for position, (index, entries) in enumerate(self.patterns)]
+
+    def search(self, text):
+        # Return 'Master Category: Category' of the first matching category, or '' when nothing matches
+        return self.ruleLabels[self.match(text)]
+
+    def found(self, rules):
+        # Labels of rules returned by match, every one is counted as a hit of its rule
+        hits = self.hits
+        for rule in rules:
+            hits[rule] += 1
+        labels = self.ruleLabels
+        return [labels[rule] for rule in rules]
+
+    def match(self, text):
+        # Number of the first matching rule, or self.nothing
+        best = self.automaton.search(text.lower())
+
+        if self.first < best:
+            started = time.perf_counter()
+            index = self.searchRegexes(text)
+            elapsed = time.perf_counter() - started
+            best = min(best, index)
+
+            if elapsed > self.budget:
+                self.disableSlow(text, elapsed)
+
+        if best == NOTHING:
+            return self.nothing
+        return best
+
+    def searchRegexes(self, text):
+        if self.regex is not None:
+            result = self.regex.match(text)
+            if result:
+                return self.matchedRule(int(result.lastgroup[2:]), text)
+            return NOTHING
+
+        for regex, position in self.fallback:
+            if regex.search(text):
+                return self.matchedRule(position, text)
+        return NOTHING
+
+    def matchedRule(self, position, text):
+        # The first entry of the category at position in self.patterns that matches text
+        entries = self.compiled[position]
+        for rule, regex in entries:
+            if regex.search(text):
+                return rule
+        return entries[0][0]
+
+    def disableSlow(self, text, elapsed):
+        # Find the entries that are too slow on this text on their own, and leave them out from now on
+        patterns = []
+        for (index, entries), compiled in zip(self.patterns, self.compiled):
+            kept = []
+            for (rule, entry), (rule, regex) in zip(entries, compiled):
+                started = time.perf_counter()
+                regex.search(text)
+                if time.perf_counter() - started > self.budget:
+                    self.reject(index, entry, 'matching took longer than %.0f ms on %r' % (self.budget * 1000, text))
+                else:
+                    kept.append((rule, entry))
+            if kept:
+                patterns.append((index, kept))
+
+        if patterns != self.patterns:
+            self.patterns = patterns
+            self.compile()
+        else:
+            logger.warning('Matching ' + repr(text) + ' took ' + '%.0f ms.' % (elapsed * 1000))
@@ -0,0 +1,187 @@
+""" Merged output, one date-sorted file without duplicates from many overlapping exports
+
+Back-filling years of history means many exports that overlap each other. mergeFiles classifies the transactions of
+all files, sorts them into runs of at most run_rows transactions and merges the runs with heapq.merge into one YNAB
+file in date order. Runs are written to temporary files, only one run is in memory at a time, so memory stays
+bounded however much history goes in.
+
+Overlapping exports contain the same transactions, those are written once. Identical transactions within one export
+(two coffees on the same day) are real and are all kept: of a group of identical transactions, the largest number
+found in any single export is written. The category is not part of what makes transactions identical, a rule added
+while merging can categorize a later copy; the category of the newest categorized copy is written.
+"""
+
+import csv
+import heapq
+import itertools
+import logging
+import os
+import pickle
+import tempfile
+from contextlib import ExitStack, closing
+
+from checkpoint import finishParts, partName
+from convert import HEADER, checkCancel, classifyBatches, formatAmount, parseBatches, readRows, reportProgress
+from main import Database, formatOrdinal
+
+logger = logging.getLogger(__name__)
+
+# Runs are merged at most this many at a time, more runs are first merged into longer runs
+FAN_IN = 64
+# Transactions per pickled batch in a run file, at most FAN_IN batches are in memory while merging
+BATCH = 256
+
+
+def records(filename, source, resolve=None, skip=None, cancel=None, progress=None):
+    # (day number, payee, memo, debit, amount, account, category, source) of every transaction of a file.
+    # Everything before category is the content that makes two transactions duplicates.
+    with closing(readRows(filename)) as rows:
+        pipeline = rows
+        if progress is not None:
+            pipeline = reportProgress(pipeline, progress)
+        if cancel is not None:
+            pipeline = checkCancel(pipeline, cancel)
+        for batch, categories in classifyBatches(parseBatches(pipeline, skip), resolve):
+            for index, category in enumerate(categories):
+                if category is not None:
+                    yield (batch.dates[index], batch.payees[index], batch.memos[index], batch.debits[index],
+                           batch.amounts[index], batch.accounts[index], category, source)
+
+
+def spill(run, directory):
+    # Write a sorted run to a temporary file, in batches so reading it back needs little memory
+    handle, filename = tempfile.mkstemp(suffix='.run', dir=directory)
+    with os.fdopen(handle, 'wb') as f:
+        for start in range(0, len(run), BATCH):
+            pickle.dump(run[start:start + BATCH], f, pickle.HIGHEST_PROTOCOL)
+    return filename
+
+
+def readRun(filename):
+    with open(filename, 'rb') as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
+
+
+def mergeRuns(filenames, directory):
+    # Merge runs into one longer run until there are few enough to merge them all at once
+    while len(filenames) > FAN_IN:
+        merged = []
+        for start in range(0, len(filenames), FAN_IN):
+            group = filenames[start:start + FAN_IN]
+            handle, filename = tempfile.mkstemp(suffix='.run', dir=directory)
+            with os.fdopen(handle, 'wb') as f:
+                batch = []
+                for record in heapq.merge(*[readRun(run) for run in group]):
+                    batch.append(record)
+                    if len(batch) == BATCH:
+                        pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+                        batch = []
+                if batch:
+                    pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+            for run in group:
+                os.remove(run)
+            merged.append(filename)
+        filenames = merged
+    return filenames
+
+
+def deduplicate(stream):
+    # The stream is sorted, so identical transactions are next to each other. Yields the content and category
+    for content, group in itertools.groupby(stream, key=lambda record: record[:-2]):
+        counts = {}
+        category = ''
+        newest = -1
+        for record in group:
+            source = record[-1]
+            counts[source] = counts.get(source, 0) + 1
+            if record[-2] and source > newest:
+                category = record[-2]
+                newest = source
+        for _ in range(max(counts.values())):
+            yield content + (category,)
+
+
+def outputRow(record):
+    date, payee, memo, debit, amount, account, category = record
+    amount = formatAmount(amount)
+    date = formatOrdinal(date)
+    if debit:
+        return [date, payee, category, memo, amount, '']
+    else:
+        return [date, payee, category, memo, '', amount]
+
+
+def mergeFiles(filenames, outputfile, uncategorized=None, resolve=None, skips=None, cancel=None, progress=None,
+               run_rows=50000, directory=None):
+    """ Convert all files into one date-sorted outputfile without duplicates.
+
+    Without resolve, transactions without a category go to the uncategorized file (if given).
+    skips maps a filename to the indexes of rows to leave out (see manifest.py), directory is where runs are kept.
+    progress is called with the number of rows read from all files so far, cancel is checked between rows.
+    Returns the number of categorized and uncategorized rows written and the number of duplicates left out.
+    """
+    written = 0
+    unknown = 0
+    unique = 0
+
+    with tempfile.TemporaryDirectory(prefix='ingtoynab-merge-', dir=directory) as directory:
+        runs = []
+        run = []
+        # Rows read from the previous files and from the current file
+        done = 0
+        current = 0
+
+        def counted(count):
+            nonlocal current
+            current = count
+            progress(done + count)
+
+        for source, filename in enumerate(filenames):
+            skip = skips.get(filename) if skips else None
+            current = 0
+            for record in records(filename, source, resolve, skip, cancel, counted if progress else None):
+                run.append(record)
+                if len(run) >= run_rows:
+                    run.sort()
+                    runs.append(spill(run, directory))
+                    run = []
+            done = done + current
+
+        total = len(run) + len(runs) * run_rows
+        logger.info('Sorted ' + str(total) + ' transactions into ' + str(len(runs) + 1) + ' run(s).')
+
+        # The last run stays in memory
+        run.sort()
+        runs = mergeRuns(runs, directory)
+
+        # Written as .part files, renamed when the merge is complete
+        parts = [partName(outputfile)]
+        with ExitStack() as stack:
+            output = csv.writer(stack.enter_context(open(parts[0], 'w', newline='')))
+            output.writerow(HEADER)
+            uncategorizedwriter = None
+
+            streams = [stack.enter_context(closing(readRun(filename))) for filename in runs]
+            for record in deduplicate(heapq.merge(run, *streams)):
+                unique = unique + 1
+                if record[-1]:
+                    output.writerow(outputRow(record))
+                    written = written + 1
+                elif uncategorized is not None:
+                    if uncategorizedwriter is None:
+                        parts.append(partName(uncategorized))
+                        uncategorizedwriter = csv.writer(stack.enter_context(open(parts[-1], 'w', newline='')))
+                        uncategorizedwriter.writerow(HEADER)
+                    uncategorizedwriter.writerow(outputRow(record))
+                    unknown = unknown + 1
+
+        finishParts(parts)
+
+    Database().saveResults()
+
+    return written, unknown, total - unique
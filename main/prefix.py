@@ -0,0 +1,100 @@
+""" Prefix index of the category database, for type-ahead search in the manage tab
+
+Every payee and memo entry is stored under its text and under the rest of the text from every word on, so 'heij'
+finds 'ALBERT HEIJN 1234'. Category names are stored the same way. The keys are kept in one sorted list, a prefix
+is the range of keys between bisect_left(prefix) and bisect_left(prefix + the highest character). Typing one more
+letter narrows the range of the previous search instead of searching the whole list again.
+
+Entries are added and removed one at a time with insort and del, so an edit does not rebuild the index.
+"""
+
+import re
+from bisect import bisect_left, insort
+
+from matcher import literalText
+
+WORD_START = re.compile(r'\b\w')
+
+# Above every character that can be in a key
+HIGHEST = '\U0010ffff'
+
+
+def keys(text):
+    # The lowercase text from its start and from every word start on
+    text = text.lower()
+    result = {text}
+    for match in WORD_START.finditer(text):
+        result.add(text[match.start():])
+    return result
+
+
+def entryText(entry):
+    # Plain entries are searched for the text they match, BOL\.COM for bol.com
+    text = literalText(entry)
+    return entry if text is None else text
+
+
+class PrefixIndex:
+
+    def __init__(self, data):
+        # (key, category position, field, entry), field and entry are '' for the category itself
+        self.items = []
+        # The last search (prefix, start, end), a longer prefix is searched within its range
+        self.last = None
+
+        for position, x in enumerate(data['categories']):
+            for key in keys(x['Master Category'] + ': ' + x['Category']):
+                self.items.append((key, position, '', ''))
+            for field in ('Payees', 'Memos'):
+                for entry in x[field]:
+                    for key in keys(entryText(entry)):
+                        self.items.append((key, position, field, entry))
+        self.items.sort()
+
+    def __len__(self):
+        return len(self.items)
+
+    def addCategory(self, position, master, category):
+        for key in keys(master + ': ' + category):
+            insort(self.items, (key, position, '', ''))
+        self.last = None
+
+    def add(self, position, field, entry):
+        for key in keys(entryText(entry)):
+            insort(self.items, (key, position, field, entry))
+        self.last = None
+
+    def remove(self, position, field, entry):
+        for key in keys(entryText(entry)):
+            item = (key, position, field, entry)
+            index = bisect_left(self.items, item)
+            if index < len(self.items) and self.items[index] == item:
+                del self.items[index]
+        self.last = None
+
+    def span(self, prefix):
+        # start and end of the keys that start with prefix
+        start, end = 0, len(self.items)
+        if self.last is not None and prefix.startswith(self.last[0]):
+            start, end = self.last[1:]
+
+        start = bisect_left(self.items, (prefix,), start, end)
+        end = bisect_left(self.items, (prefix + HIGHEST,), start, end)
+        self.last = (prefix, start, end)
+        return start, end
+
+    def search(self, prefix, limit=200):
+        """ (position, field, entry) of the categories and entries with a word that starts with prefix, at most
+        limit of them, and whether there are more
+        """
+        start, end = self.span(prefix.lower())
+
+        found = {}
+        for index in range(start, end):
+            key, position, field, entry = self.items[index]
+            if (position, field, entry) not in found:
+                if len(found) == limit:
+                    return list(found), True
+                found[(position, field, entry)] = True
+
+        return list(found), False
@@ -0,0 +1,320 @@
+""" Bulk import of payee and memo rules
+
+        python cli.py import <file> [<file> ...] [--database database.json] [--dry-run] [--conflicts conflicts.csv]
+
+Thousands of rules are merged into the category database at once, and the database is written once, instead of
+adding them one by one through the dialog. Rules can come from:
+
+    a CSV of rules      columns Master Category, Category, Payee and/or Memo. Without a Master Category column,
+                        Category can be 'Master Category: Category'
+    a YNAB register     a register export of YNAB 4 (Master Category, Sub Category) or of the new YNAB (Category
+                        Group, Category). Every payee becomes a rule for the category it was used with most often
+    a database          another database.json or database.sqlite, all of its entries
+
+Entries are compared case-insensitively, like they are matched. An entry that is already in its category is counted
+as a duplicate. An entry that is already in another category is a conflict, the existing category is kept (it would
+win anyway, the first matching category wins) and the conflict is reported.
+
+The rule set is also checked here, for the rules and prune commands of cli.py:
+
+    covered     entries that can never decide the category, because every text they match is matched by an entry
+                earlier on (coveredEntries). Removing them changes nothing
+    dead        entries that have not matched anything since they were first counted (see hits.py)
+    invalid     entries that are never used, see matcher.checkEntry
+"""
+
+import csv
+import os
+import re
+from collections import Counter
+
+from matcher import NOTHING, Automaton, Matcher, checkEntry, escape, literalText
+from storage import openStorage
+
+FIELDS = (('Payees', 'Payee'), ('Memos', 'Memo'))
+
+
+class ImportReport:
+    """ Outcome of importing rules """
+
+    def __init__(self):
+        self.added = 0
+        self.duplicates = 0
+        self.categories = 0
+        # (field, entry, category it is in, category it was imported for)
+        self.conflicts = []
+        # (rule, reason) of the rules that were left out
+        self.invalid = []
+
+    def summary(self):
+        return (str(self.added) + ' entries added, ' + str(self.categories) + ' new categories, '
+                + str(self.duplicates) + ' duplicates, ' + str(len(self.conflicts)) + ' conflicts, '
+                + str(len(self.invalid)) + ' invalid.')
+
+
+def entryKey(field, entry):
+    # Plain entries match their text case-insensitively, BOL\.COM and bol.com are the same entry
+    literal = literalText(entry)
+    if literal is not None:
+        return field, 'text', literal.lower()
+    return field, 'regex', entry.lower()
+
+
+def label(master, category):
+    return master + ': ' + category
+
+
+def mergeRules(data, rules):
+    """ Add rules ({'Master Category', 'Category', 'Payee', 'Memo'}) to the document data. Returns an ImportReport """
+    report = ImportReport()
+
+    positions = {}
+    owners = {}
+    for position, x in enumerate(data['categories']):
+        positions.setdefault((x['Master Category'].strip().lower(), x['Category'].strip().lower()), position)
+        for field, key in FIELDS:
+            for entry in x[field]:
+                owners.setdefault(entryKey(field, entry), position)
+
+    for rule in rules:
+        master = rule.get('Master Category', '').strip()
+        category = rule.get('Category', '').strip()
+        if not master or not category:
+            report.invalid.append((rule, 'master category or category is empty'))
+            continue
+
+        entries = [(field, rule.get(key, '')) for field, key in FIELDS if rule.get(key, '')]
+        if not entries:
+            report.invalid.append((rule, 'no payee or memo'))
+            continue
+
+        reasons = [checkEntry(entry) for field, entry in entries]
+        if any(reasons):
+            report.invalid.append((rule, next(reason for reason in reasons if reason)))
+            continue
+
+        position = positions.get((master.lower(), category.lower()))
+        for field, entry in entries:
+            owner = owners.get(entryKey(field, entry))
+            if owner is not None:
+                if owner == position:
+                    report.duplicates = report.duplicates + 1
+                else:
+                    x = data['categories'][owner]
+                    report.conflicts.append((field[:-1], entry, label(x['Master Category'], x['Category']),
+                                             label(master, category)))
+                continue
+
+            if position is None:
+                position = positions[(master.lower(), category.lower())] = len(data['categories'])
+                data['categories'].append({'Category': category, 'Master Category': master,
+                                           'Memos': [], 'Payees': []})
+                report.categories = report.categories + 1
+
+            data['categories'][position][field].append(entry)
+            owners[entryKey(field, entry)] = position
+            report.added = report.added + 1
+
+    return report
+
+
+def readRuleCsv(filename):
+    # Rules from a CSV with the columns Master Category, Category, Payee and Memo (any order, any case)
+    with open(filename, newline='', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            row = {(name or '').strip().lower(): (value or '').strip() for name, value in row.items()}
+            master = row.get('master category', '')
+            category = row.get('category', '')
+            if not master and ': ' in category:
+                master, category = category.split(': ', 1)
+            yield {'Master Category': master, 'Category': category, 'Payee': row.get('payee', ''),
+                   'Memo': row.get('memo', '')}
+
+
+def readRegister(filename, report=None):
+    """ Payee rules from a YNAB register export, every payee for the category it was used with most often.
+    Payees that were used with several categories are added to report.conflicts.
+    """
+    usage = {}
+    with open(filename, newline='', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            row = {(name or '').strip().lower(): (value or '').strip() for name, value in row.items()}
+            if 'sub category' in row:
+                master, category = row.get('master category', ''), row['sub category']
+            else:
+                master, category = row.get('category group', ''), row.get('category', '')
+
+            payee = row.get('payee', '')
+            # Transfers and income (Inflow / To be Budgeted) say nothing about a spending category
+            if not payee or not master or not category or payee.startswith('Transfer :') \
+                    or master.lower() in ('inflow', 'income'):
+                continue
+            usage.setdefault(payee, Counter())[(master, category)] += 1
+
+    for payee, counts in usage.items():
+        ranked = counts.most_common()
+        (master, category), _ = ranked[0]
+        if report is not None:
+            for other, _ in ranked[1:]:
+                report.conflicts.append(('Payee', payee, label(master, category), label(*other)))
+        # The register has the payee names as they are, not as regular expressions
+        yield {'Master Category': master, 'Category': category, 'Payee': escape(payee), 'Memo': ''}
+
+
+def readDatabase(filename):
+    # Every entry of another category database
+    for x in openStorage(filename).load()['categories']:
+        for field, key in FIELDS:
+            for entry in x[field]:
+                rule = {'Master Category': x['Master Category'], 'Category': x['Category'], 'Payee': '', 'Memo': ''}
+                rule[key] = entry
+                yield rule
+
+
+def isRegister(filename):
+    with open(filename, newline='', encoding='utf-8-sig') as f:
+        header = [name.strip().lower() for name in next(csv.reader(f), [])]
+    return 'payee' in header and ('sub category' in header or 'category group' in header)
+
+
+def readRules(filename, report=None):
+    # Rules from a file of any of the supported kinds, picked from the extension and the header
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in ('.json', '.sqlite', '.sqlite3', '.db'):
+        return readDatabase(filename)
+    if isRegister(filename):
+        return readRegister(filename, report)
+    return readRuleCsv(filename)
+
+
+def saveConflicts(filename, report):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Field', 'Entry', 'Kept in', 'Imported for'])
+        writer.writerows(report.conflicts)
+
+
+# Anchors, word boundaries and lookarounds make a match depend on the text around it
+CONTEXT = re.compile(r'\^|\$|\\[bBAZ]|\(\?<?[=!]')
+
+
+def coveredEntries(data, field):
+    """ Entries of field ('Payees' or 'Memos') that never decide the category, as (position, entry, position of the
+    covering entry, covering entry).
+
+    A plain entry is covered by a plain entry it contains, in an earlier category or in its own (every text with
+    'ALDI 12' also has 'ALDI'), and by a regular expression of an earlier category that matches it without looking at
+    the text around it (no anchors, word boundaries or lookarounds). A regular expression is only covered by the same
+    expression earlier on.
+    """
+    # (position, entry, plain text or None), numbered like the rules of a Matcher
+    rules = []
+    automaton = Automaton()
+    first = {}
+    independent = []
+    for position, x in enumerate(data['categories']):
+        regexes = []
+        for entry in x[field]:
+            if not entry:
+                continue
+            literal = literalText(entry)
+            rule = len(rules)
+            rules.append((position, entry, literal))
+            if literal is not None:
+                automaton.add(literal.lower(), rule)
+                first.setdefault(('text', literal.lower()), rule)
+            elif checkEntry(entry) is None:
+                first.setdefault(('regex', entry.lower()), rule)
+                if not CONTEXT.search(entry):
+                    regexes.append(entry)
+        independent.append({'Master Category': '', 'Category': '', field: regexes})
+    automaton.build()
+    # The first category whose regular expressions match a text, in one search
+    matcher = Matcher(independent, field)
+
+    covered = []
+    for rule, (position, entry, literal) in enumerate(rules):
+        if literal is None:
+            earlier = first.get(('regex', entry.lower()), rule)
+            if earlier < rule:
+                covered.append((position, entry, rules[earlier][0], rules[earlier][1]))
+            continue
+
+        text = literal.lower()
+        earlier = first[('text', text)]
+        if earlier == rule:
+            # Every shorter entry in the text is in the text without its first or without its last character
+            earlier = min(automaton.search(text[1:]), automaton.search(text[:-1]))
+        if earlier != NOTHING and rules[earlier][0] <= position:
+            covered.append((position, entry, rules[earlier][0], rules[earlier][1]))
+            continue
+
+        found = matcher.match(literal)
+        if found != matcher.nothing and matcher.rules[found][0] < position:
+            covered.append((position, entry) + matcher.rules[found])
+
+    return covered
+
+
+def invalidEntries(data):
+    # (position, field, entry, reason) of the entries the matcher leaves out
+    invalid = []
+    for position, x in enumerate(data['categories']):
+        for field, key in FIELDS:
+            for entry in x[field]:
+                reason = checkEntry(entry)
+                if reason is not None:
+                    invalid.append((position, field, entry, reason))
+    return invalid
+
+
+def countedEntries(data, counts):
+    # (hits, first counted, last hit, position, field, entry) of the entries of data that are counted (see hits.py)
+    counted = []
+    for position, x in enumerate(data['categories']):
+        name = label(x['Master Category'], x['Category'])
+        for field, key in FIELDS:
+            for entry in x[field]:
+                count = counts.get((field, name, entry))
+                if count is not None:
+                    counted.append(count + (position, field, entry))
+    return counted
+
+
+def deadEntries(data, counts, before):
+    # (position, field, entry) of the entries that were counted since before (an ISO date) and never matched
+    return [(position, field, entry) for hits, since, last, position, field, entry in countedEntries(data, counts)
+            if hits == 0 and since <= before]
+
+
+def pruneEntries(data, counts, before):
+    """ (position, field, entry, reason) of the entries that can be removed: invalid and covered entries, which are
+    never used, and entries that did not match anything since before
+    """
+    prune = {}
+    for position, field, entry, reason in invalidEntries(data):
+        prune.setdefault((position, field, entry), 'not used: ' + reason)
+    for field, key in FIELDS:
+        for position, entry, other, covering in coveredEntries(data, field):
+            x = data['categories'][other]
+            prune.setdefault((position, field, entry), 'covered by ' + covering + ' of '
+                             + label(x['Master Category'], x['Category']))
+    for position, field, entry in deadEntries(data, counts, before):
+        prune.setdefault((position, field, entry), 'never matched')
+    # In database order, imported again the earlier category keeps an entry that is in two
+    return sorted((key + (reason,) for key, reason in prune.items()), key=lambda item: item[:2])
+
+
+def saveRules(filename, data, entries):
+    # Append (position, field, entry, ..) entries as a rule CSV, cli.py import adds them again
+    new = not os.path.exists(filename)
+    with open(filename, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if new:
+            writer.writerow(['Master Category', 'Category', 'Payee', 'Memo'])
+        for position, field, entry in (item[:3] for item in entries):
+            x = data['categories'][position]
+            if field == 'Payees':
+                writer.writerow([x['Master Category'], x['Category'], entry, ''])
+            else:
+                writer.writerow([x['Master Category'], x['Category'], '', entry])
@@ -0,0 +1,159 @@
+""" Output split per account
+
+An ING export can contain the transactions of several accounts (the Rekening column), while YNAB imports one file per
+account. ShardedWriter routes every row to <output>-<account>.csv. Rows are buffered per account and written in
+batches, and only a limited number of files is kept open, so an export with hundreds of accounts does not run out
+of file handles. Optionally the batches are written by a background thread while the conversion continues.
+
+The files are written as <output>-<account>.csv.part, see checkpoint.py. Accounts that give the same file name
+('NL01 INGB' and 'NL01-INGB') share that file.
+"""
+
+import csv
+import os
+import re
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from checkpoint import partName
+
+
+def accountName(account):
+    # Safe part of a file name, 'NL01 INGB 0001234567' -> 'NL01_INGB_0001234567'
+    name = re.sub(r'[^A-Za-z0-9]+', '_', account).strip('_')
+    return name or 'unknown'
+
+
+class Shard:
+    """ Buffered rows and the (possibly closed) output file of one account """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.rows = []
+        self.file = None
+        self.writer = None
+        self.created = False
+        self.count = 0
+
+
+class ShardedWriter:
+
+    def __init__(self, outputfile, header, max_open=16, buffer_rows=500, background=False, sizes=None):
+        directory, name = os.path.split(str(outputfile))
+        stem, extension = os.path.splitext(name)
+        # Every file name is prefix + accountName(account) + suffix
+        self.prefix = os.path.join(directory, stem + '-')
+        self.suffix = partName(extension or '.csv')
+        self.header = header
+        self.max_open = max_open
+        self.buffer_rows = buffer_rows
+        # account -> shard, and file name -> shard
+        self.shards = {}
+        self.names = {}
+        # Shards with an open file, least recently written first. Only used by the thread that writes.
+        self.open = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=1) if background else None
+        self.futures = deque()
+
+        # Files of a stopped conversion that is continued, cut back to their size at the checkpoint
+        self.resumed = {}
+        for filename, size in (sizes or {}).items():
+            if filename.startswith(self.prefix) and filename.endswith(self.suffix):
+                os.truncate(filename, size)
+                self.resumed[filename] = size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def writerow(self, row, account):
+        shard = self.shards.get(account)
+        if shard is None:
+            filename = self.prefix + accountName(account) + self.suffix
+            shard = self.names.get(filename)
+            if shard is None:
+                shard = self.names[filename] = Shard(filename)
+                # Appended to, without a second header
+                shard.created = filename in self.resumed
+            self.shards[account] = shard
+
+        shard.rows.append(row)
+        shard.count = shard.count + 1
+        if len(shard.rows) >= self.buffer_rows:
+            self.flush(shard)
+
+    def writerows(self, rows, accounts):
+        for row, account in zip(rows, accounts):
+            self.writerow(row, account)
+
+    def flush(self, shard):
+        rows = shard.rows
+        shard.rows = []
+        if self.executor is None:
+            self.write(shard, rows)
+            return
+
+        # One background thread writes the batches in order, errors are raised here on a later flush or in close
+        self.futures.append(self.executor.submit(self.write, shard, rows))
+        while self.futures and self.futures[0].done():
+            self.futures.popleft().result()
+
+    def write(self, shard, rows):
+        if shard.file is None:
+            while len(self.open) >= self.max_open:
+                _, oldest = self.open.popitem(last=False)
+                oldest.file.close()
+                oldest.file = None
+
+            # The first batch creates the file, later batches of a shard that was closed in between are appended
+            shard.file = open(shard.filename, 'a' if shard.created else 'w', newline='')
+            shard.writer = csv.writer(shard.file)
+            if not shard.created:
+                shard.writer.writerow(self.header)
+                shard.created = True
+            self.open[shard.filename] = shard
+        else:
+            self.open.move_to_end(shard.filename)
+
+        shard.writer.writerows(rows)
+
+    def sizes(self):
+        # Write everything that is buffered and return the size of every file, for a checkpoint
+        for shard in self.names.values():
+            if shard.rows:
+                self.flush(shard)
+        while self.futures:
+            self.futures.popleft().result()
+        for shard in self.open.values():
+            shard.file.flush()
+        return {filename: os.path.getsize(filename) for filename in self.parts()}
+
+    def parts(self):
+        # Every file that was written, also by the conversion that is continued
+        filenames = set(self.resumed)
+        filenames.update(shard.filename for shard in self.names.values() if shard.created)
+        return sorted(filenames)
+
+    def close(self):
+        # Write what is still buffered and close every file
+        try:
+            for shard in self.names.values():
+                if shard.rows:
+                    self.flush(shard)
+
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                while self.futures:
+                    self.futures.popleft().result()
+        finally:
+            while self.open:
+                _, shard = self.open.popitem()
+                shard.file.close()
+                shard.file = None
+
+    def files(self):
+        # Output file and number of rows per account, accounts that share a file have the rows of both
+        return {account: (shard.filename, shard.count) for account, shard in self.shards.items()}
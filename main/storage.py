@@ -0,0 +1,282 @@
+""" Storage backends for the category database
+
+The Database index in main.py works on one document, {'categories': [{'Master Category', 'Category', 'Payees', 'Memos'}]},
+and leaves reading and writing it to a storage backend:
+
+    JsonStorage     database.json plus an append-only journal (the default)
+    SqliteStorage   a local SQLite file with indexed categories and entries
+
+openStorage picks the backend from the file extension.
+"""
+
+import json
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from contextlib import closing
+
+
+def findCategory(data, master, category):
+    # Position of the master/category combination in the document, or '' when it does not exist yet.
+    # Names are compared case-insensitively, they are names and not regular expressions
+    master = master.strip().lower()
+    category = category.strip().lower()
+
+    for count, x in enumerate(data['categories']):
+        if x['Master Category'].strip().lower() == master and x['Category'].strip().lower() == category:
+            return count
+
+    return ''
+
+
+def categoryNames(data):
+    # Category names in database order
+    return [x['Category'] for x in data['categories']]
+
+
+def masterCategoryNames(data):
+    # Master category names, each once, in the order they first appear
+    return list(dict.fromkeys(x['Master Category'] for x in data['categories']))
+
+
+def applyRule(data, rule):
+    # Add a payee and/or memo to a category, a new category is created when needed.
+    # Entries that already exist are not added twice, so replaying a journal more than once is harmless.
+    pos = findCategory(data, rule['Master Category'], rule['Category'])
+
+    if pos == '':
+        # Empty entries are left out, joined with later entries they would match everything
+        add = {'Category': rule['Category'], 'Master Category': rule['Master Category'],
+               'Memos': [rule['Memo']] if rule['Memo'] else [], 'Payees': [rule['Payee']] if rule['Payee'] else []}
+
+        data['categories'].append(add)
+    else:
+        x = data['categories'][pos]
+        if rule['Payee'] != '' and rule['Payee'] not in x['Payees']:
+            x['Payees'].append(rule['Payee'])
+
+        if rule['Memo'] != '' and rule['Memo'] not in x['Memos']:
+            x['Memos'].append(rule['Memo'])
+
+
+class Storage(ABC):
+    """ Interface of a storage backend, a backend without one of the abstract methods can not be created """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @abstractmethod
+    def stamp(self):
+        # Changes whenever the stored database changes, used to decide if the in-memory index must be reloaded
+        pass
+
+    @abstractmethod
+    def load(self):
+        # The whole database as a document
+        pass
+
+    @abstractmethod
+    def addRule(self, data, rule):
+        # Store one rule, data is the in-memory document the rule has already been applied to
+        pass
+
+    @abstractmethod
+    def save(self, data):
+        # Replace the stored database with data
+        pass
+
+    def categories(self, load):
+        # load returns the in-memory document, a backend that can list the names without it overrides these
+        return categoryNames(load())
+
+    def masterCategories(self, load):
+        return masterCategoryNames(load())
+
+
+class JsonStorage(Storage):
+    """ database.json plus a journal. New rules are appended to the journal, which is replayed on load.
+    Every compact_after rules the journal is compacted into database.json through a temporary file and an atomic rename.
+    """
+
+    compact_after = 100
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.journal_entries = 0
+
+    def journalFile(self):
+        return os.path.splitext(self.filename)[0] + '.journal'
+
+    def stamp(self):
+        stat = os.stat(self.filename)
+        try:
+            journal = os.stat(self.journalFile())
+        except FileNotFoundError:
+            return stat.st_mtime_ns, stat.st_size, None
+        return stat.st_mtime_ns, stat.st_size, (journal.st_mtime_ns, journal.st_size)
+
+    def load(self):
+        with open(self.filename, "r") as read_file:
+            data = json.load(read_file)
+
+        self.journal_entries = self.replayJournal(data)
+        return data
+
+    def replayJournal(self, data):
+        # Apply the rules added since the last compaction, a line cut off by a crash is ignored
+        entries = 0
+        try:
+            with open(self.journalFile(), "r", encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        rule = json.loads(line)
+                    except ValueError:
+                        continue
+                    applyRule(data, rule)
+                    entries = entries + 1
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def addRule(self, data, rule):
+        # O(1) append instead of rewriting the database
+        line = json.dumps(rule, sort_keys=True) + '\n'
+        with open(self.journalFile(), 'ab+') as journal:
+            # Start on a new line when the previous append was cut off by a crash
+            if journal.tell() > 0:
+                journal.seek(-1, os.SEEK_END)
+                if journal.read(1) != b'\n':
+                    line = '\n' + line
+
+            journal.write(line.encode('utf-8'))
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        self.journal_entries = self.journal_entries + 1
+        if self.journal_entries >= self.compact_after:
+            self.save(data)
+
+    def save(self, data):
+        # Compaction: write the document to a temporary file and atomically rename it over database.json,
+        # then drop the journal. A crash at any point leaves either the old or the new database plus a valid journal.
+        js = json.dumps(data, sort_keys=True, indent=4, separators=(',', ': '))
+
+        temporary = self.filename + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(js)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.filename)
+
+        try:
+            os.remove(self.journalFile())
+        except FileNotFoundError:
+            pass
+
+        self.journal_entries = 0
+
+
+class SqliteStorage(Storage):
+    """ Categories and their payee/memo entries in a local SQLite file. Looking up and listing categories are
+    indexed queries and adding a rule is a single-row insert. Every call opens its own short-lived connection,
+    so the storage can be used from the GUI worker thread as well.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY,
+            master TEXT NOT NULL COLLATE NOCASE,
+            category TEXT NOT NULL COLLATE NOCASE,
+            UNIQUE (master, category)
+        );
+        CREATE TABLE IF NOT EXISTS entries (
+            id INTEGER PRIMARY KEY,
+            category_id INTEGER NOT NULL REFERENCES categories (id),
+            field TEXT NOT NULL,
+            entry TEXT NOT NULL,
+            UNIQUE (category_id, field, entry)
+        );
+    '''
+
+    fields = (('Payees', 'Payee'), ('Memos', 'Memo'))
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        with closing(self.connect()) as connection:
+            connection.executescript(self.schema)
+
+    def connect(self):
+        return sqlite3.connect(self.filename)
+
+    def stamp(self):
+        stat = os.stat(self.filename)
+        return stat.st_mtime_ns, stat.st_size
+
+    def categories(self, load):
+        # Only the names, the entries are not read
+        with closing(self.connect()) as connection:
+            return [row[0] for row in connection.execute('SELECT category FROM categories ORDER BY id')]
+
+    def masterCategories(self, load):
+        # The UNIQUE (master, category) index is ordered by master, names that differ in case are one master
+        with closing(self.connect()) as connection:
+            return [row[0] for row in connection.execute('SELECT master FROM categories GROUP BY master '
+                                                         'ORDER BY MIN(id)')]
+
+    def load(self):
+        data = {'categories': []}
+        positions = {}
+
+        with closing(self.connect()) as connection:
+            for id, master, category in connection.execute('SELECT id, master, category FROM categories ORDER BY id'):
+                positions[id] = len(data['categories'])
+                data['categories'].append({'Category': category, 'Master Category': master, 'Memos': [], 'Payees': []})
+
+            for category_id, field, entry in connection.execute('SELECT category_id, field, entry FROM entries ORDER BY id'):
+                data['categories'][positions[category_id]][field].append(entry)
+
+        return data
+
+    def addRule(self, data, rule):
+        with closing(self.connect()) as connection, connection:
+            connection.execute('INSERT OR IGNORE INTO categories (master, category) VALUES (?, ?)',
+                               (rule['Master Category'], rule['Category']))
+            category_id = connection.execute('SELECT id FROM categories WHERE master = ? AND category = ?',
+                                             (rule['Master Category'], rule['Category'])).fetchone()[0]
+
+            for field, key in self.fields:
+                if rule[key]:
+                    connection.execute('INSERT OR IGNORE INTO entries (category_id, field, entry) VALUES (?, ?, ?)',
+                                       (category_id, field, rule[key]))
+
+    def save(self, data):
+        # Rewrite all rows in one transaction, the order of the document is kept in the ids
+        with closing(self.connect()) as connection, connection:
+            connection.execute('DELETE FROM entries')
+            connection.execute('DELETE FROM categories')
+
+            for x in data['categories']:
+                connection.execute('INSERT OR IGNORE INTO categories (master, category) VALUES (?, ?)',
+                                            (x['Master Category'], x['Category']))
+                category_id = connection.execute('SELECT id FROM categories WHERE master = ? AND category = ?',
+                                                 (x['Master Category'], x['Category'])).fetchone()[0]
+
+                for field, key in self.fields:
+                    connection.executemany('INSERT OR IGNORE INTO entries (category_id, field, entry) VALUES (?, ?, ?)',
+                                           [(category_id, field, entry) for entry in x[field] if entry])
+
+
+def openStorage(filename):
+    # SQLite for .sqlite/.db files, JSON otherwise
+    if os.path.splitext(filename)[1].lower() in ('.sqlite', '.sqlite3', '.db'):
+        return SqliteStorage(filename)
+    return JsonStorage(filename)
+
+
+def migrate(source, target):
+    """ One-shot migration of database.json (including its journal) into another storage, e.g. database.sqlite.
+    Returns the number of categories migrated.
+    """
+    data = JsonStorage(source).load()
+    openStorage(target).save(data)
+    return len(data['categories'])
@@ -0,0 +1,126 @@
+""" Category suggestions for unknown transactions
+
+An inverted index from tokens to categories, built from the payee and memo entries of every category and from the
+transactions that were categorized during this run. A payee or memo is split into words and the 3-letter grams of
+those words, so 'ALBERT HEIJN 1234' still finds the category of 'Albert Heijn' and 'HEIJN BV'. Categories are ranked
+by the TF-IDF cosine similarity with the unknown transaction, only the categories that share a token are scored.
+"""
+
+import heapq
+import math
+import re
+
+from matcher import literalText
+
+WORD = re.compile(r'[^\W\d_]{2,}')
+
+# Payee tokens count more than memo tokens, memos are full of card numbers, dates and IBANs
+PAYEE_WEIGHT = 1.0
+MEMO_WEIGHT = 0.5
+
+
+def termWeight(count):
+    # Sublinear, a word that is in ten entries of a category is not ten times as telling. Memo counts can be 0.5
+    return 1.0 + math.log(count) if count >= 1 else count
+
+
+def tokens(text):
+    # Words without digits and their 3-grams, padded so the start and end of a word count as well
+    result = []
+    for word in WORD.findall(text.lower()):
+        result.append(word)
+        padded = ' ' + word + ' '
+        for i in range(len(padded) - 2):
+            result.append(padded[i:i + 3])
+    return result
+
+
+class Suggester:
+
+    def __init__(self, categories):
+        # Categories as (master, category), in database order
+        self.categories = []
+        self.positions = {}
+        # token -> {category position: weighted count}
+        self.index = {}
+        self.norms = None
+        # Payees learned from categorized transactions, each one is only added once
+        self.learned = set()
+
+        for x in categories:
+            position = self.position(x['Master Category'], x['Category'])
+            for entry in x['Payees']:
+                self.add(literalText(entry) or entry, position, PAYEE_WEIGHT)
+            for entry in x['Memos']:
+                self.add(literalText(entry) or entry, position, MEMO_WEIGHT)
+
+    def position(self, master, category):
+        key = (master.lower(), category.lower())
+        position = self.positions.get(key)
+        if position is None:
+            position = self.positions[key] = len(self.categories)
+            self.categories.append((master, category))
+        return position
+
+    def add(self, text, position, weight):
+        for token in tokens(text):
+            postings = self.index.setdefault(token, {})
+            postings[position] = postings.get(position, 0.0) + weight
+        self.norms = None
+
+    def addRule(self, rule):
+        # Rule added to the database, see Database.addRule
+        position = self.position(rule['Master Category'], rule['Category'])
+        if rule['Payee']:
+            self.add(literalText(rule['Payee']) or rule['Payee'], position, PAYEE_WEIGHT)
+        if rule['Memo']:
+            self.add(literalText(rule['Memo']) or rule['Memo'], position, MEMO_WEIGHT)
+
+    def learn(self, payee, master, category):
+        # A transaction that got a category, from a rule or from the user
+        if payee in self.learned:
+            return
+        self.learned.add(payee)
+        self.add(payee, self.position(master, category), PAYEE_WEIGHT)
+
+    def idf(self, postings):
+        return math.log(1.0 + len(self.categories) / len(postings))
+
+    def computeNorms(self):
+        # Length of every category vector, recomputed once after entries were added
+        squares = [0.0] * len(self.categories)
+        for postings in self.index.values():
+            idf = self.idf(postings)
+            for position, count in postings.items():
+                squares[position] = squares[position] + (termWeight(count) * idf) ** 2
+        self.norms = [math.sqrt(square) or 1.0 for square in squares]
+
+    def suggest(self, payee, memo='', count=5):
+        """ Up to count (master, category, score) tuples, the best match first. Score is between 0 and 1 """
+        if self.norms is None:
+            self.computeNorms()
+
+        query = {}
+        for token in tokens(payee):
+            query[token] = query.get(token, 0.0) + PAYEE_WEIGHT
+        for token in tokens(memo):
+            query[token] = query.get(token, 0.0) + MEMO_WEIGHT
+
+        scores = {}
+        length = 0.0
+        for token, weight in query.items():
+            postings = self.index.get(token)
+            if postings is None:
+                continue
+            idf = self.idf(postings)
+            q = weight * idf
+            length = length + q * q
+            for position, amount in postings.items():
+                scores[position] = scores.get(position, 0.0) + q * termWeight(amount) * idf
+
+        if not scores:
+            return []
+
+        length = math.sqrt(length)
+        ranked = heapq.nlargest(count, scores.items(), key=lambda item: item[1] / self.norms[item[0]])
+        return [self.categories[position] + (score / self.norms[position] / length,) for position, score in ranked]
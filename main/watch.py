@@ -0,0 +1,238 @@
+""" Watch mode, converts ING exports as soon as they land in a directory
+
+        python cli.py watch <input directory> <output directory> [--database database.json] [--settle seconds]
+
+New and changed .csv files are noticed with inotify on Linux, elsewhere (or on network shares where inotify says
+nothing) by polling the size and modification time of the files. A file is only converted once it has stopped
+changing for a few seconds, so an export that is still being copied is never read half-written.
+
+Files are converted in this process, one after the other, so the rule index and the compiled matchers stay in
+memory between files. A manifest in the output directory (see manifest.py) remembers what was converted, so
+restarting the watcher does not convert the same files again and a changed export only adds its new transactions.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+import instrument
+from cli import convertOne
+from main import Database
+from manifest import Manifest
+
+logger = logging.getLogger(__name__)
+
+
+def isExport(name):
+    return name.endswith('.csv') and not name.startswith('.')
+
+
+def signature(filename):
+    # Size and modification time, a file that is still being written changes at least one of them
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class InotifyWatcher:
+    """ Names of the files in a directory that were written, created or moved in, from the Linux inotify API """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+
+    event = struct.Struct('iIII')
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, 'inotify_add_watch failed for ' + str(path))
+
+    def wait(self, timeout):
+        # Names of the files that changed, or an empty set after timeout seconds
+        names = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return names
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.event.unpack_from(data, offset)
+            offset = offset + self.event.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset = offset + length
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """ Names of the files in a directory whose size or modification time changed, by scanning every interval """
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for entry in os.scandir(self.path):
+            if entry.is_file():
+                stat = entry.stat()
+                snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        snapshot = self.scan()
+        names = {name for name, value in snapshot.items() if self.snapshot.get(name) != value}
+        self.snapshot = snapshot
+        return names
+
+    def close(self):
+        pass
+
+
+def openWatcher(path, polling=False):
+    if not polling:
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError) as error:
+            logger.info('Watching with inotify is not possible (' + str(error) + '), polling instead.')
+    return PollingWatcher(path)
+
+
+class Debouncer:
+    """ Holds back changed files until their size and modification time have not changed for settle seconds """
+
+    def __init__(self, settle):
+        self.settle = settle
+        # name -> (signature, time the signature was first seen)
+        self.pending = {}
+
+    def add(self, filename):
+        self.pending.setdefault(filename, (None, 0.0))
+
+    def ready(self, now=None):
+        # Files that are complete, in the order they were found
+        now = time.monotonic() if now is None else now
+        result = []
+        for filename, (last, since) in list(self.pending.items()):
+            current = signature(filename)
+            if current is None:
+                # Deleted or moved away before it was complete
+                del self.pending[filename]
+            elif current != last or current[0] == 0:
+                self.pending[filename] = (current, now)
+            elif now - since >= self.settle:
+                del self.pending[filename]
+                result.append(filename)
+        return result
+
+
+def watchDirectory(input_path, output_path, database='database.json', cache=False, settle=2.0, interval=1.0,
+                   polling=False, stop=None, accounts=False, hits=False):
+    """ Convert every new or changed export in input_path until stop (a threading.Event) is set.
+    Files that are already there when the watcher starts are converted too, unless the manifest knows them.
+    """
+    stop = stop or threading.Event()
+    Database.filename = os.path.abspath(database)
+    if cache:
+        Database().enableDiskCache()
+    if hits:
+        Database().enableHitCounts()
+
+    os.makedirs(os.path.join(output_path, 'uncategorized'), exist_ok=True)
+    manifest = Manifest(output_path)
+    debouncer = Debouncer(settle)
+    watcher = openWatcher(input_path, polling)
+
+    for entry in sorted(os.scandir(input_path), key=lambda entry: entry.name):
+        if entry.is_file() and isExport(entry.name):
+            debouncer.add(entry.path)
+
+    # Load the rules and compile the matchers now, instead of when the first file arrives
+    Database().getMatcher('Payees')
+    Database().getMatcher('Memos')
+    logger.info('Watching ' + str(input_path) + ' for ING exports..')
+
+    try:
+        while not stop.is_set():
+            for name in watcher.wait(interval):
+                if isExport(name):
+                    debouncer.add(os.path.join(input_path, name))
+
+            for filename in debouncer.ready():
+                convertWatched(filename, output_path, manifest, accounts)
+    finally:
+        watcher.close()
+        Database.cache.close()
+
+
+def outputName(manifest, name):
+    # A changed export must not overwrite the output of its earlier versions, which may not be imported yet
+    versions = sum(1 for converted in manifest.files.values() if converted['name'] == name)
+    if not versions:
+        return name
+    stem, extension = os.path.splitext(name)
+    return stem + '-' + str(versions + 1) + extension
+
+
+def convertWatched(filename, output_path, manifest, accounts=False):
+    plan = manifest.prepare(filename)
+    if plan is None:
+        logger.info(filename + ' has been converted before.. Skipped.')
+        return
+
+    if len(plan.skip) == len(plan.fingerprints):
+        # Changed, but every transaction in it was converted before
+        manifest.commit(filename, plan, 0)
+        manifest.save()
+        logger.info(filename + ' has no new transactions.. Skipped.')
+        return
+
+    started = time.perf_counter()
+    try:
+        name = outputName(manifest, os.path.basename(filename))
+        filename, written, unknown, statistics, report, part = convertOne(filename, output_path, plan.skip, name=name,
+                                                                          accounts=accounts)
+    except Exception:
+        # Not recorded in the manifest, so it is tried again when the file changes
+        manifest.pending.difference_update(plan.fingerprints)
+        logger.exception('Failed to convert ' + filename)
+        return
+
+    manifest.commit(filename, plan, written + unknown)
+    manifest.save()
+    logger.info('Processed file completly. ' + filename + ' -> ' + name + ': ' + str(written) + ' rows written, '
+                + str(unknown) + ' uncategorized, ' + str(len(plan.skip)) + ' converted before, in '
+                + '%.0f ms.' % ((time.perf_counter() - started) * 1000))
+    if report is not None:
+        logger.info(instrument.finishFile(filename, report))
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# The modules import each other by name, like when they are run from main/
+sys.path.insert(0, os.path.join(ROOT, 'main'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from cache import ClassificationCache  # noqa: E402
+from generate import generateDatabase, generateExport  # noqa: E402
+from main import Database  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path):
+    # A synthetic rule database, loaded fresh: nothing compiled or cached from an earlier test
+    filename = str(tmp_path / 'database.json')
+    data = generateDatabase(filename, categories=30, payees=10, memos=3)
+    Database.filename = filename
+    Database.backend = None
+    Database.data = None
+    Database.pending = []
+    Database.suggester = None
+    Database.learned = {}
+    Database.matchers = {}
+    Database.cache = ClassificationCache()
+    return data
+
+
+@pytest.fixture
+def export(tmp_path, database):
+    filename = str(tmp_path / 'export.csv')
+    generateExport(filename, rows=3000, data=database)
+    return filename
@@ -0,0 +1,84 @@
+import json
+import os
+
+from cache import ClassificationCache
+from main import Category, Database
+
+
+class Search:
+    """ Search function that counts its calls """
+
+    def __init__(self, result):
+        self.result = result
+        self.calls = 0
+
+    def __call__(self, text):
+        self.calls = self.calls + 1
+        return self.result
+
+
+def test_searched_once_per_text():
+    cache = ClassificationCache()
+    search = Search(3)
+    for text in ['Albert Heijn', 'ALBERT HEIJN', 'albert heijn']:
+        assert cache.get('stamp', 'Payees', text, search) == 3
+    assert search.calls == 1
+
+    # Payees and memos are cached separately
+    assert cache.get('stamp', 'Memos', 'albert heijn', search) == 3
+    assert search.calls == 2
+
+
+def test_new_stamp_empties_the_cache():
+    cache = ClassificationCache()
+    search = Search(3)
+    cache.get('first', 'Payees', 'jumbo', search)
+    cache.get('second', 'Payees', 'jumbo', search)
+    assert search.calls == 2
+
+
+def test_disk_cache_is_kept_for_the_same_stamp(tmp_path):
+    filename = str(tmp_path / 'database.cache')
+    cache = ClassificationCache()
+    cache.openDisk(filename)
+    cache.get('stamp', 'Payees', 'jumbo', Search(3))
+    cache.close()
+
+    cache = ClassificationCache()
+    cache.openDisk(filename)
+    search = Search(4)
+    assert cache.get('stamp', 'Payees', 'jumbo', search) == 3
+    assert search.calls == 0 and cache.disk_hits == 1
+    cache.close()
+
+    # Another version of the rules
+    cache = ClassificationCache()
+    cache.openDisk(filename)
+    assert cache.get('other stamp', 'Payees', 'jumbo', search) == 4
+    cache.close()
+
+    cache = ClassificationCache()
+    cache.openDisk(filename)
+    assert cache.get('stamp', 'Payees', 'jumbo', Search(5)) == 5
+    cache.close()
+
+
+def test_added_rule_replaces_cached_results(database):
+    assert Database().lookup('Payees', 'NEW PAYEE 123') == ''
+
+    Category('Groceries', 'new payee', '', 'Daily').addCategory()
+    assert Database().lookup('Payees', 'NEW PAYEE 123') == 'Daily: Groceries'
+
+
+def test_edited_database_replaces_cached_results(database):
+    assert Database().lookup('Payees', 'OTHER PAYEE 456') == ''
+
+    # Changed by another program, the stamp of the file changes
+    database['categories'][0]['Payees'].insert(0, 'other payee')
+    with open(Database.filename, 'w') as f:
+        json.dump(database, f)
+    stat = os.stat(Database.filename)
+    os.utime(Database.filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    first = database['categories'][0]
+    assert Database().lookup('Payees', 'OTHER PAYEE 456') == first['Master Category'] + ': ' + first['Category']
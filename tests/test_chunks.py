@@ -0,0 +1,34 @@
+import csv
+import io
+
+from chunks import recordEnd, splitFile
+
+
+def test_record_end_skips_quoted_newlines():
+    data = b'"Datum","Mededelingen"\n"1","two\nlines"\n"2","x"\n'
+    first = data.index(b'\n') + 1
+    # From inside the quoted memo the record only ends after its closing quote
+    assert recordEnd(data, first, first + 5) == data.index(b'"2"')
+    assert recordEnd(data, 0, 0) == first
+    assert recordEnd(data, data.index(b'"2"'), len(data) - 1) == len(data)
+
+
+def test_record_end_without_newline():
+    data = b'"a"\n"b","c'
+    assert recordEnd(data, 4, 5) == len(data)
+
+
+def test_chunks_hold_whole_records(export):
+    with open(export, 'rb') as f:
+        data = f.read()
+    chunks = splitFile(export, chunk_bytes=1000)
+    assert len(chunks) > 10
+
+    # The chunks follow each other and every one parses into complete records
+    assert chunks[0][0] == data.index(b'\n') + 1
+    assert chunks[-1][1] == len(data)
+    rows = []
+    for (start, end), following in zip(chunks, chunks[1:] + [(len(data), None)]):
+        assert end == following[0]
+        rows.extend(csv.reader(io.StringIO(data[start:end].decode(), newline='')))
+    assert rows == list(csv.reader(io.StringIO(data.decode(), newline='')))[1:]
@@ -0,0 +1,65 @@
+import json
+import os
+
+import pytest
+
+from convert import ConversionCancelled, collectUnknowns, convertFile
+
+
+class CancelAfter:
+    """ Cancel event that is set once it has been checked rows times """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def is_set(self):
+        self.rows = self.rows - 1
+        return self.rows < 0
+
+
+def convertInto(directory, export, accounts, cancel=None):
+    os.makedirs(directory, exist_ok=True)
+    return convertFile(export, os.path.join(directory, 'out.csv'), cancel=cancel, accounts=accounts,
+                       uncategorized=os.path.join(directory, 'uncategorized.csv'))
+
+
+def contents(directory):
+    result = {}
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), 'rb') as f:
+            result[name] = f.read()
+    return result
+
+
+@pytest.mark.parametrize('accounts', [False, True])
+@pytest.mark.parametrize('rows', [700, 1536, 2999])
+def test_cancelled_conversion_continues(tmp_path, export, accounts, rows):
+    expected = convertInto(str(tmp_path / 'whole'), export, accounts)
+
+    # Stopped in the middle of a batch (of 512 rows), or right after one
+    directory = str(tmp_path / 'stopped')
+    with pytest.raises(ConversionCancelled):
+        convertInto(directory, export, accounts, cancel=CancelAfter(rows))
+    assert any(name.endswith('.checkpoint') for name in os.listdir(directory))
+    assert not any(name.endswith('.csv') for name in os.listdir(directory))
+
+    assert convertInto(directory, export, accounts) == expected
+    assert contents(directory) == contents(str(tmp_path / 'whole'))
+
+
+def unknownRows(unknowns):
+    return sum(group.count for group in unknowns.values())
+
+
+def test_review_leaves_out_converted_rows(tmp_path, export):
+    directory = str(tmp_path / 'stopped')
+    with pytest.raises(ConversionCancelled):
+        convertInto(directory, export, False, cancel=CancelAfter(1536))
+    outputfile = os.path.join(directory, 'out.csv')
+    with open(outputfile + '.checkpoint') as f:
+        state = json.load(f)
+
+    everything = unknownRows(collectUnknowns([export]))
+    remaining = unknownRows(collectUnknowns([export], outputs={export: outputfile}))
+    assert state['unknown'] > 0
+    assert remaining == everything - state['unknown']
@@ -0,0 +1,30 @@
+import os
+import threading
+
+import instrument
+from convert import convertFile
+
+
+def convert(tmp_path, export, name):
+    return convertFile(export, os.path.join(str(tmp_path), name), uncategorized=os.path.join(str(tmp_path), 'x.csv'))
+
+
+def test_only_the_enabling_thread_is_timed(tmp_path, export):
+    instrument.enable()
+    try:
+        # Another thread converting at the same time, like the Tk thread of the GUI, is not timed
+        other = threading.Thread(target=convert, args=(tmp_path, export, 'other.csv'))
+        other.start()
+        other.join()
+        assert instrument.collect() == {}
+
+        convert(tmp_path, export, 'out.csv')
+        report = instrument.collect()
+    finally:
+        instrument.disable()
+
+    assert report['parse transaction']['calls'] == 3000
+    assert report['read csv']['calls'] >= 3000
+    assert report['parse transaction']['slowest'][0][1].startswith('row ')
+    assert 'slowest rows: row ' in instrument.summary('out.csv', report)
+    assert not instrument.enabled() and not instrument.patched
@@ -0,0 +1,75 @@
+import csv
+import os
+
+from convert import convertFile
+from manifest import Manifest
+
+
+def readExport(filename):
+    with open(filename, newline='') as f:
+        reader = csv.reader(f)
+        return next(reader), list(reader)
+
+
+def writeExport(filename, header, rows):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(header)
+        writer.writerows(rows)
+    return filename
+
+
+def outputRows(filename):
+    with open(filename, newline='') as f:
+        return len(list(csv.reader(f))) - 1
+
+
+def test_converted_files_and_rows_are_skipped(tmp_path, export):
+    header, rows = readExport(export)
+    first = writeExport(str(tmp_path / 'first.csv'), header, rows[:2000])
+    output = str(tmp_path / 'output')
+    os.makedirs(output)
+
+    manifest = Manifest(output)
+    plan = manifest.prepare(first)
+    assert plan.skip == set()
+    manifest.commit(first, plan, 2000)
+    manifest.save()
+
+    # Kept in the output directory, an unchanged file is skipped however it is named
+    manifest = Manifest(output)
+    assert manifest.prepare(first) is None
+    assert manifest.prepare(writeExport(str(tmp_path / 'copy.csv'), header, rows[:2000])) is None
+
+    # Of an overlapping export only the new rows are converted
+    second = writeExport(str(tmp_path / 'second.csv'), header, rows[1500:])
+    plan = manifest.prepare(second)
+    assert plan.skip == set(range(500))
+    written, unknown = convertFile(second, os.path.join(output, 'second.csv'), skip=plan.skip,
+                                   uncategorized=os.path.join(output, 'uncategorized.csv'))
+    assert written + unknown == 1000
+    assert outputRows(os.path.join(output, 'second.csv')) == written
+
+
+def test_identical_rows_stay_distinct(tmp_path, export):
+    header, rows = readExport(export)
+    coffee = rows[0]
+    output = str(tmp_path)
+
+    # One coffee in the first export, two on the same day in the second: the second one is new
+    manifest = Manifest(output)
+    first = writeExport(str(tmp_path / 'first.csv'), header, [coffee])
+    manifest.commit(first, manifest.prepare(first), 1)
+    second = writeExport(str(tmp_path / 'second.csv'), header, [coffee, coffee, rows[1]])
+    assert manifest.prepare(second).skip == {0}
+
+
+def test_overlap_within_one_run(tmp_path, export):
+    header, rows = readExport(export)
+    manifest = Manifest(str(tmp_path))
+
+    # Nothing is committed yet, the second file still leaves out what the first will convert
+    first = manifest.prepare(writeExport(str(tmp_path / 'first.csv'), header, rows[:100]))
+    second = manifest.prepare(writeExport(str(tmp_path / 'second.csv'), header, rows[50:150]))
+    assert first.skip == set()
+    assert second.skip == set(range(50))
@@ -0,0 +1,103 @@
+import functools
+import random
+import re
+import time
+
+import pytest
+
+from matcher import Matcher, checkEntry, literalText
+
+WORDS = ['ab', 'abc', 'bc', 'cab', 'x.y', 'ba']
+
+
+@functools.lru_cache(maxsize=None)
+def usable(entry):
+    return checkEntry(entry) is None
+
+
+def scan(categories, field, text):
+    # Reference: every category in order, the first one with a matching entry wins
+    for x in categories:
+        for entry in x[field]:
+            if not entry:
+                continue
+            literal = literalText(entry)
+            if literal is not None:
+                if literal.lower() in text.lower():
+                    return x['Master Category'] + ': ' + x['Category'], entry
+            elif usable(entry) and re.search(entry, text, re.IGNORECASE):
+                return x['Master Category'] + ': ' + x['Category'], entry
+    return '', None
+
+
+def randomEntry(rng):
+    kind = rng.random()
+    if kind < 0.5:
+        return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 2)))
+    if kind < 0.6:
+        # Escaped plain text
+        return re.escape(rng.choice(WORDS).upper())
+    if kind < 0.9:
+        return rng.choice(WORDS) + rng.choice(['.*', r'\s+', '[0-9]+', '|']) + rng.choice(WORDS)
+    return rng.choice(['^' + rng.choice(WORDS), rng.choice(WORDS) + '$', r'\bab\b', '(a+)+', 'bad('])
+
+
+def randomCategories(rng, count, extra=()):
+    return [{'Master Category': 'M' + str(i % 3), 'Category': 'C' + str(i),
+             'Payees': [randomEntry(rng) for _ in range(rng.randint(0, 4))] + list(extra), 'Memos': []}
+            for i in range(count)]
+
+
+def randomText(rng):
+    return ''.join(rng.choice(WORDS + [' ', '1', '23', 'Q']) for _ in range(rng.randint(1, 8)))
+
+
+def check(categories, rng):
+    matcher = Matcher(categories, 'Payees')
+    for _ in range(2000):
+        text = randomText(rng)
+        label, entry = scan(categories, 'Payees', text)
+        rule = matcher.match(text)
+        assert matcher.search(text) == label, text
+        assert (matcher.rules[rule][1] if rule != matcher.nothing else None) == entry, text
+    return matcher
+
+
+def test_first_category_wins():
+    rng = random.Random(1)
+    for _ in range(20):
+        matcher = check(randomCategories(rng, 40), rng)
+        assert matcher.regex is not None
+
+
+def test_categories_compiled_separately():
+    # A numbered backreference keeps the regular expressions of every category apart
+    rng = random.Random(2)
+    matcher = check(randomCategories(rng, 40, extra=[r'(ab)\1']), rng)
+    assert matcher.regex is None
+
+
+def test_hits_are_counted_per_rule():
+    categories = [{'Master Category': 'M', 'Category': 'A', 'Payees': ['ALDI', 'JUMBO.*'], 'Memos': []},
+                  {'Master Category': 'M', 'Category': 'B', 'Payees': ['ALDI 12'], 'Memos': []}]
+    matcher = Matcher(categories, 'Payees')
+    texts = ['aldi 12', 'Jumbo 3', 'lidl', 'ALDI']
+    assert matcher.found([matcher.match(text) for text in texts]) == ['M: A', 'M: A', '', 'M: A']
+    assert matcher.hits == [2, 1, 0, 1]
+
+
+@pytest.mark.parametrize('entry', ['(a+)+', '((a+))+', '(a|aa)+', '(a+){20}', r'(\w*)*', '(?:foo|bar)+',
+                                   '(.*a){3}', '(x(a+)y)*'])
+def test_catastrophic_entries_are_rejected(entry):
+    assert checkEntry(entry) == 'nested quantifiers can make matching take forever'
+
+    matcher = Matcher([{'Master Category': 'M', 'Category': 'A', 'Payees': [entry], 'Memos': []}], 'Payees')
+    started = time.perf_counter()
+    assert matcher.search('a' * 40 + '!') == ''
+    assert time.perf_counter() - started < 0.1
+
+
+@pytest.mark.parametrize('entry', ['(a|b)+', r'(\d{4})+', '(ab)+', '(a+)?', 'x.*y', 'jumbo|aldi', r'\bab\b',
+                                   '(a+){1}'])
+def test_safe_entries_are_kept(entry):
+    assert checkEntry(entry) is None
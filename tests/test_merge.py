@@ -0,0 +1,54 @@
+import csv
+
+from merge import deduplicate, mergeFiles
+
+
+def test_deduplicate_across_sources():
+    # (content, category, source), sorted like the runs of a merge
+    stream = [('a', 'x', 0), ('a', 'x', 1), ('b', 'x', 0), ('b', 'x', 0), ('b', 'x', 1),
+              ('c', 'x', 1), ('c', 'x', 1), ('c', 'x', 1), ('c', 'x', 2)]
+    # A transaction that is in several exports is written once, twice in one export means twice
+    assert list(deduplicate(iter(stream))) == [('a', 'x'), ('b', 'x'), ('b', 'x'), ('c', 'x'), ('c', 'x'), ('c', 'x')]
+
+
+def test_deduplicate_ignores_category():
+    # A rule added while merging categorizes the copy in a later export, the copies are still one transaction
+    stream = sorted([('a', '', 0), ('a', 'x', 1), ('b', 'x', 0), ('b', 'y', 1), ('b', 'y', 1), ('c', '', 0),
+                     ('c', '', 2)])
+    assert list(deduplicate(iter(stream))) == [('a', 'x'), ('b', 'y'), ('b', 'y'), ('c', '')]
+
+
+def writeRows(filename, header, rows):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def readFile(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def test_overlapping_exports(tmp_path, export):
+    with open(export, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = list(reader)
+
+    # Newest first like ING exports, overlapping by 500 transactions
+    first = str(tmp_path / 'first.csv')
+    second = str(tmp_path / 'second.csv')
+    writeRows(first, header, rows[1500:][::-1])
+    writeRows(second, header, rows[:2000][::-1])
+
+    whole = str(tmp_path / 'whole.csv')
+    merged = str(tmp_path / 'merged.csv')
+    expected = mergeFiles([export], whole, uncategorized=str(tmp_path / 'whole-uncategorized.csv'))
+    written, unknown, duplicates = mergeFiles([first, second], merged, run_rows=700,
+                                              uncategorized=str(tmp_path / 'merged-uncategorized.csv'))
+
+    assert (written, unknown) == expected[:2]
+    assert duplicates == expected[2] + 500
+    assert readFile(merged) == readFile(whole)
+    assert readFile(str(tmp_path / 'merged-uncategorized.csv')) == readFile(str(tmp_path / 'whole-uncategorized.csv'))
@@ -0,0 +1,62 @@
+import pytest
+
+from convert import parseBatches, parseTransactions
+from main import MalformedRow, formatAmount, formatOrdinal, parseAmount, parseDate, parseOrdinal
+
+
+@pytest.mark.parametrize('amount, cents', [
+    ('1234,56', 123456), ('0,01', 1), ('-12,34', -1234), (' 12,34 ', 1234), ('12,3', 1230), ('12', 1200),
+    (',5', 50), ('12.34', 1234), ('-0,50', -50), ('007,00', 700),
+])
+def test_parse_amount(amount, cents):
+    assert parseAmount(amount) == cents
+
+
+@pytest.mark.parametrize('amount', ['', ' ', '-', ',', '1,234', '1.234,56', '12,3a', '+12,34', '12,-3', 'EUR 5'])
+def test_malformed_amount(amount):
+    with pytest.raises(MalformedRow):
+        parseAmount(amount)
+
+
+@pytest.mark.parametrize('cents, text', [(123456, '1234.56'), (5, '0.05'), (-5, '-0.05'), (-123400, '-1234.00')])
+def test_format_amount(cents, text):
+    assert formatAmount(cents) == text
+    assert parseAmount(text) == cents
+
+
+@pytest.mark.parametrize('date, text', [('20200131', '31/01/20'), (' 20000229 ', '29/02/00'), ('19991231', '31/12/99')])
+def test_parse_date(date, text):
+    assert parseDate(date) == text
+    assert formatOrdinal(parseOrdinal(date)) == text
+
+
+@pytest.mark.parametrize('date', ['', '2020013', '202001311', '2020-1-31', '20200230', '20190229', '20201301',
+                                  '20200100', 'abcdefgh'])
+def test_malformed_date(date):
+    for parse in (parseDate, parseOrdinal):
+        with pytest.raises(MalformedRow):
+            parse(date)
+
+
+def row(date, amount, payee='SHELL'):
+    # Datum,Naam / Omschrijving,Rekening,Tegenrekening,Code,Af Bij,Bedrag (EUR),MutatieSoort,Mededelingen
+    return [date, payee, 'NL01INGB0001234567', '', 'BA', 'Af', amount, 'Betaalautomaat', 'memo']
+
+
+def test_malformed_rows_are_skipped():
+    rows = [row('20200131', '12,34'), row('20200230', '1,00'), ['20200131', 'too short'],
+            row('20200201', '1,2,3'), row('20200202', '0,99', payee='JUMBO, ALBERT')]
+
+    batches = list(parseBatches(iter(rows)))
+    assert [list(batch.numbers) for batch in batches] == [[2, 6]]
+    assert list(batches[0].amounts) == [1234, 99]
+
+    transactions = list(parseTransactions(iter(rows)))
+    assert [(transaction.date, transaction.amount) for transaction in transactions] == [('31/01/20', 1234),
+                                                                                        ('02/02/20', 99)]
+    assert transactions[1].payee == 'JUMBO & ALBERT'
+
+    # Every skipped row is reported with its row number in the export, the header is row 1
+    warnings = []
+    list(parseBatches(iter(rows), warnings=warnings))
+    assert [number for number, text in warnings] == [3, 4, 5]
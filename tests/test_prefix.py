@@ -0,0 +1,87 @@
+import json
+import os
+
+from main import Database
+from prefix import PrefixIndex, keys
+
+DOCUMENT = {'categories': [
+    {'Master Category': 'Daily', 'Category': 'Groceries', 'Payees': ['ALBERT HEIJN 1234', r'BOL\.COM'],
+     'Memos': ['bakker']},
+    {'Master Category': 'Living', 'Category': 'Energy', 'Payees': ['ENECO', r'^ESSENT\b'], 'Memos': []},
+]}
+
+
+def test_keys():
+    assert keys('Albert Heijn-12') == {'albert heijn-12', 'heijn-12', '12'}
+
+
+def test_search_from_every_word():
+    index = PrefixIndex(DOCUMENT)
+    assert index.search('heij') == ([(0, 'Payees', 'ALBERT HEIJN 1234')], False)
+    assert index.search('HEIJN 12') == ([(0, 'Payees', 'ALBERT HEIJN 1234')], False)
+    # Plain entries are found by the text they match, categories by their names
+    assert index.search('bol.') == ([(0, 'Payees', r'BOL\.COM')], False)
+    assert index.search('groc') == ([(0, '', '')], False)
+    assert sorted(index.search('e')[0]) == [(1, '', ''), (1, 'Payees', 'ENECO'), (1, 'Payees', r'^ESSENT\b')]
+    assert index.search('xyz') == ([], False)
+
+
+def test_typing_and_deleting():
+    index = PrefixIndex(DOCUMENT)
+    results = [index.search(prefix)[0] for prefix in ['e', 'en', 'ene', 'en', 'e', 'b', 'ba']]
+    fresh = [PrefixIndex(DOCUMENT).search(prefix)[0] for prefix in ['e', 'en', 'ene', 'en', 'e', 'b', 'ba']]
+    assert results == fresh
+    assert sorted(results[2]) == [(1, '', ''), (1, 'Payees', 'ENECO')]
+
+
+def test_limit():
+    index = PrefixIndex({'categories': [{'Master Category': 'M', 'Category': 'C', 'Memos': [],
+                                         'Payees': ['SHOP ' + str(number) for number in range(10)]}]})
+    found, more = index.search('shop', limit=4)
+    assert len(found) == 4 and more
+    assert index.search('shop', limit=10) == ([(0, 'Payees', 'SHOP ' + str(number)) for number in range(10)], False)
+
+
+def test_edits():
+    index = PrefixIndex(DOCUMENT)
+    index.search('jum')
+    index.add(0, 'Payees', 'JUMBO')
+    assert index.search('jum') == ([(0, 'Payees', 'JUMBO')], False)
+    index.remove(0, 'Payees', 'JUMBO')
+    assert index.search('jum') == ([], False)
+    assert len(index) == len(PrefixIndex(DOCUMENT))
+
+    index.addCategory(2, 'Health', 'Dentist')
+    assert index.search('dent') == ([(2, '', '')], False)
+
+
+def test_unsaved_edits_survive_a_reload(tmp_path):
+    filename = str(tmp_path / 'database.json')
+    with open(filename, 'w') as f:
+        json.dump(DOCUMENT, f)
+    Database.filename = filename
+    Database.backend = None
+    Database.data = None
+    Database.pending = []
+    Database.matchers = {}
+
+    database = Database()
+    database.addEntry('Daily', 'Groceries', 'Payees', 'JUMBO')
+    database.removeEntry(1, 'Payees', 'ENECO')
+
+    # Changed on disk by another program before the edits were saved
+    changed = json.loads(json.dumps(DOCUMENT))
+    changed['categories'][1]['Memos'].append('stroom')
+    with open(filename, 'w') as f:
+        json.dump(changed, f)
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    data = database.openDatabase()
+    assert data['categories'][0]['Payees'] == ['ALBERT HEIJN 1234', r'BOL\.COM', 'JUMBO']
+    assert data['categories'][1]['Payees'] == [r'^ESSENT\b']
+    assert data['categories'][1]['Memos'] == ['stroom']
+
+    database.saveDatabase()
+    Database.data = None
+    assert database.openDatabase() == data
@@ -0,0 +1,145 @@
+import csv
+
+from convert import collectUnknowns, convertFile
+from main import Database
+from rules import (ImportReport, coveredEntries, deadEntries, mergeRules, pruneEntries, readRegister, readRules,
+                   saveRules)
+
+
+def document():
+    return {'categories': [
+        {'Master Category': 'Daily', 'Category': 'Groceries', 'Payees': ['Albert Heijn', r'JUMBO\s+\d+'],
+         'Memos': []},
+        {'Master Category': 'Car', 'Category': 'Fuel', 'Payees': ['SHELL'], 'Memos': ['tanken']},
+    ]}
+
+
+def rule(master, category, payee='', memo=''):
+    return {'Master Category': master, 'Category': category, 'Payee': payee, 'Memo': memo}
+
+
+def test_merge_rules():
+    data = document()
+    report = mergeRules(data, [
+        rule('daily', 'GROCERIES', payee='LIDL'),
+        # Already in its category, compared like they are matched
+        rule('Daily', 'Groceries', payee='ALBERT HEIJN'),
+        rule('Daily', 'Groceries', payee=r'Albert\ Heijn'),
+        # In another category, which keeps it
+        rule('Daily', 'Snacks', payee='shell'),
+        rule('Health', 'Dentist', payee='TANDARTS', memo='controle'),
+        rule('Health', 'Dentist', memo='CONTROLE'),
+        rule('', 'Dentist', payee='ORTHODONTIST'),
+        rule('Health', 'Dentist'),
+        rule('Health', 'Dentist', payee='(a+)+'),
+    ])
+
+    assert (report.added, report.duplicates, report.categories) == (3, 3, 1)
+    assert report.conflicts == [('Payee', 'shell', 'Car: Fuel', 'Daily: Snacks')]
+    assert [reason for rule, reason in report.invalid][:2] == ['master category or category is empty',
+                                                               'no payee or memo']
+    assert len(report.invalid) == 3
+    assert data['categories'][0]['Payees'] == ['Albert Heijn', r'JUMBO\s+\d+', 'LIDL']
+    assert data['categories'][2] == {'Master Category': 'Health', 'Category': 'Dentist', 'Payees': ['TANDARTS'],
+                                     'Memos': ['controle']}
+
+
+def writeCsv(filename, rows):
+    with open(filename, 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+    return str(filename)
+
+
+def test_read_rule_csv(tmp_path):
+    filename = writeCsv(tmp_path / 'rules.csv', [['category', 'PAYEE', 'Memo'], ['Daily: Groceries', 'LIDL', ''],
+                                                 ['Car: Fuel', '', 'tanken']])
+    assert list(readRules(filename)) == [rule('Daily', 'Groceries', payee='LIDL'), rule('Car', 'Fuel', memo='tanken')]
+
+
+def test_read_register(tmp_path):
+    filename = writeCsv(tmp_path / 'register.csv', [
+        ['Account', 'Date', 'Payee', 'Category Group', 'Category', 'Outflow', 'Inflow'],
+        ['Checking', '01/01/2020', 'AH 1.2', 'Daily', 'Groceries', '1.00', ''],
+        ['Checking', '02/01/2020', 'AH 1.2', 'Daily', 'Snacks', '1.00', ''],
+        ['Checking', '03/01/2020', 'AH 1.2', 'Daily', 'Groceries', '1.00', ''],
+        ['Checking', '04/01/2020', 'Transfer : Savings', 'Daily', 'Groceries', '1.00', ''],
+        ['Checking', '05/01/2020', 'Employer', 'Inflow', 'To be Budgeted', '', '100.00'],
+    ])
+
+    report = ImportReport()
+    rules = list(readRules(filename, report))
+    # The payee as it is, not as a regular expression
+    assert rules == [rule('Daily', 'Groceries', payee=r'AH 1\.2')]
+    assert report.conflicts == [('Payee', 'AH 1.2', 'Daily: Groceries', 'Daily: Snacks')]
+    assert list(readRegister(filename)) == rules
+
+
+def category(name, payees=(), memos=()):
+    return {'Master Category': 'M', 'Category': name, 'Payees': list(payees), 'Memos': list(memos)}
+
+
+def test_covered_entries():
+    data = {'categories': [
+        category('A', payees=['ALDI', r'JUMBO\s*\d+', r'^LIDL\b', 'SHELL 1']),
+        category('B', payees=['ALDI 12', 'jumbo 5', 'LIDL 3', r'JUMBO\s*\d+', 'SHELL']),
+        category('C', payees=['SHELL 12', 'SHELL 1 B']),
+    ]}
+    covered = coveredEntries(data, 'Payees')
+    assert covered == [
+        # Every text with 'ALDI 12' has 'ALDI', which is in an earlier category
+        (1, 'ALDI 12', 0, 'ALDI'),
+        # Matched by a regex of an earlier category, whatever is around it
+        (1, 'jumbo 5', 0, r'JUMBO\s*\d+'),
+        (1, r'JUMBO\s*\d+', 0, r'JUMBO\s*\d+'),
+        # The first covering rule is named
+        (2, 'SHELL 12', 0, 'SHELL 1'),
+        (2, 'SHELL 1 B', 0, 'SHELL 1'),
+    ]
+    # '^LIDL\b' depends on the text around it, 'LIDL 3' is not covered
+    assert coveredEntries(data, 'Memos') == []
+
+
+def test_prune_entries():
+    data = {'categories': [
+        category('A', payees=['ALDI', 'ALDI 12', '(a+)+'], memos=['huur']),
+        category('B', payees=['JUMBO', 'LIDL'], memos=['aldi']),
+    ]}
+    counts = {
+        ('Payees', 'M: A', 'ALDI'): (5, '2020-01-01', '2024-01-01'),
+        ('Payees', 'M: B', 'JUMBO'): (0, '2020-01-01', None),
+        # Counted too recently to call it dead
+        ('Payees', 'M: B', 'LIDL'): (0, '2024-06-01', None),
+        ('Memos', 'M: A', 'huur'): (0, '2020-01-01', None),
+    }
+    assert deadEntries(data, counts, '2024-01-01') == [(0, 'Memos', 'huur'), (1, 'Payees', 'JUMBO')]
+    assert pruneEntries(data, counts, '2024-01-01') == [
+        (0, 'Memos', 'huur', 'never matched'),
+        (0, 'Payees', '(a+)+', 'not used: nested quantifiers can make matching take forever'),
+        (0, 'Payees', 'ALDI 12', 'covered by ALDI of M: A'),
+        (1, 'Payees', 'JUMBO', 'never matched'),
+    ]
+
+
+def test_pruned_entries_can_be_imported_again(tmp_path):
+    data = {'categories': [category('A', payees=['ALDI'], memos=['huur'])]}
+    filename = str(tmp_path / 'pruned.csv')
+    saveRules(filename, data, [(0, 'Payees', 'ALDI', 'never matched')])
+    saveRules(filename, data, [(0, 'Memos', 'huur')])
+    assert list(readRules(filename)) == [rule('M', 'A', payee='ALDI'), rule('M', 'A', memo='huur')]
+
+
+def test_hits_are_counted_once_per_row(tmp_path, export):
+    database = Database()
+    database.enableHitCounts()
+    try:
+        # The first pass of the batch review classifies every row before it is converted
+        collectUnknowns([export])
+        written, unknown = convertFile(export, str(tmp_path / 'out.csv'),
+                                       uncategorized=str(tmp_path / 'uncategorized.csv'))
+        counts = Database.hits.load()
+    finally:
+        database.disableHitCounts()
+
+    assert written > 0
+    assert sum(hits for hits, since, last in counts.values()) == written
+    assert len(counts) == sum(len(x['Payees']) + len(x['Memos']) for x in database.openDatabase()['categories'])
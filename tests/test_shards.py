@@ -0,0 +1,65 @@
+import csv
+import os
+
+import pytest
+
+from shards import ShardedWriter, accountName
+
+HEADER = ['Date', 'Payee']
+
+
+def readCsv(filename):
+    with open(filename, newline='') as f:
+        return list(csv.reader(f))
+
+
+def test_account_name():
+    assert accountName('NL01 INGB 0001234567') == 'NL01_INGB_0001234567'
+    assert accountName('{0}/..') == '0'
+    assert accountName('') == 'unknown'
+
+
+@pytest.mark.parametrize('background', [False, True])
+def test_rows_per_account(tmp_path, background):
+    outputfile = str(tmp_path / 'export.csv')
+    accounts = ['NL0' + str(number % 7) for number in range(200)]
+    rows = [[str(number), 'payee ' + str(number)] for number in range(200)]
+
+    # More accounts than open files and small buffers, files are closed and appended to again
+    with ShardedWriter(outputfile, HEADER, max_open=2, buffer_rows=3, background=background) as writer:
+        writer.writerows(rows, accounts)
+    files = writer.files()
+
+    assert sorted(os.listdir(str(tmp_path))) == ['export-NL0' + str(number) + '.csv.part' for number in range(7)]
+    for account, (filename, count) in files.items():
+        expected = [row for row, other in zip(rows, accounts) if other == account]
+        assert readCsv(filename) == [HEADER] + expected
+        assert count == len(expected)
+
+
+def test_accounts_with_the_same_file_name(tmp_path):
+    outputfile = str(tmp_path / 'export.csv')
+    with ShardedWriter(outputfile, HEADER, buffer_rows=1) as writer:
+        writer.writerow(['1', 'a'], 'NL01 INGB')
+        writer.writerow(['2', 'b'], 'NL01-INGB')
+        writer.writerow(['3', 'c'], 'NL01 INGB')
+
+    files = writer.files()
+    assert files['NL01 INGB'] == files['NL01-INGB'] == (str(tmp_path / 'export-NL01_INGB.csv.part'), 3)
+    assert readCsv(files['NL01 INGB'][0]) == [HEADER, ['1', 'a'], ['2', 'b'], ['3', 'c']]
+
+
+def test_continued_files_are_cut_back(tmp_path):
+    outputfile = str(tmp_path / 'export.csv')
+    with ShardedWriter(outputfile, HEADER) as writer:
+        writer.writerow(['1', 'a'], 'A')
+        sizes = writer.sizes()
+        # Written after the checkpoint, before the conversion stopped
+        writer.writerow(['2', 'b'], 'A')
+
+    with ShardedWriter(outputfile, HEADER, sizes=sizes) as writer:
+        writer.writerow(['3', 'c'], 'A')
+        writer.writerow(['4', 'd'], 'B')
+    assert writer.parts() == [str(tmp_path / 'export-A.csv.part'), str(tmp_path / 'export-B.csv.part')]
+    assert readCsv(writer.parts()[0]) == [HEADER, ['1', 'a'], ['3', 'c']]
+    assert readCsv(writer.parts()[1]) == [HEADER, ['4', 'd']]
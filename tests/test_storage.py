@@ -0,0 +1,136 @@
+import json
+import os
+
+from main import Database
+from storage import JsonStorage, SqliteStorage, applyRule, migrate, openStorage
+
+
+def rule(category, payee='', memo='', master='Master'):
+    return {'Master Category': master, 'Category': category, 'Payee': payee, 'Memo': memo}
+
+
+def jsonDatabase(tmp_path, data=None):
+    filename = str(tmp_path / 'database.json')
+    with open(filename, 'w') as f:
+        json.dump(data or {'categories': []}, f)
+    return filename
+
+
+def addRules(storage, rules):
+    data = storage.load()
+    for added in rules:
+        applyRule(data, added)
+        storage.addRule(data, added)
+    return data
+
+
+def test_journal_is_replayed(tmp_path):
+    storage = JsonStorage(jsonDatabase(tmp_path))
+    expected = addRules(storage, [rule('Food', payee='ALBERT HEIJN'), rule('Food', memo='bakker'),
+                                  rule('Rent', payee='WONEN')])
+
+    assert os.path.exists(storage.journalFile())
+    assert JsonStorage(storage.filename).load() == expected
+    # database.json itself is only written when the journal is compacted
+    with open(storage.filename) as f:
+        assert json.load(f) == {'categories': []}
+
+
+def test_cut_off_journal_line_is_ignored(tmp_path):
+    storage = JsonStorage(jsonDatabase(tmp_path))
+    addRules(storage, [rule('Food', payee='ALBERT HEIJN')])
+    # A crash in the middle of an append
+    with open(storage.journalFile(), 'a') as f:
+        f.write('{"Category": "Rent", "Mas')
+
+    data = addRules(JsonStorage(storage.filename), [rule('Fuel', payee='SHELL')])
+    assert [x['Category'] for x in data['categories']] == ['Food', 'Fuel']
+    assert JsonStorage(storage.filename).load() == data
+
+
+def test_replaying_twice_adds_nothing(tmp_path):
+    storage = JsonStorage(jsonDatabase(tmp_path))
+    addRules(storage, [rule('Food', payee='ALBERT HEIJN'), rule('Food', payee='ALBERT HEIJN')])
+
+    data = JsonStorage(storage.filename).load()
+    storage.replayJournal(data)
+    assert data['categories'][0]['Payees'] == ['ALBERT HEIJN']
+
+
+def test_journal_is_compacted(tmp_path):
+    storage = JsonStorage(jsonDatabase(tmp_path))
+    storage.compact_after = 5
+    data = addRules(storage, [rule('Food', payee='PAYEE ' + str(number)) for number in range(7)])
+
+    # Compacted after the fifth rule, the last two are in a new journal
+    with open(storage.filename) as f:
+        assert json.load(f)['categories'][0]['Payees'] == ['PAYEE ' + str(number) for number in range(5)]
+    with open(storage.journalFile()) as f:
+        assert len(f.readlines()) == 2
+    assert not os.path.exists(storage.filename + '.tmp')
+    assert JsonStorage(storage.filename).load() == data
+
+    storage.save(data)
+    assert not os.path.exists(storage.journalFile())
+    assert JsonStorage(storage.filename).load() == data
+
+
+def sqliteDatabase(tmp_path, data):
+    filename = str(tmp_path / 'database.sqlite')
+    SqliteStorage(filename).save(data)
+    return filename
+
+
+DOCUMENT = {'categories': [
+    {'Master Category': 'Living', 'Category': 'Rent', 'Payees': ['WONEN'], 'Memos': []},
+    {'Master Category': 'Daily', 'Category': 'Food', 'Payees': ['ALBERT HEIJN', 'JUMBO'], 'Memos': ['bakker']},
+    {'Master Category': 'Living', 'Category': 'Energy', 'Payees': ['ENECO'], 'Memos': ['stroom', 'gas']},
+]}
+
+
+def test_sqlite_round_trip(tmp_path):
+    storage = SqliteStorage(sqliteDatabase(tmp_path, DOCUMENT))
+    assert storage.load() == DOCUMENT
+    assert storage.categories(None) == ['Rent', 'Food', 'Energy']
+    assert storage.masterCategories(None) == ['Living', 'Daily']
+
+    data = storage.load()
+    for added in [rule('food', payee='LIDL', master='DAILY'), rule('Food', payee='JUMBO', master='Daily'),
+                  rule('Fuel', payee='SHELL', master='Car')]:
+        applyRule(data, added)
+        storage.addRule(data, added)
+    # Names are compared case-insensitively and an entry is stored once
+    assert storage.load() == data
+    assert storage.masterCategories(None) == ['Living', 'Daily', 'Car']
+
+
+def test_migrate_includes_the_journal(tmp_path):
+    storage = JsonStorage(jsonDatabase(tmp_path, DOCUMENT))
+    expected = addRules(storage, [rule('Food', payee='LIDL', master='Daily'), rule('Fuel', payee='SHELL')])
+
+    target = str(tmp_path / 'database.sqlite')
+    assert migrate(storage.filename, target) == 4
+    assert isinstance(openStorage(target), SqliteStorage)
+    assert openStorage(target).load() == expected
+
+
+def useDatabase(filename):
+    Database.filename = filename
+    Database.backend = None
+    Database.data = None
+    Database.pending = []
+    Database.matchers = {}
+
+
+def test_sqlite_categories_include_unsaved_edits(tmp_path):
+    useDatabase(sqliteDatabase(tmp_path, DOCUMENT))
+    database = Database()
+    assert database.getCategories() == ['Rent', 'Food', 'Energy']
+
+    database.addEntry('Car', 'Fuel', 'Payees', 'SHELL')
+    assert database.getCategories() == ['Rent', 'Food', 'Energy', 'Fuel']
+    assert database.getMasterCategories() == ['Living', 'Daily', 'Car']
+
+    database.saveDatabase()
+    assert database.getCategories() == ['Rent', 'Food', 'Energy', 'Fuel']
+    assert SqliteStorage(Database.filename).categories(None) == ['Rent', 'Food', 'Energy', 'Fuel']
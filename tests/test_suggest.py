@@ -0,0 +1,56 @@
+from main import Database, Transaction
+from suggest import Suggester, tokens
+
+CATEGORIES = [
+    {'Master Category': 'Daily', 'Category': 'Groceries', 'Payees': ['Albert Heijn', 'JUMBO'], 'Memos': []},
+    {'Master Category': 'Living', 'Category': 'Energy', 'Payees': ['ENECO'], 'Memos': ['stroom']},
+    {'Master Category': 'Car', 'Category': 'Fuel', 'Payees': ['SHELL', r'^ESSO\b'], 'Memos': []},
+]
+
+
+def names(suggestions):
+    return [category for master, category, score in suggestions]
+
+
+def test_tokens():
+    assert tokens('AH 1234 Heijn') == ['ah', ' ah', 'ah ', 'heijn', ' he', 'hei', 'eij', 'ijn', 'jn ']
+
+
+def test_similar_payees_are_suggested():
+    suggester = Suggester(CATEGORIES)
+    assert names(suggester.suggest('ALBERT HEIJN 1234 AMSTERDAM'))[0] == 'Groceries'
+    assert names(suggester.suggest('HEIJN BV'))[0] == 'Groceries'
+    # The literal text of a regex entry is indexed
+    assert names(suggester.suggest('ESSO EXPRESS'))[0] == 'Fuel'
+    assert names(suggester.suggest('Betaling', memo='stroom en gas'))[0] == 'Energy'
+
+    scores = [score for master, category, score in suggester.suggest('ALBERT HEIJN')]
+    assert scores == sorted(scores, reverse=True)
+    assert all(0 < score <= 1.0 + 1e-9 for score in scores)
+
+
+def test_nothing_in_common():
+    suggester = Suggester(CATEGORIES)
+    assert suggester.suggest('1234 5678') == []
+    assert suggester.suggest('XYZ') == []
+
+
+def test_learned_and_added_rules():
+    suggester = Suggester(CATEGORIES)
+    assert names(suggester.suggest('TANDARTSPRAKTIJK')) == []
+
+    suggester.learn('TANDARTSPRAKTIJK ZUID', 'Health', 'Dentist')
+    assert names(suggester.suggest('TANDARTSPRAKTIJK NOORD')) == ['Dentist']
+
+    suggester.addRule({'Master Category': 'Car', 'Category': 'Parking', 'Payee': 'Q-PARK', 'Memo': ''})
+    assert names(suggester.suggest('Q-PARK CENTRUM'))[0] == 'Parking'
+    # Existing categories are found by name, whatever the case
+    suggester.learn('LIDL', 'daily', 'groceries')
+    assert len(suggester.categories) == 5
+
+
+def test_database_suggestions(database):
+    transaction = Transaction('20200131', 'TANDARTSPRAKTIJK ZUID', '', 'Af', '12,00')
+    Database().learn(transaction, 'Health: Dentist')
+    suggestions = Database().suggest(Transaction('20200201', 'TANDARTSPRAKTIJK NOORD', '', 'Af', '1,00'))
+    assert suggestions[0][:2] == ('Health', 'Dentist')